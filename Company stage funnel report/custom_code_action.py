@@ -1,186 +1,332 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hubspot import HubSpot
+from deadline import DeadlineExceeded, with_deadline
+from hubspot_client import chunks, get_session, search_all
+
+# HubSpot API key
+api_key = os.getenv('YOUR_SECRET_KEY_NAME')
+
+# Pooled keep-alive session for the API requests
+session = get_session(api_key)
+
+# HubSpot caps batch reads at 100 inputs and v4 association pages at 500 results
+BATCH_SIZE = 100
+ASSOCIATIONS_PAGE_SIZE = 500
+
+# Number of batch reads running at the same time
+MAX_WORKERS = 5
+
+# Contact property used as the funnel report filter
+FLAG_PROPERTY = 'opt_in_lcs_funnel_analytics'
+
+
+def get_associated_contact_ids(company_id):
+  """
+  Retrieves the IDs of all contacts associated with a company, following every page.
+
+  :param company_id: The HubSpot company ID.
+  :return: List of contact IDs.
+  """
+  associations_url = f"https://api.hubapi.com/crm/v4/objects/companies/{company_id}/associations/contacts"
+  params = {'limit': ASSOCIATIONS_PAGE_SIZE}
+  contact_ids = []
+
+  while True:
+    response = session.get(associations_url, params=params)
+
+    if response.status_code != 200:
+      raise Exception(f"Error fetching associations: {response.text}")
+
+    associations_data = response.json()
+    contact_ids.extend(assoc['toObjectId'] for assoc in associations_data.get('results', []))
+
+    after = associations_data.get('paging', {}).get('next', {}).get('after')
+    if not after:
+      return contact_ids
+    params['after'] = after
+
+
+def read_contacts_batch(contact_ids):
+  """
+  Reads lifecycle stage, create date and email for up to 100 contacts in one call.
+
+  :param contact_ids: Up to 100 HubSpot contact IDs.
+  :return: List of contact records from the batch read endpoint.
+  """
+  contacts_url = "https://api.hubapi.com/crm/v3/objects/contacts/batch/read"
+  contacts_payload = {
+    "inputs": [{"id": cid} for cid in contact_ids],
+    "properties": ["lifecyclestage", "createdate", "email"]
+  }
+
+  response = session.post(contacts_url, json=contacts_payload)
+
+  # 207 means some of the IDs could not be read (e.g. deleted contacts)
+  if response.status_code not in [200, 207]:
+    raise Exception(f"Error fetching contacts: {response.text}")
+
+  return response.json().get('results', [])
+
+
+def parse_createdate(value):
+  """
+  Parses HubSpot's ISO 8601 createdate, returning None if it is missing.
+  """
+  if not value:
+    return None
+  return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def get_contacts(contact_ids):
+  """
+  Reads the lifecycle stage and create date of every contact with concurrent 100-id batch reads.
+
+  :param contact_ids: List of HubSpot contact IDs.
+  :return: List of dictionaries with contact_id, contact_email, create_date and lifecycle_stage.
+  """
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    batches = list(executor.map(read_contacts_batch, chunks(contact_ids)))
+
+  contact_data = []
+  for batch in batches:
+    for contact in batch:
+      properties = contact.get('properties', {})
+      contact_data.append({
+        "contact_id": contact.get('id'),
+        "contact_email": properties.get('email'),
+        "create_date": parse_createdate(properties.get('createdate')),
+        "lifecycle_stage": properties.get('lifecyclestage'),
+      })
+  return contact_data
+
+
+def get_oldest_matching_contact(contact_data, company_lcs):
+  """
+  Picks the oldest contact whose lifecycle stage matches the company's lifecycle stage.
+
+  :param contact_data: Contacts as returned by get_contacts.
+  :param company_lcs: Lifecycle stage of the company.
+  :return: The matching contact dictionary, or None if no contact matches.
+  """
+  matching = [
+    contact for contact in contact_data
+    if contact["lifecycle_stage"] == company_lcs and contact["create_date"] is not None
+  ]
+  if not matching:
+    return None
+  return min(matching, key=lambda x: x["create_date"])
+
+
+def get_companies_contact_ids(company_ids):
+  """
+  Retrieves the associated contact IDs for up to 100 companies with one v4 batch association read.
+
+  :param company_ids: Up to 100 HubSpot company IDs.
+  :return: Dictionary of company ID -> list of contact IDs.
+  """
+  associations_url = "https://api.hubapi.com/crm/v4/associations/companies/contacts/batch/read"
+  payload = {"inputs": [{"id": str(cid)} for cid in company_ids]}
+
+  response = session.post(associations_url, json=payload)
+
+  # 207 is returned when some of the companies have no associated contacts
+  if response.status_code not in [200, 207]:
+    raise Exception(f"Error fetching associations: {response.text}")
+
+  contact_ids_by_company = {str(cid): [] for cid in company_ids}
+  for result in response.json().get('results', []):
+    company_id = str(result['from']['id'])
+    if result.get('paging', {}).get('next'):
+      # More contacts than fit in one batch page, walk this company on its own
+      contact_ids_by_company[company_id] = get_associated_contact_ids(company_id)
+    else:
+      contact_ids_by_company[company_id] = [assoc['toObjectId'] for assoc in result.get('to', [])]
+  return contact_ids_by_company
+
+
+def get_flagged_contact_ids():
+  """
+  Retrieves the IDs of all contacts currently included in the funnel report.
+  """
+  filters = [{"propertyName": FLAG_PROPERTY, "operator": "EQ", "value": "Yes"}]
+  return {contact['id'] for contact in search_all(session, 'contacts', filters=filters)}
+
+
+def update_flag_batch(contact_ids, value):
+  """
+  Sets the funnel opt-in flag on up to 100 contacts with one batch update.
+
+  :param contact_ids: Up to 100 HubSpot contact IDs.
+  :param value: 'Yes' to include the contacts in the report, '' to clear the flag.
+  :return: List of contact IDs that failed to update.
+  """
+  update_url = "https://api.hubapi.com/crm/v3/objects/contacts/batch/update"
+  payload = {
+    "inputs": [{"id": cid, "properties": {FLAG_PROPERTY: value}} for cid in contact_ids]
+  }
+
+  response = session.post(update_url, json=payload)
+
+  if response.status_code != 200:
+    print(f"Failed to update contacts {contact_ids}. Status Code: {response.status_code}, Response: {response.text}")
+    return list(contact_ids)
+  return []
+
+
+def update_flags(contact_ids, value):
+  """
+  Sets the funnel opt-in flag on any number of contacts with concurrent 100-id batch updates.
+
+  :return: List of contact IDs that failed to update.
+  """
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    results = executor.map(lambda batch: update_flag_batch(batch, value), chunks(sorted(contact_ids)))
+  return [cid for failed_ids in results for cid in failed_ids]
+
+
+def pick_representative_contacts(companies):
+  """
+  Picks the representative contact of every company in one page of search results.
+
+  :param companies: Up to 100 company records with the lifecyclestage property.
+  :return: Set of representative contact IDs.
+  """
+  company_lcs = {company['id']: company.get('properties', {}).get('lifecyclestage') for company in companies}
+  contact_ids_by_company = get_companies_contact_ids(list(company_lcs))
+
+  unique_contact_ids = sorted({str(cid) for ids in contact_ids_by_company.values() for cid in ids})
+  contacts = {contact['contact_id']: contact for contact in get_contacts(unique_contact_ids)}
+
+  representatives = set()
+  for company_id, contact_ids in contact_ids_by_company.items():
+    contact_data = [contacts[str(cid)] for cid in contact_ids if str(cid) in contacts]
+    oldest_primary_contact = get_oldest_matching_contact(contact_data, company_lcs[company_id])
+    if oldest_primary_contact is not None:
+      representatives.add(oldest_primary_contact['contact_id'])
+  return representatives
+
+
+def backfill_company_funnel(dry_run=False):
+  """
+  Recomputes the funnel opt-in flag for every company in the portal.
+
+  Streams all companies through the search API 100 at a time, resolves their contacts
+  and lifecycle stages with batch reads and picks the representative contact in memory.
+  Only contacts whose flag actually changes are written, through batch updates.
+
+  :param dry_run: Compute the changes without writing them.
+  :return: Dictionary with the number of companies processed and flags set/cleared/failed.
+  """
+  flagged = get_flagged_contact_ids()
+  print(f"Contacts currently flagged: {len(flagged)}")
+
+  representatives = set()
+  companies_processed = 0
+  page = []
+
+  for company in search_all(session, 'companies', properties=['lifecyclestage']):
+    page.append(company)
+    if len(page) == BATCH_SIZE:
+      representatives |= pick_representative_contacts(page)
+      companies_processed += len(page)
+      page = []
+      print(f"Companies processed: {companies_processed}, representatives found: {len(representatives)}")
+
+  if page:
+    representatives |= pick_representative_contacts(page)
+    companies_processed += len(page)
+
+  to_set = representatives - flagged
+  to_clear = flagged - representatives
+  print(f"Companies processed: {companies_processed}, flags to set: {len(to_set)}, flags to clear: {len(to_clear)}")
+
+  failed_ids = []
+  if not dry_run:
+    failed_ids += update_flags(to_clear, '')
+    failed_ids += update_flags(to_set, 'Yes')
+
+  return {
+    "companies_processed": companies_processed,
+    "flags_set": len(to_set),
+    "flags_cleared": len(to_clear),
+    "failed_contact_ids": failed_ids
+  }
+
+
+def failed(status_details):
+  return {
+    "outputFields": {
+      "status": "Failed",
+      "status_details": status_details
+    }
+  }
+
+
+@with_deadline()
 def main(event):
   # Use inputs to get data from any action in your workflow and use it in your code instead of having to use the HubSpot API.
   company_id = event["inputFields"]["company_id"]
-  
-  import requests
-  import os
-  from hubspot import HubSpot
-  
+
   status = "No issues"
   status_details = None
-  
-  # HubSpot API endpoint to retrieve company contacts
-  #v2 api
-  company_endpoint = f"https://api.hubapi.com/companies/v2/companies/{company_id}/contacts"
-   
-  # HubSpot API key
-  api_key = os.getenv('YOUR_SECRET_KEY_NAME')
-  
+
   #company Lifecycle Stage
   company_lcs = event["inputFields"]["lifecyclestage"]
   print(f'COMPANY LIFECYCLE STAGE: {company_lcs}')
-  
-  # Set the headers for the API request
-  headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {api_key}"
-  }
 
-  # v2 api
-  # Set the parameters for the API request
-  params = {
-    "filterGroups": [
+  try:
+    contact_ids = get_associated_contact_ids(company_id)
+  except DeadlineExceeded:
+    raise
+  except Exception as e:
+    print(e)
+    return failed("failed to get contacts associated to a company")
+
+  try:
+    contact_data = get_contacts(contact_ids)
+  except DeadlineExceeded:
+    raise
+  except Exception as e:
+    print(e)
+    return failed("failed to get lifecycle stage of associated contacts")
+
+  print(f"ASSOCIATED CONTACTS: {contact_data}")
+
+  # get the oldest primary contact with matching lifecycle stage
+  oldest_primary_contact = get_oldest_matching_contact(contact_data, company_lcs)
+  if oldest_primary_contact is None:
+    return failed("failed to get the oldest primary contact")
+  print(f"OLDEST PRIMARY CONTACT: {oldest_primary_contact}")
+
+  #update the oldest matching contact with Yes in "Opt-in LCS Funnel Analytics" property
+  contact_update_endpoint = f"https://api.hubapi.com/contacts/v1/contact/vid/{oldest_primary_contact['contact_id']}/profile"
+
+  # Set the payload for updating the property
+  data = {
+    "properties": [
       {
-        "filters": [
-          {
-            "propertyName": "lifecyclestage",
-            "operator": "EQ",
-            "value": company_lcs
-          }
-        ]
+        "property": FLAG_PROPERTY,
+        "value": 'Yes'
       }
     ]
   }
-  
-  # Send GET request to retrieve contacts
-  #v2 api
+
+  # Send the POST request to update the contact's property
   try:
-    response = requests.get(company_endpoint, headers=headers, params=params)
-  except:
-    status = "Failed"
-    status_details = "failed to get contacts associated to a company"
+    response = session.post(contact_update_endpoint, json=data)
+
+    if response.status_code == 204:
+      print(f"Contact property updated successfully for {oldest_primary_contact['contact_email']}, id: {oldest_primary_contact['contact_id']}.")
+    else:
+      print(f"Failed to update contact property. Status code: {response.status_code}")
+  except DeadlineExceeded:
     raise
-    return {
-      "outputFields": {
-        "status": status,
-        "status_details": status_details
-      }
-    }
-    
-    
-  if response.status_code == 200:
-    # Get the contacts from the response
-    contacts = response.json().get("contacts", [])
-    
-    # Create a dictionary to store the desired properties for each contact
-    contact_data = []
-    
-    # get contact's lifecycle stage
-    for contact in contacts:
-      try:
-        contact_id = contact['identities'][0]['vid']
-        contact_email = contact['identities'][0]['identity'][0]['value']
-        contact_create_date = contact['identities'][0]['identity'][0]['timestamp']
-        
-      except:
-        status = "Failed"
-        status_details = "failed to get specific contact details"
-        return {
-          "outputFields": {
-            "status": status,
-            "status_details": status_details
-          }
-        }
-        
-      contact_lifecycle_stage = None
-      
-      contact_endpoint = f"https://api.hubapi.com/contacts/v1/contact/vid/{contact_id}/profile"
-      
-      try:
-        contact_response = requests.get(contact_endpoint, headers=headers)
-      except:
-        print(f"Failed to retrieve contact response for {contact_id}. Status code: {contact_response.status_code}")
-        raise
-      
-      if contact_response.status_code == 200:
-        try:
-          # Get the contact properties from the contact_response
-          properties = contact_response.json().get("properties", {})
-          # Fetch the lifecycle stage property value
-          contact_lifecycle_stage = properties.get("lifecyclestage", {}).get("value")
-        except:
-          status = "Failed"
-          status_details = "failed to get lifecycle stage of a specific contact"
-          return {
-            "outputFields": {
-            "status": status,
-            "status_details": status_details
-            }
-          }
-          
-      else:
-        print(f"Failed to retrieve contact properties. Status code: {contact_response.status_code}")
-      
-      contact_info = {
-        "contact_id": contact_id,
-        "contact_email": contact_email,
-        "create_date": contact_create_date,
-        "lifecycle_stage": contact_lifecycle_stage,
-      }
-      
-      contact_data.append(contact_info)
-
-    print(f"ASSOCIATED CONTACTS: {contact_data}")  
-    
-  else:
-    print(f"Failed to retrieve contacts. Status code: {response.status_code}")
-    contacts = 'none'
-    contact_data = None
-    
-    status = "Failed"
-    status_details = "failed to get contacts associated to a company"
-  
-  
-  # get the oldest primary contact with matching lifecycle stage
-  try:
-    oldest_primary_contact = min(
-      (contact for contact in contact_data if contact["lifecycle_stage"] == company_lcs),
-      key=lambda x: x["create_date"]
-    )
-    print(f"OLDEST PRIMARY CONTACT: {oldest_primary_contact}")
-  
-  
-    #update the oldest matching contact with Yes in "Opt-in LCS Funnel Analytics" property 
-    contact_update_endpoint = f"https://api.hubapi.com/contacts/v1/contact/vid/{oldest_primary_contact['contact_id']}/profile"
-  
-    # Set the payload for updating the property
-    data = {
-      "properties": [
-        {
-          "property": 'opt_in_lcs_funnel_analytics',
-          "value": 'Yes'
-        }
-      ]
-    }
-  
-    # Send the POST request to update the contact's property
-    try:
-      response = requests.post(contact_update_endpoint, headers=headers, json=data)
-    
-      if response.status_code == 204:
-        print(f"Contact property updated successfully for {oldest_primary_contact['contact_email']}, id: {oldest_primary_contact['contact_id']}.")
-      else:
-        print(f"Failed to update contact property. Status code: {response.status_code}")
-    except:
-      status = "Failed"
-      status_details = "failed to update the oldest primary contact"
-      return {
-        "outputFields": {
-          "status": status,
-          "status_details": status_details
-        }
-      }
-      
-  except:
-    status = "Failed"
-    status_details = "failed to get the oldest primary contact"
-    return {
-      "outputFields": {
-        "status": status,
-        "status_details": status_details
-      }
-    }
-  
+  except Exception:
+    return failed("failed to update the oldest primary contact")
+
   # Return the output data that can be used in later actions in your workflow.
   return {
     "outputFields": {
@@ -188,3 +334,10 @@ def main(event):
       "status_details": status_details
     }
   }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Recompute the LCS funnel opt-in flag for every company in the portal.")
+  parser.add_argument("--dry-run", action="store_true", help="compute the changes without writing them")
+  args = parser.parse_args()
+  print(backfill_company_funnel(dry_run=args.dry_run))
@@ -1,97 +1,224 @@
 import os
-import requests
+import random
+import sqlite3
+import time
+from contextlib import closing
+from deadline import with_deadline
+from hubspot_client import chunks, get_session
+from ttl_cache import TTLCache
 
 # Retrieve the HubSpot access token from environment variables.
 access_token = os.getenv("RevOps")
 
-# Set up headers for Bearer token authentication.
-headers = {
-  "Authorization": f"Bearer {access_token}",
-  "Content-Type": "application/json"
-}
+# Pooled keep-alive session with Bearer token authentication, timeouts and gzip.
+session = get_session(access_token)
 
-def ensure_option_exists(primary_team_id, label=None):
+PROPERTY_URL = "https://api.hubapi.com/crm/v3/properties/deals/creator_s_team"
+
+# Teams and 'creator_s_team' option values rarely change, so keep them for an hour.
+# Set DEAL_CREATOR_CACHE_PATH to share the cache between runs through a file.
+CACHE_TTL = 3600
+cache = TTLCache(CACHE_TTL, path=os.getenv("DEAL_CREATOR_CACHE_PATH"))
+
+# Deals whose team has no option yet wait here for the next reconcile_team_options() run.
+# Must point to the same file for the action and the scheduled reconcile.
+QUEUE_PATH = os.getenv("DEAL_CREATOR_QUEUE_PATH")
+
+
+def get_teams(refresh=False):
+  """
+  Returns the teams map (team id -> team name), from the cache unless it is
+  missing, expired or `refresh` is set.
+  """
+  teams = None if refresh else cache.get("teams")
+  if teams is None:
+    teams_url = "https://api.hubapi.com/settings/v3/users/teams"
+    teams_response = session.get(teams_url)
+    teams_response.raise_for_status()
+    teams = {team.get("id"): team.get("name") for team in teams_response.json().get("results", [])}
+    cache.set("teams", teams)
+  return teams
+
+
+def get_property_options():
+  """
+  Retrieves the current options of the 'creator_s_team' deal property and
+  refreshes the cached option values with them.
+  """
+  response = session.get(PROPERTY_URL)
+  response.raise_for_status()
+  options = response.json().get("options", [])
+  cache.set("option_values", [option.get("value") for option in options])
+  return options
+
+
+def option_exists(primary_team_id):
   """
   Checks if an option with the primary_team_id as the internal name exists
-  in the 'creator_s_team' property on deals. If it does not exist, add the option.
-  
-  If a label is not provided, it retrieves the team name from the
-  /settings/v3/users/teams endpoint.
+  in the 'creator_s_team' property on deals.
+
+  Known option values are cached, so for a team that already has an option this
+  makes no API calls. A cache miss re-reads the property before answering.
     
   Args:
     primary_team_id (str): The primary team ID (used as the option's internal value).
-    label (str, optional): The label for the new option. If not provided, it will be
-                           retrieved from the teams endpoint.
+
+  Returns:
+    bool: True if the option exists.
   """
-  # If label is not provided, fetch the team name from the teams API.
-  if label is None:
-    teams_url = "https://api.hubapi.com/settings/v3/users/teams"
-    teams_response = requests.get(teams_url, headers=headers)
-    teams_response.raise_for_status()
-    teams_data = teams_response.json()
-    teams = teams_data.get("results", [])
-    
-    found_label = None
-    for team in teams:
-      if team.get("id") == primary_team_id:
-        found_label = team.get("name")
-        break
-      
-    if found_label:
-      label = found_label
-    else:
-      label = primary_team_id  # Fallback if team is not found
+  if primary_team_id in (cache.get("option_values") or []):
+    print(f"Option with value '{primary_team_id}' already exists (cached).")
+    return True
 
   # Retrieve the property details for 'creator_s_team' on deals.
-  property_url = "https://api.hubapi.com/crm/v3/properties/deals/creator_s_team"
-  response = requests.get(property_url, headers=headers)
-  response.raise_for_status()
-  property_data = response.json()
-  
-  options = property_data.get("options", [])
-  
-  # Check if an option with the given primary_team_id already exists.
-  for option in options:
-    if option.get("value") == primary_team_id:
-      print(f"Option with value '{primary_team_id}' already exists.")
-      return  # Option exists, nothing to add.
-  
-  # Determine displayOrder for the new option (one more than the highest order).
-  if options:
-    max_order = max(option.get("displayOrder", 0) for option in options)
-    new_display_order = max_order + 1
-  else:
-    new_display_order = 1
-     
-  new_option = {
-    "label": label,
-    "value": primary_team_id,
-    "displayOrder": new_display_order,
-    "hidden": False
-  }
-  
-  print(new_option)
-  
-  # Append the new option to the existing options.
+  options = get_property_options()
+  return any(option.get("value") == primary_team_id for option in options)
+
+
+def get_queue():
+  """
+  Opens the local queue of deals waiting for their team's option to be added,
+  creating the table on first use.
+  """
+  if not QUEUE_PATH:
+    raise Exception("DEAL_CREATOR_QUEUE_PATH is not set; the action and reconcile_team_options() must share the queue file.")
+  connection = sqlite3.connect(QUEUE_PATH, timeout=30)
+  connection.execute(
+    "CREATE TABLE IF NOT EXISTS pending_deals ("
+    "deal_id TEXT PRIMARY KEY, primary_team_id TEXT NOT NULL, "
+    "deal_creator_id TEXT, queued_at REAL NOT NULL)"
+  )
+  return connection
+
+
+def queue_deal(deal_id, primary_team_id, deal_creator_id):
+  """
+  Queues a deal whose team has no 'creator_s_team' option yet. The option is added
+  and the deal updated by the next reconcile_team_options() run.
+  """
+  with closing(get_queue()) as connection, connection:
+    connection.execute(
+      "INSERT OR REPLACE INTO pending_deals VALUES (?, ?, ?, ?)",
+      (str(deal_id), str(primary_team_id), str(deal_creator_id), time.time())
+    )
+  print(f"Queued deal {deal_id} until an option for team '{primary_team_id}' is added.")
+
+
+def build_options(options, team_ids, teams):
+  """
+  Returns the options list with one new option appended for every team id that has none.
+
+  Args:
+    options (list): Current options of the property.
+    team_ids (iterable): Team ids that must have an option.
+    teams (dict): Teams map used for the option labels.
+  """
+  existing = {option.get("value") for option in options}
+  max_order = max((option.get("displayOrder", 0) for option in options), default=0)
+
   updated_options = options.copy()
-  updated_options.append(new_option)
-  
-  print(updated_options)
-  
-  # Update the property with the new options list.
-  patch_payload = {
-    "options": updated_options
+  for team_id in sorted(set(team_ids) - existing):
+    max_order += 1
+    updated_options.append({
+      "label": teams.get(team_id) or team_id,  # Fallback if team is not found
+      "value": team_id,
+      "displayOrder": max_order,
+      "hidden": False
+    })
+  return updated_options
+
+
+def sync_team_options(team_ids, max_attempts=5):
+  """
+  Adds options for all given team ids to the 'creator_s_team' property in one PATCH.
+
+  This is the only code that writes the options (the action queues deals instead),
+  so run reconcile_team_options() from a single scheduler. HubSpot has no
+  compare-and-swap for the options list and replaces it on PATCH, so an edit made in
+  the UI between the read and the PATCH can still be lost. To catch that, the list is
+  re-read after the PATCH: every option we wrote must still be there, next to anything
+  added meanwhile. If a needed team option is missing, the merge is redone on top of
+  the newer list; other missing options are reported but not restored.
+
+  Args:
+    team_ids (iterable): Team ids that must have an option.
+    max_attempts (int): How many read-merge-write rounds to try.
+
+  Returns:
+    tuple: The options list after the sync and the number of options added.
+  """
+  team_ids = {team_id for team_id in team_ids if team_id}
+  teams = get_teams()
+
+  for attempt in range(max_attempts):
+    options = get_property_options()
+    updated_options = build_options(options, team_ids, teams)
+    if len(updated_options) == len(options):
+      return options, 0
+
+    patch_response = session.patch(PROPERTY_URL, json={"options": updated_options})
+    if not patch_response.ok:
+      print("Error updating property options:", patch_response.status_code, patch_response.text)
+      cache.invalidate("option_values")
+      patch_response.raise_for_status()
+    print(f"Added {len(updated_options) - len(options)} new options.")
+
+    # Expected after the PATCH: everything we wrote plus whatever others added since
+    current_options = get_property_options()
+    current_values = {option.get("value") for option in current_options}
+    dropped = {option.get("value") for option in updated_options} - current_values
+    if not dropped & team_ids:
+      if dropped:
+        print(f"Options removed by another writer during the sync: {sorted(dropped)}")
+      return current_options, len(updated_options) - len(options)
+    print(f"Team options {sorted(dropped & team_ids)} were overwritten by another writer, merging again.")
+    time.sleep(random.uniform(0, 2 ** attempt))
+
+  raise Exception(f"Could not reconcile 'creator_s_team' options after {max_attempts} attempts.")
+
+
+def reconcile_team_options():
+  """
+  Syncs every team (and every queued team id) into the 'creator_s_team' property
+  with a single coalesced PATCH, then updates the queued deals in batches.
+
+  Returns:
+    dict: Number of options added and of queued deals updated/failed.
+  """
+  with closing(get_queue()) as connection:
+    pending = connection.execute(
+      "SELECT deal_id, primary_team_id, deal_creator_id FROM pending_deals"
+    ).fetchall()
+
+  team_ids = set(get_teams(refresh=True)) | {team_id for _, team_id, _ in pending}
+  options, options_added = sync_team_options(team_ids)
+  option_values = {option.get("value") for option in options}
+
+  updated, failed = [], []
+  ready = [row for row in pending if row[1] in option_values]
+  for batch in chunks(ready):
+    update_url = "https://api.hubapi.com/crm/v3/objects/deals/batch/update"
+    payload = {
+      "inputs": [
+        {"id": deal_id, "properties": {"creator_s_team": team_id, "deal_creator": creator_id}}
+        for deal_id, team_id, creator_id in batch
+      ]
+    }
+    response = session.post(update_url, json=payload)
+    if response.status_code == 200:
+      updated.extend(deal_id for deal_id, _, _ in batch)
+    else:
+      print(f"Failed to update deals. Status Code: {response.status_code}, Response: {response.text}")
+      failed.extend(deal_id for deal_id, _, _ in batch)
+
+  with closing(get_queue()) as connection, connection:
+    connection.executemany("DELETE FROM pending_deals WHERE deal_id = ?", [(deal_id,) for deal_id in updated])
+
+  return {
+    "options_added": options_added,
+    "deals_updated": len(updated),
+    "deals_failed": len(failed)
   }
-  
-  
-  try:
-    patch_response = requests.patch(property_url, headers=headers, json=patch_payload)
-    patch_response.raise_for_status()
-    print(f"Added new option: {new_option}")
-  except requests.HTTPError as e:
-    print("Error updating property options:", e)
-    print("Response content:", patch_response.text)
-    raise
 
 
 
@@ -115,12 +242,13 @@ def update_deal_creator_team(deal_id, primary_team_id,deal_creator_id):
       "deal_creator": deal_creator_id
     }
   }
-  response = requests.patch(deal_update_url, headers=headers, json=update_payload)
+  response = session.patch(deal_update_url, json=update_payload)
   response.raise_for_status()  # Raises an error if the update fails.
   return response.json()
 
 
 
+@with_deadline()
 def main(event):
   # Use inputs to get data from any action in your workflow and use it in your code instead of having to use the HubSpot API.
   deal_creator_id = event["inputFields"]["hs_created_by_user_id"]
@@ -132,7 +260,7 @@ def main(event):
   url = f"https://api.hubapi.com/settings/v3/users/{deal_creator_id}"
   
   # Make the GET request to retrieve the user details.
-  response = requests.get(url, headers=headers)
+  response = session.get(url)
   response.raise_for_status()  # Raises an error for a bad status.
   user_data = response.json()
   
@@ -142,17 +270,29 @@ def main(event):
   
   print(primary_team_id)
 
-  # Ensure that the option for this primary_team_id exists in the 'creator_s_team' property.
-  ensure_option_exists(primary_team_id)
-  
-  # Update the deal property 'creator_s_team' with the primary team ID.
-  update_result = update_deal_creator_team(deal_id, primary_team_id,deal_creator_id)
-  print("Deal update result:", update_result)
+  # Update the deal property 'creator_s_team' with the primary team ID if it is a known option,
+  # otherwise leave it to the next coalesced reconcile_team_options() run.
+  if primary_team_id is None:
+    print("Deal creator has no primary team.")
+    creator_team_status = "no team"
+  elif option_exists(primary_team_id):
+    update_result = update_deal_creator_team(deal_id, primary_team_id,deal_creator_id)
+    print("Deal update result:", update_result)
+    creator_team_status = "updated"
+  else:
+    queue_deal(deal_id, primary_team_id, deal_creator_id)
+    creator_team_status = "queued"
   
 
   return {
     "outputFields": {
       "deal_creator_id": deal_creator_id,
-      "primary_team_id": primary_team_id
+      "primary_team_id": primary_team_id,
+      "creator_team_status": creator_team_status
     }
   }
+
+
+if __name__ == "__main__":
+  # Run on a schedule to add missing team options and update the queued deals.
+  print(reconcile_team_options())
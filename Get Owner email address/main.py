@@ -1,31 +1,30 @@
+import os
+from hubspot import HubSpot
+from deadline import with_deadline
+from hubspot_client import get_session
+from owner_directory import OwnerDirectory
+
+# HubSpot API key
+api_key = os.getenv('API_key')
+
+# Owners are loaded in bulk once and kept between warm runs (and in OWNER_CACHE_PATH if set),
+# so resolving an owner id normally makes no API call.
+directory = OwnerDirectory(get_session(api_key), path=os.getenv('OWNER_CACHE_PATH'))
+
+@with_deadline(email="")
 def main(event):
   # Use inputs to get data from any action in your workflow and use it in your code instead of having to use the HubSpot API.
-  import requests
-  import os
-  from hubspot import HubSpot
-  
-  # HubSpot API key
-  api_key = os.getenv('API_key')
-  
   ownerID = event["inputFields"]["ownerID"]
-  
-  owner_endpoint = f"https://api.hubapi.com/crm/v3/owners/{ownerID}?idProperty=id&archived=false"
 
-  # Set the headers for the API request
-  headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {api_key}"
-  }
-
-  # Send GET request to retrieve contacts
-  response = requests.get(owner_endpoint, headers=headers)
+  owner = directory.get(ownerID)
 
-  if response.json().get("status", []) == 'error':
+  # Only active owners have an email to return (same as querying with archived=false)
+  if owner is None or owner["archived"]:
     email = ""
   else:
-    email = response.json().get("email", [])
-  
-  print(response.text)
+    email = owner["email"]
+
+  print(owner)
   # Return the output data that can be used in later actions in your workflow.
   return {
     "outputFields": {
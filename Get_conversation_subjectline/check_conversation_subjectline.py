@@ -4,9 +4,11 @@
 # get conversation subjectline and check if it's a reply to an email with a subjectline from the EmailSubjectlines
 
 import os
-import requests
 import logging
-from typing import Dict, Any
+import deadline
+from hubspot_client import get_session
+from ttl_cache import TTLCache
+from typing import Dict, Any, Iterator
 
 isError = ''
 log_buffer = []
@@ -26,37 +28,62 @@ EmailSubjectlines = [
   "list subjectlines here"
 ]
 
+THREADS_URL = "/conversations/v3/conversations/threads"
+
+# The first email is usually among the first few messages, so pages are kept small
+MESSAGES_PAGE_SIZE = 10
+
+session = get_session(secret_value)
+
+# Subject of each thread's first message, kept between warm runs (and in CONVERSATION_CACHE_PATH if set)
+SUBJECT_CACHE_TTL = 30 * 24 * 3600
+SUBJECT_CACHE_SIZE = 10000
+subject_cache = TTLCache(SUBJECT_CACHE_TTL, path=os.getenv('CONVERSATION_CACHE_PATH'), max_entries=SUBJECT_CACHE_SIZE)
+
+
+def iter_thread_messages(threadID: str, page_size: int = MESSAGES_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+  # Streams a thread's messages page by page, following the paging cursor only as far as the caller reads
+  request_url = f"{THREADS_URL}/{threadID}/messages"
+  params = {"limit": page_size}
+
+  while True:
+    response = session.get(request_url, params=params)
+    print(request_url, response.status_code)
+
+    if response.status_code != 200:
+      raise Exception(f"Error fetching thread messages: {response.text}")
+
+    data = response.json()
+    yield from data.get("results", [])
+
+    after = data.get("paging", {}).get("next", {}).get("after")
+    if not after:
+      return
+    params["after"] = after
+
 
 def call_conversations_api(threadID: str) -> str:
-  url = 'https://api.hubapi.com/conversations/v3/conversations/threads/'
-  headers = {'Authorization': f'Bearer {secret_value}'}
-  base_url="https://api.hubapi.com/conversations/v3/conversations/threads/"
-    
-  #API Request Headers
-  headers = {
-    'Content-Type': 'application/json',
-    'Authorization': 'Bearer ' + secret_value,
-  }
-  request_url = base_url+threadID+'/'+'messages'
-  print(request_url)
-  
-  response = requests.get( request_url, headers=headers)
-  print(response.status_code)
+  if not threadID:
+    custom_log("No thread id given", "ERROR")
+    return "No subject"
 
-  Jresp = response.json()
-  
-  messageIndex=0
-  while Jresp["results"][messageIndex]["type"] != "MESSAGE":
-    messageIndex+=1
-  print("index: ", messageIndex,Jresp["results"][messageIndex]["type"])
-    
-  try:
-    title = Jresp["results"][messageIndex]["subject"]
-    print("Title: ", type(title), len(title))
-  except:
-    title="No subject"
-    
-  
+  title = subject_cache.get(threadID)
+  if title is not None:
+    print("Title (cached): ", title)
+    return title
+
+  # Stop at the first email message instead of downloading the whole thread
+  message = next((message for message in iter_thread_messages(threadID) if message.get("type") == "MESSAGE"), None)
+  if message is None:
+    # Not cached: the thread may still get its first message
+    custom_log(f"No message found in thread {threadID}", "ERROR")
+    return "No subject"
+
+  title = message.get("subject") or "No subject"
+  print("Title: ", type(title), len(title))
+
+  # The first message of a thread does not change
+  subject_cache.set(threadID, title)
   return title
   
 
@@ -65,6 +92,7 @@ def custom_log(msg, level="INFO"):
     log_buffer.append(log_message)
     logging.getLogger().log(logging._nameToLevel[level], msg)
 
+@deadline.with_deadline(conversation_title='', is_email_response='no', isError='Yes')
 def main(event: Dict[str, Any]) -> Dict[str, Any]:
     try:
         threadID = event["inputFields"]["hs_thread_id"]
@@ -2,79 +2,74 @@
 # when a lead is moved to Qualified by automation
 # 1. get last deal from the associated contact
 # 2. associate lead with a deal 
+# run as a script to backfill existing qualified leads in bulk (batch association endpoints)
 
 # Use inputs to get data from any action in your workflow and use it in your code instead of having to use the HubSpot API.
-from datetime import datetime
-import requests
+import argparse
 import os
 import json
-from hubspot import HubSpot
+from concurrent.futures import ThreadPoolExecutor
+from deadline import with_deadline
+from hubspot_client import batch_read_associations, chunks, get_session, search_all
 
 # HubSpot API key
 api_key = os.getenv('OPS_HubSpot_Workflow_app')
 
-headers = {
-  'Authorization': f'Bearer {api_key}',
-  'Content-Type': 'application/json'
-}
+# Pooled keep-alive session (auth headers, timeouts and gzip set once)
+session = get_session(api_key)
+
+# Object type IDs of leads and deals
+LEAD_OBJECT_TYPE = '0-136'
+DEAL_OBJECT_TYPE = '0-3'
+
+# Internal ID of the lead pipeline stage picked up by the bulk backfill (or pass --stage)
+QUALIFIED_LEAD_STAGE = os.getenv('qualified_lead_stage')
+
+# Number of batch calls running at the same time during the backfill
+MAX_WORKERS = 5
 
 def get_last_deal(contact_id):
     """
     Retrieves last deal associated with a given contact ID
 
+    Asks the deals search API for the single most recently created deal associated
+    with the contact, so the result is correct however many deals the contact has.
+
     :param contact_id: The HubSpot contact ID.
     :return: Dictionary with last deal associated to a contact, including its details.
     """
-    # HubSpot Associations API Endpoint
-    associations_url = f"https://api.hubapi.com/crm/v4/objects/contacts/{contact_id}/associations/deals"
-
-    # Fetch associated deals
-    response = requests.get(associations_url, headers=headers, params={'limit': 100})
-
-    if response.status_code != 200:
-        raise Exception(f"Error fetching associations: {response.text}")
-
-    associations_data = response.json()
-    print(associations_data)
-
-    deal_ids = [assoc['toObjectId'] for assoc in associations_data.get('results', [])]
-    print(deal_ids)
-
-    if not deal_ids:
-        return []
-
-    # Batch fetch deal details
-    deal_url = "https://api.hubapi.com/crm/v3/objects/deals/batch/read"
-    deals_payload = {
-        "inputs": [{"id": tid} for tid in deal_ids],
-        "properties": ["hubspot_owner_id"
-                      ]
+    search_url = "https://api.hubapi.com/crm/v3/objects/deals/search"
+    search_payload = {
+        "filterGroups": [{
+            "filters": [
+                {"propertyName": "associations.contact", "operator": "EQ", "value": str(contact_id)}
+            ]
+        }],
+        "sorts": [{"propertyName": "createdate", "direction": "DESCENDING"}],
+        "properties": ["hubspot_owner_id", "createdate"],
+        "limit": 1
     }
 
-    deals_response = requests.post(deal_url, headers=headers, json=deals_payload)
+    response = session.post(search_url, json=search_payload)
 
-    if deals_response.status_code != 200:
-        raise Exception(f"Error fetching deals: {deals_response.text}")
+    if response.status_code != 200:
+        raise Exception(f"Error fetching deals: {response.text}")
 
-    deals_data = deals_response.json()
-    last_deal = dict()
+    results = response.json().get('results', [])
+    print(results)
 
-    # Sort deals by created date in descending order (most recent first)
-    sorted_deals = sorted(deals_data.get('results', []), key=lambda x: x['properties'].get('createdate', 0), reverse=True)
+    if not results:
+        return {}
 
-    if sorted_deals:
-        # Select the most recent deal
-        most_recent_deal = sorted_deals[0]
-        properties = most_recent_deal.get('properties', {})
+    # Select the most recent deal
+    properties = results[0].get('properties', {})
 
-        # Populate the last_deal dictionary with required information
-        last_deal = {
-            'deal_id': properties.get('hs_object_id', ''),
-            'deal_owner': properties.get('hubspot_owner_id', ''),
-            'created_at': properties.get('createdate', 'N/A')
-        }
-    else:
-        last_deal = {}
+    # Populate the last_deal dictionary with required information
+    last_deal = {
+        'deal_id': properties.get('hs_object_id', ''),
+        'deal_owner': properties.get('hubspot_owner_id', ''),
+        'created_at': properties.get('createdate', 'N/A')
+    }
 
     return last_deal
 
@@ -90,7 +85,7 @@ def associate_lead_to_deal(lead_id, deal_id):
   endpoint_url = f"https://api.hubapi.com/crm/v4/objects/0-136/{lead_id}/associations/default/0-3/{deal_id}"
   
   # Send POST request to create association
-  response = requests.put(endpoint_url, headers=headers)
+  response = session.put(endpoint_url)
    
   if response.status_code == 201:
     print("Association created successfully.")
@@ -102,6 +97,153 @@ def associate_lead_to_deal(lead_id, deal_id):
   
   return association_creation_status
 
+def get_latest_deals(contact_ids):
+    """
+    Retrieves the most recently created deal of up to 100 contacts with batch calls.
+
+    :param contact_ids: Up to 100 HubSpot contact IDs.
+    :return: Dictionary of contact ID -> latest deal ID for contacts that have deals.
+    """
+    deal_ids_by_contact = batch_read_associations(session, 'contacts', 'deals', contact_ids)
+    deal_ids = sorted({did for ids in deal_ids_by_contact.values() for did in ids})
+    if not deal_ids:
+        return {}
+
+    def read_createdates(batch):
+        deals_url = "https://api.hubapi.com/crm/v3/objects/deals/batch/read"
+        payload = {"inputs": [{"id": did} for did in batch], "properties": ["createdate"]}
+        response = session.post(deals_url, json=payload)
+
+        # 207 means some of the IDs could not be read (e.g. deleted deals)
+        if response.status_code not in [200, 207]:
+            raise Exception(f"Error fetching deals: {response.text}")
+        return response.json().get('results', [])
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        batches = list(executor.map(read_createdates, chunks(deal_ids)))
+    createdates = {
+        deal['id']: deal.get('properties', {}).get('createdate') or ''
+        for batch in batches for deal in batch
+    }
+
+    latest_deals = {}
+    for contact_id, ids in deal_ids_by_contact.items():
+        known_ids = [did for did in ids if did in createdates]
+        if known_ids:
+            latest_deals[contact_id] = max(known_ids, key=lambda did: createdates[did])
+    return latest_deals
+
+
+def associate_leads_to_deals_batch(pairs):
+    """
+    Creates default lead-to-deal associations for up to 100 pairs with one v4 batch call.
+
+    :param pairs: Up to 100 (lead_id, deal_id) tuples.
+    :return: Dictionary of (lead_id, deal_id) -> 'success' or an error message.
+    """
+    endpoint_url = f"https://api.hubapi.com/crm/v4/associations/{LEAD_OBJECT_TYPE}/{DEAL_OBJECT_TYPE}/batch/associate/default"
+    payload = {
+        "inputs": [{"from": {"id": lead_id}, "to": {"id": deal_id}} for lead_id, deal_id in pairs]
+    }
+
+    response = session.post(endpoint_url, json=payload)
+
+    if response.status_code not in [200, 201, 207]:
+        error = f"{response.status_code} {response.text}"
+        return {pair: error for pair in pairs}
+
+    return parse_batch_associate_response(response.json(), pairs)
+
+
+def parse_batch_associate_response(response_data, pairs):
+    """
+    Maps a v4 batch/associate/default response back to the requested pairs.
+
+    Each result looks like {"from": {"id": "1"}, "to": {"id": "2"}, "associationSpec": {...}};
+    each error names its pairs in context.fromObjectId / context.toObjectId.
+
+    :param response_data: Parsed JSON body of the batch association call.
+    :param pairs: The (lead_id, deal_id) tuples that were sent.
+    :return: Dictionary of (lead_id, deal_id) -> 'success' or an error message.
+    """
+    created = {
+        (str(result['from']['id']), str(result['to']['id']))
+        for result in response_data.get('results', [])
+    }
+    errors = {}
+    for error in response_data.get('errors', []):
+        context = error.get('context') or {}
+        for lead_id, deal_id in zip(context.get('fromObjectId', []), context.get('toObjectId', [])):
+            errors.setdefault((str(lead_id), str(deal_id)), error.get('message', ''))
+    statuses = {}
+    for lead_id, deal_id in pairs:
+        pair = (str(lead_id), str(deal_id))
+        statuses[pair] = 'success' if pair in created else errors.get(pair, "not created")
+    return statuses
+
+
+def backfill_lead_deal_associations(lead_stage, dry_run=False):
+    """
+    Associates every lead in the given stage with the latest deal of its contact.
+
+    Leads are streamed 100 at a time; their contacts, existing deal associations and the
+    contacts' latest deals are resolved with batch calls, and the new associations are
+    created through the v4 batch association endpoint, 100 pairs per call.
+
+    :param lead_stage: Lead pipeline stage to backfill.
+    :param dry_run: Resolve the pairs without creating the associations.
+    :return: List of dictionaries with lead_id, contact_id, deal_id and status for each lead.
+    """
+    filters = [{"propertyName": "hs_pipeline_stage", "operator": "EQ", "value": lead_stage}]
+    report = []
+    page = []
+
+    def process_page(leads):
+        lead_ids = [lead['id'] for lead in leads]
+        contact_ids_by_lead = batch_read_associations(session, LEAD_OBJECT_TYPE, 'contacts', lead_ids)
+        deal_ids_by_lead = batch_read_associations(session, LEAD_OBJECT_TYPE, 'deals', lead_ids)
+
+        contact_by_lead = {lid: ids[0] for lid, ids in contact_ids_by_lead.items() if ids}
+        latest_deals = get_latest_deals(sorted(set(contact_by_lead.values())))
+
+        page_report = {}
+        pairs = []
+        for lead_id in lead_ids:
+            contact_id = contact_by_lead.get(lead_id)
+            deal_id = latest_deals.get(contact_id)
+            if deal_ids_by_lead.get(lead_id):
+                status = 'already associated'
+            elif contact_id is None:
+                status = 'no contact'
+            elif deal_id is None:
+                status = 'no deal'
+            else:
+                status = 'dry run' if dry_run else None
+                pairs.append((lead_id, deal_id))
+            page_report[lead_id] = {'lead_id': lead_id, 'contact_id': contact_id, 'deal_id': deal_id, 'status': status}
+
+        if pairs and not dry_run:
+            for (lead_id, deal_id), status in associate_leads_to_deals_batch(pairs).items():
+                page_report[lead_id]['status'] = status
+                if status != 'success':
+                    print(f"Association creation error for lead {lead_id} and deal {deal_id}: {status}")
+
+        report.extend(page_report.values())
+        created = sum(1 for row in report if row['status'] == 'success')
+        print(f"Leads processed: {len(report)}, associations created: {created}")
+
+    for lead in search_all(session, LEAD_OBJECT_TYPE, filters=filters):
+        page.append(lead)
+        if len(page) == 100:
+            process_page(page)
+            page = []
+    if page:
+        process_page(page)
+
+    return report
+
+
+@with_deadline()
 def main(event):
   lead_id = event["inputFields"]["lead_id"]
   contact_id = event["inputFields"]["contact_id"]
@@ -128,3 +270,14 @@ def main(event):
       "create_association": create_association
     }
   }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Associate existing leads with the latest deal of their contact.")
+  parser.add_argument("--stage", default=QUALIFIED_LEAD_STAGE, help="lead pipeline stage to backfill")
+  parser.add_argument("--dry-run", action="store_true", help="resolve the lead/deal pairs without creating associations")
+  args = parser.parse_args()
+  if not args.stage:
+    parser.error("the lead stage is required: pass --stage or set qualified_lead_stage")
+  report = backfill_lead_deal_associations(lead_stage=args.stage, dry_run=args.dry_run)
+  print(json.dumps(report, indent=2))
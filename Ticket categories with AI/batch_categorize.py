@@ -0,0 +1,218 @@
+# Bulk (re-)categorization of existing tickets, e.g. after CATEGORIES changed.
+# Tickets are streamed from HubSpot, packed several per chat completion with a JSON answer,
+# classified with bounded concurrency and written back through the tickets batch update
+# endpoint. After every written window the last ticket id is checkpointed, so an
+# interrupted run continues where it stopped.
+#
+# Usage:
+#   python batch_categorize.py [--only-missing] [--dry-run] [--checkpoint PATH]
+# Against the local stub instead of OpenAI:
+#   python openai_stub.py --port 8000 &
+#   OPENAI_BASE_URL=http://localhost:8000/v1 python batch_categorize.py --dry-run
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterable, List
+
+import requests
+
+from circuit_breaker import get_breaker, is_server_error
+from custom_code_action import (CATEGORIES, CATEGORY_PROPERTY, MODEL, OBJECTIVE, OPENAI_BASE_URL,
+                                call_openai_api, classify_locally, parse_category, secret_value)
+from hubspot_client import batch_errors, chunks, get_session, search_all
+from hubspot_ratelimit import backoff_delay
+from prompt_budget import prepare_description
+
+# HubSpot private app token with tickets read/write scopes
+hubspot_token = os.getenv('HubSpot', None)
+
+TICKET_PROPERTIES = ['subject', 'content', CATEGORY_PROPERTY]
+
+# Tickets packed into one chat completion
+TICKETS_PER_REQUEST = 10
+
+# Descriptions are cleaned and cut so a full pack stays well inside the context window
+MAX_DESCRIPTION_TOKENS = 300
+
+# Tickets classified and written back between two checkpoints (one batch update)
+WINDOW_SIZE = 100
+
+MAX_WORKERS = 5
+MAX_ATTEMPTS = 3
+BATCH_TIMEOUT = 60
+
+DEFAULT_CHECKPOINT_PATH = 'batch_categorize_checkpoint.json'
+
+BATCH_INSTRUCTIONS = """Instructions: For EACH ticket below carefully select ONLY ONE category from the list above.
+Return a JSON object mapping every ticket id to the keyword found in the brackets next to the category name, e.g. {"categories": {"123": "payment"}}."""
+
+
+def build_batch_prompt(tickets: List[Dict[str, Any]]) -> str:
+    parts = [OBJECTIVE, CATEGORIES, BATCH_INSTRUCTIONS]
+    for ticket in tickets:
+        properties = ticket['properties']
+        description, _ = prepare_description(properties.get('content'), MAX_DESCRIPTION_TOKENS)
+        parts.append(f"Ticket {ticket['id']}:\nName: {properties.get('subject') or ''}\nDescription: {description}")
+    return '\n\n'.join(parts)
+
+
+def request_batch_categories(tickets: List[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Categorizes a pack of tickets with one chat completion.
+
+    :return: Dictionary of ticket id -> raw category answer (may be missing or invalid for some ids).
+    """
+    url = f'{OPENAI_BASE_URL}/chat/completions'
+    headers = {'Authorization': f'Bearer {secret_value}'}
+    params = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": build_batch_prompt(tickets)}],
+        "response_format": {"type": "json_object"},
+        "temperature": 0
+    }
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = get_breaker('api.openai.com').call(requests.post, url, headers=headers, json=params, timeout=BATCH_TIMEOUT, is_failure=is_server_error)
+        except requests.exceptions.RequestException as e:
+            print(f"Batch request failed: {e}")
+        else:
+            if response.status_code == 200:
+                try:
+                    content = response.json()['choices'][0]['message']['content']
+                    return {str(ticket_id): category for ticket_id, category in json.loads(content).get('categories', {}).items()}
+                except (KeyError, IndexError, ValueError, AttributeError) as e:
+                    print(f"Unparseable batch answer: {e}")
+                    return {}
+            print(f"Batch request failed with status code {response.status_code}: {response.text}")
+            if response.status_code not in (429, 500, 502, 503, 504):
+                return {}
+        time.sleep(backoff_delay(attempt))
+    return {}
+
+
+def categorize_pack(tickets: List[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Categorizes a pack of tickets; only tickets the local classifier is unsure about go to OpenAI,
+    and tickets the batch answer missed fall back to the single-ticket prompt.
+
+    :return: Dictionary of ticket id -> category keyword ('' when no valid category was returned).
+    """
+    categories = {}
+    for ticket in tickets:
+        properties = ticket['properties']
+        category = classify_locally(properties.get('subject') or '', properties.get('content') or '')
+        if category:
+            categories[ticket['id']] = category
+    tickets = [ticket for ticket in tickets if ticket['id'] not in categories]
+
+    answers = request_batch_categories(tickets) if tickets else {}
+    for ticket in tickets:
+        category = parse_category(answers.get(ticket['id'], ''))
+        if not category:
+            properties = ticket['properties']
+            output = call_openai_api(properties.get('subject') or '', properties.get('content') or '')
+            category = parse_category(output['prompt_output'])
+        categories[ticket['id']] = category
+    return categories
+
+
+def update_ticket_categories(session, categories: Dict[str, str]) -> List[str]:
+    """
+    Writes the categories with batch updates.
+
+    :return: Ids of the tickets a 207 response reported as not updated.
+    """
+    update_url = '/crm/v3/objects/tickets/batch/update'
+    failed = []
+    for batch in chunks(list(categories.items())):
+        payload = {"inputs": [{"id": ticket_id, "properties": {CATEGORY_PROPERTY: category}} for ticket_id, category in batch]}
+        response = session.post(update_url, json=payload)
+        if response.status_code == 207:
+            errors = batch_errors(response.json(), [ticket_id for ticket_id, _ in batch])
+            for ticket_id, error in errors.items():
+                print(f"Ticket {ticket_id} was not updated: {error}")
+            failed.extend(errors)
+        elif response.status_code != 200:
+            raise Exception(f"Error updating ticket categories: {response.text}")
+    return failed
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"last_id": 0, "categorized": 0, "failed": []}
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def windows(items: Iterable[Any], size: int) -> Iterable[List[Any]]:
+    iterator = iter(items)
+    while True:
+        window = list(islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def categorize_all_tickets(checkpoint_path: str = DEFAULT_CHECKPOINT_PATH, only_missing: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Categorizes every ticket (or only tickets without a category) and writes the categories back.
+
+    :param checkpoint_path: JSON file recording progress; an existing file resumes the run.
+    :param only_missing: Skip tickets that already have a category.
+    :param dry_run: Classify and count, but neither write categories nor checkpoint.
+    :return: Summary with the number of categorized tickets, ids without a valid or written category and counts per category.
+    """
+    session = get_session(hubspot_token)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint["last_id"]:
+        print(f"Resuming after ticket {checkpoint['last_id']}.")
+
+    filters = [{"propertyName": CATEGORY_PROPERTY, "operator": "NOT_HAS_PROPERTY"}] if only_missing else []
+    tickets = search_all(session, "tickets", filters=filters, properties=TICKET_PROPERTIES, after_id=checkpoint["last_id"])
+    counts: Dict[str, int] = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for window in windows(tickets, WINDOW_SIZE):
+            categories = {}
+            for pack_categories in executor.map(categorize_pack, chunks(window, TICKETS_PER_REQUEST)):
+                categories.update(pack_categories)
+
+            failed = [ticket_id for ticket_id, category in categories.items() if not category]
+            categorized = {ticket_id: category for ticket_id, category in categories.items() if category}
+            if not dry_run:
+                # Tickets the update rejected are recorded as failed, since last_id moves past them
+                for ticket_id in update_ticket_categories(session, categorized):
+                    categorized.pop(ticket_id, None)
+                    failed.append(ticket_id)
+            for category in categorized.values():
+                counts[category] = counts.get(category, 0) + 1
+
+            checkpoint["last_id"] = int(window[-1]['id'])
+            checkpoint["categorized"] += len(categorized)
+            checkpoint["failed"].extend(failed)
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+            print(f"Categorized {checkpoint['categorized']} tickets up to id {checkpoint['last_id']} ({len(checkpoint['failed'])} without a category).")
+
+    return {"categorized": checkpoint["categorized"], "failed": checkpoint["failed"], "counts": counts}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Categorize existing tickets in bulk.")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH, help="progress file; an existing one resumes the run")
+    parser.add_argument("--only-missing", action="store_true", help="only categorize tickets without a category")
+    parser.add_argument("--dry-run", action="store_true", help="classify and count without writing categories")
+    args = parser.parse_args()
+    print(json.dumps(categorize_all_tickets(args.checkpoint, only_missing=args.only_missing, dry_run=args.dry_run), indent=2))
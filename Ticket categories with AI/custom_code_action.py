@@ -1,7 +1,21 @@
+import argparse
+import hashlib
 import os
+import re
 import requests
 import logging
-from typing import Dict, Any
+import deadline
+import llm_jobs
+from circuit_breaker import get_breaker, is_server_error
+from hubspot_client import get_session
+from prompt_budget import count_tokens, label_constraints, prepare_description
+from ttl_cache import TTLCache
+try:
+    from local_classifier import DEFAULT_MODEL_PATH, load_classifier, ticket_text
+except ImportError:
+    # NumPy is not available in every runtime; everything then goes to OpenAI
+    load_classifier = None
+from typing import Dict, Any, List
 
 isError = ''
 log_buffer = []
@@ -26,64 +40,198 @@ CATEGORIES = """Categories:
 5. Order status (order_status)
 """
 
-INSTRUCTIONS = """Instructions: Carefully select ONLY ONE category from the list above and return ONLY the keyword found in the square brackets next to the category name."""
+# Ticket property set by step 3 of the workflow (and by the queue worker and batch_categorize.py)
+CATEGORY_PROPERTY = 'hs_ticket_category'
 
-def call_openai_api(ticket_name: str, ticket_description: str) -> str:
-    url = 'https://api.openai.com/v1/chat/completions'
+# With LLM_QUEUE_MODE=1 the action only queues the ticket and returns at once;
+# `python custom_code_action.py` runs the worker that writes the category to the ticket.
+QUEUE_MODE = os.getenv('LLM_QUEUE_MODE', '') == '1'
+JOB_KIND = 'ticket_category'
+
+# Keywords the model may answer with, in the order of CATEGORIES
+CATEGORY_KEYWORDS = re.findall(r'\((\w+)\)', CATEGORIES)
+
+# The single-ticket prompt asks for the category's number: one token per category, unlike the keywords
+CATEGORY_BY_LABEL = dict(re.findall(r'^(\d+)\..*\((\w+)\)\s*$', CATEGORIES, re.MULTILINE))
+
+# Points at https://api.openai.com/v1 unless a compatible server (e.g. openai_stub.py) is used
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+
+# Upper bound for one completion; the event deadline may cut it shorter
+OPENAI_TIMEOUT = 15
+
+OBJECTIVE = """Objective: Your task is to categorize each customer support ticket based on the description provided by the customer. Tickets may come in various languages.
+Our company provides services in XYZ. Mind that in case technical vocabulary is used."""
+
+INSTRUCTIONS = """Instructions: Carefully select ONLY ONE category from the list above and return ONLY its number."""
+
+# Only the newest message of a ticket is sent, cut to this many tokens
+MAX_DESCRIPTION_TOKENS = 400
+MAX_NAME_TOKENS = 50
+
+MODEL = "gpt-3.5-turbo"
+
+# Part of the cache key: bump it whenever the prompt, CATEGORIES or MODEL change,
+# so answers given for the old prompt are not reused
+PROMPT_VERSION = 3
+
+# Auto-generated tickets (payment reminders, order-status forms) repeat the same text
+# over and over, so answers are cached per normalized ticket text.
+CATEGORY_CACHE_TTL = 7 * 24 * 3600
+CATEGORY_CACHE_SIZE = 10000
+category_cache = TTLCache(CATEGORY_CACHE_TTL, path=os.getenv('CATEGORY_CACHE_PATH'), max_entries=CATEGORY_CACHE_SIZE)
+
+# Local pre-classifier (see local_classifier.py); OpenAI is only asked when it is less sure than this
+LOCAL_CONFIDENCE_THRESHOLD = 0.9
+pre_classifier = load_classifier(os.getenv('LOCAL_MODEL_PATH', DEFAULT_MODEL_PATH)) if load_classifier else None
+
+def normalize_ticket_text(text: str) -> str:
+    # Case, whitespace and numbers (invoice numbers, amounts, dates) do not change the category
+    text = re.sub(r'\d+', '0', (text or '').lower())
+    return ' '.join(text.split())
+
+def category_cache_key(ticket_name: str, ticket_description: str) -> str:
+    text = f"{PROMPT_VERSION}\n{normalize_ticket_text(ticket_name)}\n{normalize_ticket_text(ticket_description)}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Longest first, so a keyword is never shadowed by a shorter one it starts with
+CATEGORY_PATTERN = re.compile(r'(?<![a-z])(' + '|'.join(sorted(CATEGORY_KEYWORDS, key=len, reverse=True)) + ')')
+
+def parse_category(output: str) -> str:
+    # Returns the first category keyword in the model output, or '' if there is none
+    match = CATEGORY_PATTERN.search((output or '').lower())
+    return match.group(1) if match else ''
+
+def parse_label(output: str) -> str:
+    # Returns the category of a numbered answer (or of a keyword answer), or '' if there is none
+    return CATEGORY_BY_LABEL.get((output or '').strip().rstrip('.'), '') or parse_category(output)
+
+def classify_locally(ticket_name: str, ticket_description: str) -> str:
+    # Returns the local classifier's category when it is confident enough, otherwise ''
+    if pre_classifier is None:
+        return ''
+    category, confidence = pre_classifier.predict(ticket_text(ticket_name, ticket_description))
+    if confidence < LOCAL_CONFIDENCE_THRESHOLD or category not in CATEGORY_KEYWORDS:
+        return ''
+    custom_log(f"Local classifier: {category} ({confidence:.2f})")
+    return category
+
+def call_openai_api(ticket_name: str, ticket_description: str) -> Dict[str, Any]:
+    # Quoted history, HTML and signatures neither help the category nor belong in the cache key
+    ticket_name, _ = prepare_description(ticket_name, MAX_NAME_TOKENS)
+    ticket_description, description_tokens = prepare_description(ticket_description, MAX_DESCRIPTION_TOKENS)
+    custom_log(f"Description cut to {description_tokens} tokens")
+
+    category = classify_locally(ticket_name, ticket_description)
+    if category:
+        return {'prompt_output': category, 'isError': 'No', 'input_tokens': 0, 'output_tokens': 0}
+
+    # Identical tickets arriving at the same time share one upstream call; errors are not cached
+    requested = []
+    def request():
+        requested.append(True)
+        return request_category(ticket_name, ticket_description)
+    output = category_cache.get_or_set(
+        category_cache_key(ticket_name, ticket_description),
+        request,
+        should_cache=lambda output: output['isError'] == 'No'
+    )
+    if not requested:
+        # Answered from the cache: no tokens spent for this ticket
+        output = {**output, 'input_tokens': 0, 'output_tokens': 0}
+    return output
+
+def build_messages(ticket_name: str, ticket_description: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": f"{OBJECTIVE}\n\n{CATEGORIES}\n{INSTRUCTIONS}"},
+        {"role": "user", "content": f"Ticket name:\n{ticket_name}\n\nTicket description:\n{ticket_description}"}
+    ]
+
+def request_category(ticket_name: str, ticket_description: str) -> Dict[str, Any]:
+    url = f'{OPENAI_BASE_URL}/chat/completions'
     headers = {'Authorization': f'Bearer {secret_value}'}
+    messages = build_messages(ticket_name, ticket_description)
     params = {
-        "model": "gpt-3.5-turbo",
-        "messages": [{
-            "role": "user",
-            "content": f"""Objective: Your task is to categorize each customer support ticket based on the description provided by the customer. Tickets may come in various languages.
-            	Our company provides services in XYZ. Mind that in case technical vocabulary is used.
-                
-                {CATEGORIES}
-                {INSTRUCTIONS}
-                
-                Ticket name:
-                {ticket_name}
-                
-                Ticket description:
-                {ticket_description}
-                
-                Output:
-                """,
-        }],
-        "max_tokens": 256,
-        "temperature": 0.7
+        "model": MODEL,
+        "messages": messages,
+        # The answer is a single category number token: no sampling, and no room for anything else
+        "temperature": 0,
+        **label_constraints(list(CATEGORY_BY_LABEL))
     }
+    # Estimate used for the error outputs, where OpenAI reports no usage
+    input_tokens = sum(count_tokens(message["content"]) for message in messages)
     
-    response = requests.post(url, headers=headers, json=params)
+    # Not hedged: a losing completion cannot be cancelled and would be paid for as well.
+    # Skip straight to the error output while OpenAI is failing
+    try:
+        response = get_breaker('api.openai.com').call(requests.post, url, headers=headers, json=params, timeout=deadline.timeout(OPENAI_TIMEOUT), is_failure=is_server_error)
+    except requests.exceptions.RequestException as e:
+        custom_log(f"API call failed: {e}", "ERROR")
+
+        return {
+          'prompt_output':'',
+          'isError':'Yes',
+          'input_tokens': 0,
+          'output_tokens': 0
+        }
     
     if response.status_code != 200:
         custom_log(f"API call failed with status code {response.status_code}", "ERROR")
 
         return {
           'prompt_output':'',
-          'isError':'Yes'
+          'isError':'Yes',
+          'input_tokens': input_tokens,
+          'output_tokens': 0
         }
     
+    data = response.json()
+    usage = data.get('usage', {})
+    answer = data['choices'][0]['message']['content']
+    category = parse_label(answer)
+    if not category:
+        custom_log(f"Answer is not one of the categories: {answer!r}", "ERROR")
+
     return {
-      'prompt_output': response.json()['choices'][0]['message']['content'].strip(),
-      'isError':'No'
+      'prompt_output': category,
+      'isError': 'No' if category else 'Yes',
+      'input_tokens': usage.get('prompt_tokens', input_tokens),
+      'output_tokens': usage.get('completion_tokens', 0)
     }
   
 
+def category_job(payload: Dict[str, str]) -> Dict[str, str]:
+    # Worker handler: ticket inputs -> ticket properties; errors are retried by the queue
+    output = call_openai_api(payload['ticket_name'], payload['ticket_description'])
+    if output['isError'] == 'Yes':
+        raise Exception(f"No category for ticket: {output['prompt_output']!r}")
+    return {CATEGORY_PROPERTY: output['prompt_output']}
+
 def custom_log(msg, level="INFO"):
     log_message = f"{level}: {msg}"
     log_buffer.append(log_message)
     logging.getLogger().log(logging._nameToLevel[level], msg)
 
+@deadline.with_deadline(category_output='', isError='Yes')
 def main(event: Dict[str, Any]) -> Dict[str, Any]:
     ticket_description = event["inputFields"]["ticket_description"]
     ticket_name = event["inputFields"]["ticket_name"]
     
+    if QUEUE_MODE:
+        llm_jobs.enqueue(JOB_KIND, event["object"]["objectId"], {"ticket_name": ticket_name, "ticket_description": ticket_description})
+        return {
+            "outputFields": {
+                "category_output": '',
+                "isError": 'No',
+                "status": 'queued'
+            }
+        }
+
     api_output = call_openai_api(ticket_name, ticket_description)
     print(api_output)
     prompt_output = api_output['prompt_output']
     isError = api_output['isError']
-    custom_log(f"API output: {prompt_output}")
+    custom_log(f"API output: {prompt_output} ({api_output['input_tokens']} input / {api_output['output_tokens']} output tokens)")
     
     # Get the logs as a string
     log_contents = "\n".join(log_buffer)
@@ -92,6 +240,16 @@ def main(event: Dict[str, Any]) -> Dict[str, Any]:
         "outputFields": {
             "category_output": prompt_output,
             "isError": isError,
+            "input_tokens": api_output['input_tokens'],
+            "output_tokens": api_output['output_tokens'],
             "log_contents": log_contents
         }
     }
+
+
+if __name__ == "__main__":
+    # Worker for the tickets queued in LLM_QUEUE_MODE
+    parser = argparse.ArgumentParser(description="Categorize queued tickets and write the categories to the tickets.")
+    llm_jobs.add_worker_arguments(parser)
+    args = parser.parse_args()
+    llm_jobs.run_worker_command(args, JOB_KIND, category_job, get_session(os.getenv('HubSpot')), "tickets")
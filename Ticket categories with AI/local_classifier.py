@@ -0,0 +1,250 @@
+# Local TF-IDF + softmax regression classifier in front of the LLM ticket categorizer.
+# Trained on tickets that already have a category (i.e. on the LLM's own labels), it answers
+# in well under a millisecond; the action only calls OpenAI when the model is not confident.
+# Pure NumPy: documents are kept as sparse (row, column, value) triplets, so training on the
+# whole ticket base does not need a dense document x term matrix.
+#
+# Usage:
+#   python local_classifier.py train [--from-file tickets.jsonl] [--model PATH]
+#   python local_classifier.py benchmark [--from-file tickets.jsonl] [--threshold 0.9]
+# Without --from-file the categorized tickets are read from HubSpot. A file has one JSON
+# object per line with "subject", "content" and "category".
+# Retrain after changing CATEGORIES, otherwise the model keeps answering with the old ones, and
+# after changing the text preparation in prompt_budget.py, which training and serving share.
+
+import argparse
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+from prompt_budget import prepare_description
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_classifier.npz')
+
+# HubSpot private app token with tickets read scope (only needed to train from HubSpot)
+hubspot_token = os.getenv('HubSpot', None)
+
+# Ticket property holding the category (the one batch_categorize.py and the workflow set)
+CATEGORY_PROPERTY = 'hs_ticket_category'
+
+# Tickets are cleaned and cut like the single-ticket prompt (see ticket_text)
+MAX_NAME_TOKENS = 50
+MAX_DESCRIPTION_TOKENS = 400
+
+MAX_FEATURES = 20000
+MIN_DF = 2
+L2 = 1e-4
+LEARNING_RATE = 20.0
+EPOCHS = 300
+
+# Share of labelled tickets held out by the benchmark
+TEST_SHARE = 0.2
+
+
+def tokenize(text):
+    # Lowercased words with digits masked, plus word bigrams
+    words = re.findall(r'\w+', re.sub(r'\d+', '0', (text or '').lower()))
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class LocalClassifier:
+    """
+    TF-IDF features with a multinomial logistic regression on top.
+    """
+
+    def __init__(self, vocabulary, idf, weights, bias, labels):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.labels = labels
+
+    def _features(self, text):
+        counts = Counter(term for term in tokenize(text) if term in self.vocabulary)
+        columns = np.fromiter((self.vocabulary[term] for term in counts), dtype=np.int64, count=len(counts))
+        values = (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))) * self.idf[columns]
+        norm = np.linalg.norm(values)
+        return columns, values / norm if norm else values
+
+    def predict(self, text):
+        """
+        Returns (category, confidence) for a ticket text; confidence is the softmax probability.
+        """
+        columns, values = self._features(text)
+        logits = values @ self.weights[columns] + self.bias
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    def save(self, path):
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(path, terms=np.array(terms), idf=self.idf, weights=self.weights,
+                            bias=self.bias, labels=np.array(self.labels))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            vocabulary = {term: i for i, term in enumerate(data['terms'].tolist())}
+            return cls(vocabulary, data['idf'], data['weights'], data['bias'], data['labels'].tolist())
+
+
+def load_classifier(path=DEFAULT_MODEL_PATH):
+    """
+    Loads a trained model, or returns None if there is none at `path`.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    return LocalClassifier.load(path)
+
+
+def _sparse_matrix(documents, vocabulary, idf):
+    # Row-normalized TF-IDF values as (rows, columns, values) triplets
+    rows, columns, values = [], [], []
+    for row, terms in enumerate(documents):
+        counts = Counter(term for term in terms if term in vocabulary)
+        if not counts:
+            continue
+        doc_columns = [vocabulary[term] for term in counts]
+        doc_values = [(1.0 + math.log(count)) * idf[column] for count, column in zip(counts.values(), doc_columns)]
+        norm = math.sqrt(sum(value * value for value in doc_values))
+        rows.extend([row] * len(doc_columns))
+        columns.extend(doc_columns)
+        values.extend(value / norm for value in doc_values)
+    return np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64), np.array(values)
+
+
+def train(texts, categories, epochs=EPOCHS):
+    """
+    Fits a LocalClassifier on ticket texts and their categories.
+
+    :param texts: List of ticket texts (name and description).
+    :param categories: Category keyword of each text.
+    :return: The trained LocalClassifier.
+    """
+    documents = [tokenize(text) for text in texts]
+    document_frequency = Counter(term for terms in documents for term in set(terms))
+    terms = [term for term, df in document_frequency.most_common(MAX_FEATURES) if df >= MIN_DF]
+    vocabulary = {term: i for i, term in enumerate(terms)}
+    idf = np.log((1 + len(documents)) / (1 + np.array([document_frequency[term] for term in terms], dtype=np.float64))) + 1.0
+
+    labels = sorted(set(categories))
+    label_index = {label: i for i, label in enumerate(labels)}
+    targets = np.zeros((len(documents), len(labels)))
+    targets[np.arange(len(documents)), [label_index[category] for category in categories]] = 1.0
+
+    rows, columns, values = _sparse_matrix(documents, vocabulary, idf)
+    weights = np.zeros((len(terms), len(labels)))
+    bias = np.log(targets.mean(axis=0) + 1e-9)
+
+    # Full-batch gradient descent on the mean cross-entropy; per-class bincounts stand in
+    # for the sparse matrix products
+    for _ in range(epochs):
+        logits = np.column_stack([
+            np.bincount(rows, weights=values * weights[columns, k], minlength=len(documents)) for k in range(len(labels))
+        ]) + bias
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        errors = (probabilities - targets) / len(documents)
+        gradient = np.column_stack([
+            np.bincount(columns, weights=values * errors[rows, k], minlength=len(terms)) for k in range(len(labels))
+        ]) + L2 * weights
+        weights -= LEARNING_RATE * gradient
+        bias -= LEARNING_RATE * errors.sum(axis=0)
+
+    return LocalClassifier(vocabulary, idf, weights, bias, labels)
+
+
+def ticket_text(subject, content):
+    # The text the model sees, for training and prediction alike: HTML, quoted history and
+    # signatures stripped, cut to the same token budgets as the single-ticket prompt
+    subject, _ = prepare_description(subject, MAX_NAME_TOKENS)
+    content, _ = prepare_description(content, MAX_DESCRIPTION_TOKENS)
+    return f"{subject}\n{content}"
+
+
+def fetch_labelled_tickets():
+    """
+    Reads every ticket that has a category from HubSpot.
+
+    :return: List of (text, category) pairs.
+    """
+    from hubspot_client import get_session, search_all
+
+    tickets = search_all(get_session(hubspot_token), "tickets",
+                         filters=[{"propertyName": CATEGORY_PROPERTY, "operator": "HAS_PROPERTY"}],
+                         properties=['subject', 'content', CATEGORY_PROPERTY])
+    return [(ticket_text(t['properties'].get('subject'), t['properties'].get('content')), t['properties'][CATEGORY_PROPERTY])
+            for t in tickets]
+
+
+def read_labelled_file(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [(ticket_text(record.get('subject'), record.get('content')), record['category']) for record in records]
+
+
+def benchmark(examples, threshold, seed=0):
+    """
+    Trains on part of the labelled tickets and measures the rest against the (LLM) labels.
+
+    :param examples: List of (text, category) pairs.
+    :param threshold: Confidence above which the local answer would be used.
+    :return: Accuracy overall and above the threshold, the share of tickets answered locally
+        and the prediction latency percentiles.
+    """
+    order = np.random.default_rng(seed).permutation(len(examples))
+    split = int(len(examples) * (1 - TEST_SHARE))
+    train_set = [examples[i] for i in order[:split]]
+    test_set = [examples[i] for i in order[split:]]
+
+    started = time.perf_counter()
+    classifier = train([text for text, _ in train_set], [category for _, category in train_set])
+    training_seconds = time.perf_counter() - started
+
+    correct, confident, confident_correct, latencies = 0, 0, 0, []
+    for text, category in test_set:
+        started = time.perf_counter()
+        predicted, confidence = classifier.predict(text)
+        latencies.append(time.perf_counter() - started)
+        correct += predicted == category
+        if confidence >= threshold:
+            confident += 1
+            confident_correct += predicted == category
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "train_tickets": len(train_set),
+        "test_tickets": len(test_set),
+        "training_seconds": round(training_seconds, 2),
+        "accuracy": round(correct / len(test_set), 4),
+        "threshold": threshold,
+        "local_share": round(confident / len(test_set), 4),
+        "local_accuracy": round(confident_correct / confident, 4) if confident else None,
+        "latency_ms_p50": round(float(np.percentile(latencies_ms, 50)), 4),
+        "latency_ms_p99": round(float(np.percentile(latencies_ms, 99)), 4)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or benchmark the local ticket pre-classifier.")
+    parser.add_argument("command", choices=["train", "benchmark"])
+    parser.add_argument("--from-file", help="JSONL file with subject, content and category instead of reading HubSpot")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="where to write the trained model")
+    parser.add_argument("--threshold", type=float, default=0.9, help="confidence threshold to benchmark")
+    args = parser.parse_args()
+
+    examples = read_labelled_file(args.from_file) if args.from_file else fetch_labelled_tickets()
+    print(f"Loaded {len(examples)} categorized tickets.")
+    if args.command == "train":
+        classifier = train([text for text, _ in examples], [category for _, category in examples])
+        classifier.save(args.model)
+        print(f"Saved model with {len(classifier.vocabulary)} terms and labels {classifier.labels} to {args.model}.")
+    else:
+        print(json.dumps(benchmark(examples, args.threshold), indent=2))
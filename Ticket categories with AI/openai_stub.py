@@ -0,0 +1,76 @@
+# Minimal OpenAI-compatible chat completions server for trying the categorizer locally.
+# Answers with keyword rules instead of a model: the category's number for single-ticket prompts
+# and {"categories": {...}} with keywords for batch prompts sent with response_format json_object.
+#
+# Usage:
+#   python openai_stub.py --port 8000
+#   OPENAI_BASE_URL=http://localhost:8000/v1 python batch_categorize.py --dry-run
+
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# First matching rule wins; everything else is sales
+KEYWORD_RULES = [
+    ('payment', ('invoice', 'payment', 'installment', 'refund', 'pay')),
+    ('documentation', ('kyc', 'document', 'passport', 'identity', 'verification')),
+    ('technical', ('error', 'bug', 'crash', 'cannot', 'checkout', 'login')),
+    ('order_status', ('order', 'delivery', 'shipping', 'tracking', 'status')),
+]
+DEFAULT_CATEGORY = 'sales'
+
+# "1. Invoice, installment and payment (payment)" lines of the category list
+CATEGORY_LINE = re.compile(r'^(\d+)\..*\((\w+)\)\s*$', re.MULTILINE)
+
+TICKET_PATTERN = re.compile(r'^Ticket (\S+):\n(.*?)(?=^Ticket \S+:\n|\Z)', re.MULTILINE | re.DOTALL)
+
+
+def classify(text):
+    text = text.lower()
+    for category, keywords in KEYWORD_RULES:
+        if any(keyword in text for keyword in keywords):
+            return category
+    return DEFAULT_CATEGORY
+
+
+def complete(request):
+    prompt = request['messages'][-1]['content']
+    if request.get('response_format', {}).get('type') == 'json_object':
+        content = json.dumps({"categories": {ticket_id: classify(body) for ticket_id, body in TICKET_PATTERN.findall(prompt)}})
+    else:
+        # Only look at the ticket itself, not at the category list in the prompt
+        category = classify(prompt.split('Ticket name:', 1)[-1])
+        labels = {keyword: number for number, keyword in CATEGORY_LINE.findall(request['messages'][0]['content'])}
+        content = labels.get(category, category)
+    return {
+        "id": f"chatcmpl-stub-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get('model', 'stub'),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(content.split()), "total_tokens": len(prompt.split()) + len(content.split())}
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        body = json.dumps(complete(request)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a keyword-rule stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    print(f"OpenAI stub listening on http://localhost:{args.port}/v1")
+    ThreadingHTTPServer(('localhost', args.port), StubHandler).serve_forever()
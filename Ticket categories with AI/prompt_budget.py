@@ -0,0 +1,131 @@
+# Prompt preparation for the ticket categorizer: turns an email-style ticket description into
+# the few hundred tokens that actually carry the request, and constrains the model's answer
+# to a single category label token.
+# Token counts use tiktoken's cl100k_base (the gpt-3.5-turbo encoding) when it is installed,
+# otherwise a close approximation (~4 characters per token), which is enough for budgeting.
+
+import html
+import math
+import re
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _encoding = None
+
+# Logit bias that makes the model pick from the allowed tokens only
+LABEL_BIAS = 100
+
+# Where a reply stops and the quoted history (or the signature) begins
+QUOTE_MARKERS = re.compile(
+    r'^\s*(?:'
+    r'On\s.{0,200}?wrote:'                                          # Gmail / Apple Mail
+    r'|Am\s.{0,200}?schrieb.{0,100}?:'                              # German clients
+    r'|-{2,}\s*(?:Original Message|Ursprüngliche Nachricht)\s*-{2,}'
+    r'|(?:From|Von):\s.*\n(?:.*\n){0,3}?\s*(?:Sent|Date|Gesendet|Datum):'  # Outlook header block
+    r'|--\s*$'                                                      # signature separator
+    r')',
+    re.IGNORECASE | re.MULTILINE
+)
+
+HTML_DROP = re.compile(r'<(head|style|script|blockquote)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+HTML_BREAKS = re.compile(r'<\s*(?:br|/p|/div|/li|/tr|/h\d)\b[^>]*>', re.IGNORECASE)
+HTML_TAGS = re.compile(r'<[^>]+>')
+
+_APPROXIMATE_TOKENS = re.compile(r'\w+|[^\w\s]')
+
+
+def strip_html(text):
+    """
+    Converts an HTML email body to plain text; quoted history in <blockquote> is dropped.
+    """
+    if not re.search(r'<[a-zA-Z/!]', text):
+        return text
+    text = HTML_DROP.sub(' ', text)
+    text = HTML_BREAKS.sub('\n', text)
+    return html.unescape(HTML_TAGS.sub(' ', text))
+
+
+def strip_quoted_replies(text):
+    """
+    Keeps only the newest message of an email thread: drops '>' quoted lines and everything
+    after the first reply header or signature separator.
+    """
+    match = QUOTE_MARKERS.search(text)
+    # A ticket that starts with a forwarded message has nothing before the marker; keep it whole
+    if match and text[:match.start()].strip():
+        text = text[:match.start()]
+    return '\n'.join(line for line in text.splitlines() if not line.lstrip().startswith('>'))
+
+
+def clean_ticket_text(text):
+    """
+    Strips HTML, quoted history and signatures and collapses whitespace.
+    """
+    text = strip_quoted_replies(strip_html(text or ''))
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def _approximate_pieces(text):
+    # (end offset, tokens) for each word or punctuation mark
+    for match in _APPROXIMATE_TOKENS.finditer(text):
+        yield match.end(), max(1, math.ceil(len(match.group()) / 4))
+
+
+def count_tokens(text):
+    """
+    Returns the number of tokens `text` takes in the prompt.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return sum(tokens for _, tokens in _approximate_pieces(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts `text` to at most `max_tokens` tokens.
+
+    :return: Tuple of (truncated text, its token count).
+    """
+    if _encoding is not None:
+        tokens = _encoding.encode(text)[:max_tokens]
+        return _encoding.decode(tokens), len(tokens)
+
+    used, end = 0, 0
+    for piece_end, tokens in _approximate_pieces(text):
+        if used + tokens > max_tokens:
+            return text[:end], used
+        used, end = used + tokens, piece_end
+    return text, used
+
+
+def prepare_description(text, max_tokens):
+    """
+    Cleans a ticket description and truncates it to the token budget.
+
+    :return: Tuple of (prepared text, its token count).
+    """
+    return truncate_to_tokens(clean_ticket_text(text), max_tokens)
+
+
+def label_constraints(labels):
+    """
+    Completion parameters that restrict the answer to exactly one of `labels`.
+
+    Every label must be a single, distinct token (e.g. the category numbers "1".."9"), so the
+    answer is one token long. With tiktoken those tokens get a strong logit bias; without it
+    only max_tokens is limited and the answer is validated.
+
+    :raises ValueError: If a label is not one token or two labels share a token.
+    """
+    if _encoding is None:
+        return {"max_tokens": 1}
+    encoded = [_encoding.encode(label) for label in labels]
+    if any(len(tokens) != 1 for tokens in encoded) or len({tokens[0] for tokens in encoded}) != len(labels):
+        raise ValueError(f"Category labels must be single, distinct tokens: {labels}")
+    return {
+        "max_tokens": 1,
+        "logit_bias": {str(tokens[0]): LABEL_BIAS for tokens in encoded}
+    }
@@ -0,0 +1,261 @@
+# Per-market business-hours calendar with public holidays.
+# Each market's working intervals (working hours from market_time on non-holiday weekdays)
+# are precompiled into sorted tables of UTC start/end instants, so "is this instant working
+# time?" and "when does the next working slot start?" are binary searches -- for single
+# events with bisect, for batches with numpy.searchsorted.
+
+import time
+from bisect import bisect_right
+from datetime import date, datetime, timedelta, timezone
+
+from market_time import WEEKEND_DAYS, WORK_END_HOUR, WORK_START_HOUR, get_timezone
+
+# Holiday rules:
+#   ("fixed", month, day)                        same date every year
+#   ("easter", offset)                           days relative to Easter Sunday
+#   ("nth_weekday", month, weekday, n)           n-th weekday (0=Monday) of the month, n=-1 for the last
+#   ("weekday_from", month, day, weekday)        first weekday on or after the given date
+# Regional holidays and substitute days for holidays falling on a weekend are not included.
+GOOD_FRIDAY = ("easter", -2)
+EASTER_MONDAY = ("easter", 1)
+ASCENSION = ("easter", 39)
+WHIT_MONDAY = ("easter", 50)
+CORPUS_CHRISTI = ("easter", 60)
+NEW_YEAR = ("fixed", 1, 1)
+EPIPHANY = ("fixed", 1, 6)
+LABOUR_DAY = ("fixed", 5, 1)
+ASSUMPTION = ("fixed", 8, 15)
+ALL_SAINTS = ("fixed", 11, 1)
+CHRISTMAS_EVE = ("fixed", 12, 24)
+CHRISTMAS = ("fixed", 12, 25)
+BOXING_DAY = ("fixed", 12, 26)
+MIDSUMMER_EVE = ("weekday_from", 6, 19, 4)
+
+UK_HOLIDAYS = [
+    NEW_YEAR, GOOD_FRIDAY, EASTER_MONDAY, ("nth_weekday", 5, 0, 1), ("nth_weekday", 5, 0, -1),
+    ("nth_weekday", 8, 0, -1), CHRISTMAS, BOXING_DAY
+]
+DACH_HOLIDAYS = [NEW_YEAR, GOOD_FRIDAY, EASTER_MONDAY, LABOUR_DAY, ASCENSION, WHIT_MONDAY, ("fixed", 10, 3), CHRISTMAS, BOXING_DAY]
+SWEDEN_HOLIDAYS = [
+    NEW_YEAR, EPIPHANY, GOOD_FRIDAY, EASTER_MONDAY, LABOUR_DAY, ASCENSION, ("fixed", 6, 6),
+    MIDSUMMER_EVE, CHRISTMAS_EVE, CHRISTMAS, BOXING_DAY, ("fixed", 12, 31)
+]
+
+MARKET_HOLIDAYS = {
+    "gb": UK_HOLIDAYS,
+    "uk": UK_HOLIDAYS,
+    "ie": [
+        NEW_YEAR, ("nth_weekday", 2, 0, 1), ("fixed", 3, 17), EASTER_MONDAY, ("nth_weekday", 5, 0, 1),
+        ("nth_weekday", 6, 0, 1), ("nth_weekday", 8, 0, 1), ("nth_weekday", 10, 0, -1), CHRISTMAS, BOXING_DAY
+    ],
+    "pt": [
+        NEW_YEAR, GOOD_FRIDAY, ("fixed", 4, 25), LABOUR_DAY, CORPUS_CHRISTI, ("fixed", 6, 10), ASSUMPTION,
+        ("fixed", 10, 5), ALL_SAINTS, ("fixed", 12, 1), ("fixed", 12, 8), CHRISTMAS
+    ],
+    "es": [
+        NEW_YEAR, EPIPHANY, GOOD_FRIDAY, LABOUR_DAY, ASSUMPTION, ("fixed", 10, 12), ALL_SAINTS,
+        ("fixed", 12, 6), ("fixed", 12, 8), CHRISTMAS
+    ],
+    "fr": [
+        NEW_YEAR, EASTER_MONDAY, LABOUR_DAY, ("fixed", 5, 8), ASCENSION, WHIT_MONDAY, ("fixed", 7, 14),
+        ASSUMPTION, ALL_SAINTS, ("fixed", 11, 11), CHRISTMAS
+    ],
+    "be": [
+        NEW_YEAR, EASTER_MONDAY, LABOUR_DAY, ASCENSION, WHIT_MONDAY, ("fixed", 7, 21), ASSUMPTION,
+        ALL_SAINTS, ("fixed", 11, 11), CHRISTMAS
+    ],
+    "nl": [NEW_YEAR, EASTER_MONDAY, ("fixed", 4, 27), ASCENSION, WHIT_MONDAY, CHRISTMAS, BOXING_DAY],
+    "lu": [
+        NEW_YEAR, EASTER_MONDAY, LABOUR_DAY, ("fixed", 5, 9), ASCENSION, WHIT_MONDAY, ("fixed", 6, 23),
+        ASSUMPTION, ALL_SAINTS, CHRISTMAS, BOXING_DAY
+    ],
+    "it": [
+        NEW_YEAR, EPIPHANY, EASTER_MONDAY, ("fixed", 4, 25), LABOUR_DAY, ("fixed", 6, 2), ASSUMPTION,
+        ALL_SAINTS, ("fixed", 12, 8), CHRISTMAS, BOXING_DAY
+    ],
+    "dach": DACH_HOLIDAYS,
+    "de": DACH_HOLIDAYS,
+    "at": [
+        NEW_YEAR, EPIPHANY, EASTER_MONDAY, LABOUR_DAY, ASCENSION, WHIT_MONDAY, CORPUS_CHRISTI, ASSUMPTION,
+        ("fixed", 10, 26), ALL_SAINTS, ("fixed", 12, 8), CHRISTMAS, BOXING_DAY
+    ],
+    "ch": [NEW_YEAR, GOOD_FRIDAY, EASTER_MONDAY, ASCENSION, WHIT_MONDAY, ("fixed", 8, 1), CHRISTMAS, BOXING_DAY],
+    "sca": SWEDEN_HOLIDAYS,
+    "se": SWEDEN_HOLIDAYS,
+    "dk": [
+        NEW_YEAR, ("easter", -3), GOOD_FRIDAY, EASTER_MONDAY, ASCENSION, WHIT_MONDAY, ("fixed", 6, 5),
+        CHRISTMAS_EVE, CHRISTMAS, BOXING_DAY
+    ],
+    "no": [
+        NEW_YEAR, ("easter", -3), GOOD_FRIDAY, EASTER_MONDAY, LABOUR_DAY, ("fixed", 5, 17), ASCENSION,
+        WHIT_MONDAY, CHRISTMAS, BOXING_DAY
+    ],
+    "fi": [
+        NEW_YEAR, EPIPHANY, GOOD_FRIDAY, EASTER_MONDAY, LABOUR_DAY, ASCENSION, MIDSUMMER_EVE,
+        ("fixed", 12, 6), CHRISTMAS_EVE, CHRISTMAS, BOXING_DAY
+    ],
+    "pl": [
+        NEW_YEAR, EPIPHANY, EASTER_MONDAY, LABOUR_DAY, ("fixed", 5, 3), CORPUS_CHRISTI, ASSUMPTION,
+        ALL_SAINTS, ("fixed", 11, 11), CHRISTMAS, BOXING_DAY
+    ],
+}
+
+# Markets without their own list only get the holidays observed almost everywhere
+DEFAULT_HOLIDAYS = [NEW_YEAR, EASTER_MONDAY, LABOUR_DAY, CHRISTMAS, BOXING_DAY]
+
+# Years compiled around the current year when no range is given
+YEARS_BEFORE = 5
+YEARS_AFTER = 2
+
+_WEEKEND_WEEKDAYS = {
+    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"].index(day)
+    for day in WEEKEND_DAYS
+}
+
+_calendars = {}
+
+
+def easter_sunday(year):
+    """
+    Returns the date of Easter Sunday (Gregorian calendar, anonymous algorithm).
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def holiday_dates(market, year):
+    """
+    Returns the set of public holiday dates of a market in a given year.
+    """
+    rules = MARKET_HOLIDAYS.get((market or "").strip().lower(), DEFAULT_HOLIDAYS)
+    easter = easter_sunday(year)
+    holidays = set()
+
+    for rule in rules:
+        kind = rule[0]
+        if kind == "fixed":
+            holidays.add(date(year, rule[1], rule[2]))
+        elif kind == "easter":
+            holidays.add(easter + timedelta(days=rule[1]))
+        elif kind == "nth_weekday":
+            _, month, weekday, n = rule
+            if n > 0:
+                first = date(year, month, 1)
+                holidays.add(first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1)))
+            else:
+                last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+                holidays.add(last - timedelta(days=(last.weekday() - weekday) % 7))
+        elif kind == "weekday_from":
+            _, month, day, weekday = rule
+            start = date(year, month, day)
+            holidays.add(start + timedelta(days=(weekday - start.weekday()) % 7))
+    return holidays
+
+
+class BusinessCalendar:
+    """
+    Working intervals of one market between two years, as sorted UTC epoch-second tables.
+    """
+
+    def __init__(self, market, first_year, last_year):
+        self.market = market
+        self.first_year = first_year
+        self.last_year = last_year
+        zone = get_timezone(market)
+
+        starts, ends = [], []
+        for year in range(first_year, last_year + 1):
+            holidays = holiday_dates(market, year)
+            day = date(year, 1, 1)
+            while day.year == year:
+                if day.weekday() not in _WEEKEND_WEEKDAYS and day not in holidays:
+                    start = datetime(day.year, day.month, day.day, WORK_START_HOUR, tzinfo=zone)
+                    end = datetime(day.year, day.month, day.day, WORK_END_HOUR, tzinfo=zone)
+                    starts.append(int(start.timestamp()))
+                    ends.append(int(end.timestamp()))
+                day += timedelta(days=1)
+
+        self.starts = starts
+        self.ends = ends
+
+    def covers(self, timestamp):
+        """
+        Whether a UTC epoch-second timestamp lies within the compiled years (with a day of margin).
+        """
+        return bool(self.starts) and self.starts[0] - 86400 * 7 <= timestamp < self.ends[-1]
+
+    def is_working_time(self, timestamp):
+        """
+        Whether a UTC epoch-second timestamp falls within working hours.
+        """
+        i = bisect_right(self.starts, timestamp) - 1
+        return i >= 0 and timestamp < self.ends[i]
+
+    def next_working_slot(self, timestamp):
+        """
+        Returns the timestamp itself if it is working time, otherwise the start of the next
+        working interval (None if it lies beyond the compiled years).
+        """
+        i = bisect_right(self.starts, timestamp)
+        if i > 0 and timestamp < self.ends[i - 1]:
+            return timestamp
+        return self.starts[i] if i < len(self.starts) else None
+
+    def is_working_time_batch(self, timestamps):
+        """
+        Vectorized is_working_time for an array of UTC epoch-second timestamps.
+        """
+        import numpy as np
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        starts, ends = np.asarray(self.starts, dtype=np.int64), np.asarray(self.ends, dtype=np.int64)
+        i = np.searchsorted(starts, timestamps, side="right") - 1
+        return (i >= 0) & (timestamps < ends[np.maximum(i, 0)])
+
+    def next_working_slot_batch(self, timestamps):
+        """
+        Vectorized next_working_slot; timestamps beyond the compiled years map to -1.
+        """
+        import numpy as np
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        starts = np.append(np.asarray(self.starts, dtype=np.int64), -1)
+        working = self.is_working_time_batch(timestamps)
+        i = np.searchsorted(starts[:-1], timestamps, side="right")
+        return np.where(working, timestamps, starts[i])
+
+
+def get_calendar(market, timestamp=None):
+    """
+    Returns a cached calendar of the market covering the given (or current) UTC epoch-second
+    timestamp, compiling a wider one if needed.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    key = (market or "").strip().lower()
+    calendar = _calendars.get(key)
+    if calendar is None or not calendar.covers(timestamp):
+        year = datetime.fromtimestamp(timestamp, timezone.utc).year
+        first_year, last_year = year - YEARS_BEFORE, year + YEARS_AFTER
+        if calendar is not None:
+            first_year, last_year = min(first_year, calendar.first_year), max(last_year, calendar.last_year)
+        calendar = _calendars[key] = BusinessCalendar(market, first_year, last_year)
+    return calendar
+
+
+def next_working_slot(market, timestamp=None):
+    """
+    Returns the next working slot of a market as a UTC epoch-second timestamp and the
+    delay until it in seconds (0 during working hours).
+    """
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    slot = get_calendar(market, timestamp).next_working_slot(timestamp)
+    return slot, slot - timestamp
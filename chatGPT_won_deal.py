@@ -1,31 +1,82 @@
+import argparse
 import os
 import requests
-import re
+import deadline
+import llm_jobs
+from circuit_breaker import get_breaker, is_server_error
+from hubspot_client import get_session
 
-def main(event): 
-  secret_value = os.environ['OpenAI_Kuba']  
+# Upper bound for one completion; the event deadline may cut it shorter
+OPENAI_TIMEOUT = 15
+
+# With LLM_QUEUE_MODE=1 the action only queues the deal and returns at once;
+# `python chatGPT_won_deal.py` runs the worker that writes the poem to the deal.
+QUEUE_MODE = os.getenv("LLM_QUEUE_MODE", "") == "1"
+JOB_KIND = "won_deal_poem"
+
+# Deal property the worker writes the poem to
+PROMPT_OUTPUT_PROPERTY = "prompt_output"
+
+def generate_poem(deal_name, deal_amount):
+  secret_value = os.environ['OpenAI_Kuba']
   url = 'https://api.openai.com/v1/completions'
-  
+
   headers = {'Authorization': f'Bearer {secret_value}'}
-  
-  deal_name = event["inputFields"]["dealname"]
-  deal_amount = event["inputFields"]["amount"]
-  
+
   params = {
     "model": "text-davinci-003",
     "prompt": f"Celebrate and congratulate a closed won deal in the form of a poem. Keep it two-three sentences. Make it in funny style, use a sitcom analogy. Deal name is exactly {deal_name} and deal amount is ${deal_amount}",
     "max_tokens": 256,
     "temperature": 0.7
   }
-  
-  response = requests.post(url, headers=headers, json=params)
-  prompt_output = response.json()['choices'][0]['text']
-  
+
+  response = get_breaker('api.openai.com').call(requests.post, url, headers=headers, json=params, timeout=deadline.timeout(OPENAI_TIMEOUT), is_failure=is_server_error)
+  # HTTPError is a RequestException, so main's fallback covers error responses too
+  response.raise_for_status()
+
   print(response.json())
-  
+  return response.json()['choices'][0]['text']
+
+def poem_job(payload):
+  # Worker handler: deal inputs -> deal properties
+  return {PROMPT_OUTPUT_PROPERTY: generate_poem(payload["dealname"], payload["amount"])}
+
+@deadline.with_deadline(prompt_output="")
+def main(event):
+  deal_name = event["inputFields"]["dealname"]
+  deal_amount = event["inputFields"]["amount"]
+
+  if QUEUE_MODE:
+    llm_jobs.enqueue(JOB_KIND, event["object"]["objectId"], {"dealname": deal_name, "amount": deal_amount})
+    return {
+      "outputFields": {
+        "prompt_output": "",
+        "status": "queued"
+      }
+    }
+
+  # Skip the call (empty poem) while OpenAI is failing
+  try:
+    prompt_output = generate_poem(deal_name, deal_amount)
+  except requests.exceptions.RequestException as e:
+    print(f"OpenAI call failed: {e}")
+    return {
+      "outputFields": {
+        "prompt_output": ""
+      }
+    }
+
   # Return the output data that can be used in later actions in your workflow.
   return {
     "outputFields": {
       "prompt_output": prompt_output
     }
   }
+
+
+if __name__ == "__main__":
+  # Worker for the deals queued in LLM_QUEUE_MODE
+  parser = argparse.ArgumentParser(description="Generate queued won-deal poems and write them to the deals.")
+  llm_jobs.add_worker_arguments(parser)
+  args = parser.parse_args()
+  llm_jobs.run_worker_command(args, JOB_KIND, poem_job, get_session(os.getenv('HubSpot')), "deals")
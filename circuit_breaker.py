@@ -0,0 +1,281 @@
+# Circuit breaker for flaky external dependencies (timeapi.io, OpenAI, HubSpot).
+# Tracks recent call outcomes per endpoint; once too many fail, the circuit opens and callers
+# skip straight to their fallback instead of waiting for timeouts. After a cool-down one probe
+# call is let through (half-open): success closes the circuit, failure opens it again.
+# The circuit state and the window's call/failure counts live in a small SQLite file, so they
+# survive across invocations and add up between processes. It is written on failures, on the
+# first success after one and on state changes; other successes are counted in memory until then.
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+
+from deadline import DeadlineExceeded
+
+STORE_PATH = os.getenv("CIRCUIT_BREAKER_DB", os.path.join(tempfile.gettempdir(), "circuit_breakers.db"))
+
+# Outcomes older than this are forgotten
+WINDOW_SECONDS = 60
+
+# The circuit opens when at least MIN_CALLS calls in the window failed at this rate or more
+MIN_CALLS = 5
+FAILURE_RATE_THRESHOLD = 0.5
+
+# How long an open circuit rejects calls before letting a probe through
+OPEN_SECONDS = 30
+
+# A probe that neither succeeded nor failed within this time is considered lost
+PROBE_TIMEOUT = 30
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# How often a process re-reads the shared state to notice transitions made by other processes
+SYNC_SECONDS = 1.0
+
+_lock = threading.Lock()
+_connections = {}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of calling an endpoint whose circuit is open.
+
+    Subclasses ConnectionError so existing `except requests.exceptions.RequestException`
+    handlers treat it like any other unreachable dependency.
+    """
+
+
+FIELDS = ("state", "opened_at", "probe_at", "window_start", "calls", "failures")
+
+
+def _connect(path):
+    # One connection per store file, reused by every breaker of the process (callers hold _lock)
+    connection = _connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        # The state is advisory, so trade durability for speed
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS circuit_breaker_states (name TEXT PRIMARY KEY, state TEXT NOT NULL, "
+            "opened_at REAL NOT NULL, probe_at REAL NOT NULL, window_start REAL NOT NULL, "
+            "calls INTEGER NOT NULL, failures INTEGER NOT NULL)"
+        )
+        _connections[path] = connection
+    return connection
+
+
+def _initial_state():
+    return {"state": CLOSED, "opened_at": 0, "probe_at": 0, "window_start": 0, "calls": 0, "failures": 0}
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one named endpoint, e.g. "timeapi.io" or "api.openai.com".
+
+    The circuit state and the call and failure counts of the current window are shared
+    through SQLite, so failures of separate invocations add up. The row is only written on
+    failures, on the first success after a failure (with the successes counted in memory
+    since the last write) and on state changes, so calls on a healthy circuit cost no writes.
+    """
+
+    def __init__(self, name, path=STORE_PATH, window=WINDOW_SECONDS, min_calls=MIN_CALLS,
+                 failure_rate=FAILURE_RATE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.name = name
+        self.path = path
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self._unwritten_successes = 0
+        self._failed_last = False
+        self._shared = _initial_state()
+        self._synced_at = float("-inf")
+
+    def _read(self, connection):
+        row = connection.execute(
+            f"SELECT {', '.join(FIELDS)} FROM circuit_breaker_states WHERE name = ?", (self.name,)
+        ).fetchone()
+        return dict(zip(FIELDS, row)) if row else _initial_state()
+
+    def _sync(self, now):
+        # Picks up the shared state, at most every SYNC_SECONDS (callers hold _lock)
+        if now - self._synced_at >= SYNC_SECONDS:
+            self._shared = self._read(_connect(self.path))
+            self._synced_at = now
+        return self._shared
+
+    def _transition(self, change):
+        # Applies a change to the freshly read shared state in one SQLite transaction
+        with _lock:
+            connection = _connect(self.path)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                shared = self._read(connection)
+                now = time.time()
+                if now - shared["window_start"] >= self.window:
+                    shared.update({"window_start": now, "calls": 0, "failures": 0})
+                result = change(shared, now)
+                connection.execute(
+                    f"INSERT OR REPLACE INTO circuit_breaker_states (name, {', '.join(FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.name, *(shared[field] for field in FIELDS))
+                )
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            self._shared, self._synced_at = shared, now
+            return result
+
+    def _take_unwritten_successes(self):
+        with _lock:
+            successes, self._unwritten_successes = self._unwritten_successes, 0
+        return successes
+
+    def state(self):
+        """
+        Returns the current state: 'closed', 'open' or 'half_open'.
+        """
+        with _lock:
+            now = time.time()
+            shared = self._sync(now)
+        if shared["state"] == OPEN and now - shared["opened_at"] >= self.open_seconds:
+            return HALF_OPEN
+        return shared["state"]
+
+    def _acquire(self):
+        # Returns (allowed, probe_at); probe_at is set when this call is the half-open probe
+        with _lock:
+            now = time.time()
+            shared = self._sync(now)
+        if shared["state"] == CLOSED:
+            return True, 0
+        if shared["state"] == OPEN and now - shared["opened_at"] < self.open_seconds:
+            return False, 0
+        if now - shared["probe_at"] < PROBE_TIMEOUT:
+            return False, 0
+
+        def claim_probe(shared, now):
+            if shared["state"] == CLOSED:
+                return True, 0
+            if shared["state"] == OPEN:
+                if now - shared["opened_at"] < self.open_seconds:
+                    return False, 0
+                shared["state"] = HALF_OPEN
+            if now - shared["probe_at"] < PROBE_TIMEOUT:
+                return False, 0
+            shared["probe_at"] = now
+            return True, now
+        return self._transition(claim_probe)
+
+    def allow(self):
+        """
+        Whether a call may be made now. In half-open state only one probe is allowed at a time.
+        """
+        return self._acquire()[0]
+
+    def release_probe(self, probe_at):
+        """
+        Lets another caller probe at once when a probe ended without an outcome (e.g. the
+        event ran out of time), instead of waiting for PROBE_TIMEOUT.
+        """
+        def release(shared, now):
+            if shared["state"] == HALF_OPEN and shared["probe_at"] == probe_at:
+                shared["probe_at"] = 0
+        self._transition(release)
+
+    def record_success(self):
+        """
+        Records a successful call; closes the circuit if it was half-open.
+        """
+        with _lock:
+            closed = self._sync(time.time())["state"] == CLOSED
+            failed_last, self._failed_last = self._failed_last, False
+            if closed and not failed_last:
+                self._unwritten_successes += 1
+                return
+        successes = self._take_unwritten_successes() + 1
+
+        def success(shared, now):
+            if shared["state"] != CLOSED:
+                # Start from a clean window so old failures do not re-trip the circuit at once
+                print(f"Circuit {self.name} closed.")
+                shared.update({"state": CLOSED, "probe_at": 0, "window_start": now, "calls": 0, "failures": 0})
+            shared["calls"] += successes
+        self._transition(success)
+
+    def record_failure(self):
+        """
+        Records a failed call; opens the circuit when the failure rate of the window (across
+        every process sharing the store) is too high, or a probe failed.
+        """
+        with _lock:
+            self._failed_last = True
+        successes = self._take_unwritten_successes()
+
+        def failure(shared, now):
+            shared["calls"] += successes + 1
+            shared["failures"] += 1
+            tripped = shared["calls"] >= self.min_calls and shared["failures"] / shared["calls"] >= self.failure_rate
+            if shared["state"] != CLOSED or tripped:
+                if shared["state"] == CLOSED:
+                    print(f"Circuit {self.name} opened after {shared['failures']} failures in {shared['calls']} calls.")
+                shared.update({"state": OPEN, "opened_at": now, "probe_at": 0})
+        self._transition(failure)
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """
+        Calls `func` through the breaker.
+
+        :param func: The call to protect, e.g. requests.get.
+        :param is_failure: Optional predicate on the result marking it as a failure (e.g. a 5xx response).
+        :return: The result of `func`.
+        :raises CircuitOpenError: If the circuit is open; exceptions raised by `func` are re-raised.
+        """
+        allowed, probe_at = self._acquire()
+        if not allowed:
+            raise CircuitOpenError(f"Circuit {self.name} is open, skipping call.")
+        succeeded = None
+        try:
+            result = func(*args, **kwargs)
+            succeeded = is_failure is None or not is_failure(result)
+            return result
+        except DeadlineExceeded:
+            # Running out of the event's budget says nothing about the endpoint
+            raise
+        except Exception:
+            succeeded = False
+            raise
+        finally:
+            if succeeded is True:
+                self.record_success()
+            elif succeeded is False:
+                self.record_failure()
+            elif probe_at:
+                self.release_probe(probe_at)
+
+
+def is_server_error(response):
+    """
+    Failure predicate for HTTP responses: 5xx counts against the endpoint. 429 does not,
+    since rate limiting is handled by backing off and says nothing about the endpoint's health.
+    """
+    return response.status_code >= 500
+
+
+_breakers = {}
+
+
+def get_breaker(name):
+    """
+    Returns the shared CircuitBreaker for an endpoint name.
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
@@ -0,0 +1,101 @@
+# Per-event deadline shared by every outbound call of a custom code action.
+# HubSpot kills custom code actions after a hard execution limit; instead of fixed per-call
+# timeouts that add up past it, `main` is wrapped with @with_deadline and every HTTP call
+# takes its timeout from the remaining budget. When the budget runs out, calls stop being
+# started and the action returns a well-defined "retry" output instead of being killed mid-write.
+#
+# The deadline is process-wide: custom code actions handle one event at a time, and worker
+# threads started by the action (batch reads) see the same budget. Batch jobs run without one.
+
+import functools
+import time
+
+# HubSpot's limit is 20s; keep a margin for starting up and returning the output
+DEFAULT_BUDGET = 18.0
+
+# Calls are not started with less time than this left
+MIN_CALL_BUDGET = 0.5
+
+_deadline = None
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the event's time budget is used up.
+    """
+
+
+def remaining():
+    """
+    Returns the seconds left in the current event's budget, or None if no deadline is set.
+    """
+    if _deadline is None:
+        return None
+    return _deadline - time.monotonic()
+
+
+def check(min_remaining=0.0):
+    """
+    Raises DeadlineExceeded if less than `min_remaining` seconds are left.
+    """
+    left = remaining()
+    if left is not None and left < min_remaining:
+        raise DeadlineExceeded(f"Event deadline exceeded ({left:.2f}s left).")
+
+
+def timeout(default):
+    """
+    Caps a requests timeout (seconds or a (connect, read) tuple) to the remaining budget.
+
+    :raises DeadlineExceeded: If too little time is left to start a call.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    check(MIN_CALL_BUDGET)
+    if default is None:
+        return left
+    if isinstance(default, tuple):
+        return tuple(min(value, left) for value in default)
+    return min(default, left)
+
+
+def sleep(seconds):
+    """
+    Sleeps like time.sleep, but raises DeadlineExceeded instead of sleeping past the deadline.
+    """
+    left = remaining()
+    if left is not None and seconds > left - MIN_CALL_BUDGET:
+        raise DeadlineExceeded(f"Waiting {seconds:.2f}s would exceed the event deadline ({left:.2f}s left).")
+    time.sleep(seconds)
+
+
+def with_deadline(budget=DEFAULT_BUDGET, **retry_output):
+    """
+    Decorator for `main(event)`: runs it under a deadline of `budget` seconds.
+
+    If the budget runs out the action returns
+    {"outputFields": {"status": "retry", "status_details": ..., **retry_output}}
+    so the workflow can branch on it and re-enroll the record.
+    """
+    def decorator(main):
+        @functools.wraps(main)
+        def wrapper(event):
+            global _deadline
+            previous = _deadline
+            _deadline = time.monotonic() + budget
+            try:
+                return main(event)
+            except DeadlineExceeded as e:
+                print(e)
+                return {
+                    "outputFields": {
+                        "status": "retry",
+                        "status_details": "execution deadline exceeded",
+                        **retry_output
+                    }
+                }
+            finally:
+                _deadline = previous
+        return wrapper
+    return decorator
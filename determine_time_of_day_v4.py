@@ -1,66 +1,74 @@
-# version using public api to check current time and day of week in a given market
-# includes a fallback solution in case the primary api returns error
+# version computing the current time and day of week in a given market locally (zoneinfo),
+# with the public time APIs kept as an opt-in cross-check (set TIME_CROSS_CHECK=1)
 
+import os
 import requests
-from datetime import datetime, timezone, timedelta
-
-def get_local_time(market):
-    # Determine timezone URL based on market
+import deadline
+from circuit_breaker import get_breaker, is_server_error
+from hedging import hedged
+from business_calendar import next_working_slot
+from market_time import classify_hour, get_local_time, get_timezone, lead_priority, lead_source_priority
+
+# Compare the local result with the public time APIs (slow, only for verification)
+TIME_CROSS_CHECK = os.getenv("TIME_CROSS_CHECK", "") == "1"
+
+# Wait this long for timeapi.io before asking the Apps Script source too, until enough
+# timeapi.io latencies are known to hedge at their p95
+TIME_HEDGE_DELAY = 1.0
+
+def fetch_timeapi(zone_name):
+    # Primary TimeAPI, skipped while its circuit is open
+    primary_url = f"https://timeapi.io/api/Time/current/zone?timeZone={zone_name}"
+    response = get_breaker("timeapi.io").call(requests.get, primary_url, timeout=deadline.timeout(5), is_failure=is_server_error)
+    response.raise_for_status()
+    local_time = response.json()
+    print(local_time)
+
+    # Accept the local time only if the expected keys are present
+    if 'hour' not in local_time or 'dayOfWeek' not in local_time:
+        raise ValueError(f"Unexpected TimeAPI response: {local_time}")
+    return local_time, "TimeAPI"
+
+def fetch_apps_script_time(zone_name):
+    # Secondary Google Apps Script
     # fallback solution credits: https://github.com/davidayalas/current-time?tab=readme-ov-file
-    
-    if market in ['gb', 'pt']:
-        primary_url = "https://timeapi.io/api/Time/current/zone?timeZone=Europe/London"
-        fallback_url = "https://script.google.com/macros/s/AKfycbyd5AcbAnWi2Yn0xhFRbyzS4qMq1VucMVgVvhul5XqS9HkAyJY/exec?tz=Europe/London"
-    else:
-        primary_url = "https://timeapi.io/api/Time/current/zone?timeZone=Europe/Berlin"
-        fallback_url = "https://script.google.com/macros/s/AKfycbyd5AcbAnWi2Yn0xhFRbyzS4qMq1VucMVgVvhul5XqS9HkAyJY/exec?tz=Europe/Berlin"
-
-    # 1) Primary TimeAPI
+    fallback_url = f"https://script.google.com/macros/s/AKfycbyd5AcbAnWi2Yn0xhFRbyzS4qMq1VucMVgVvhul5XqS9HkAyJY/exec?tz={zone_name}"
+    response = get_breaker("script.google.com").call(requests.get, fallback_url, timeout=deadline.timeout(5), is_failure=is_server_error)
+    response.raise_for_status()
+    local_time = response.json()
+    print(local_time)
+    # Transform the response to match the structure of TimeAPI
+    return {
+      "hour": local_time["hours"],
+      "dayOfWeek": local_time["dayofweekName"]  # Full day name (e.g., Monday)
+    }, "davidayalas"
+
+def fetch_remote_time(market):
+    # Query the public time APIs for the market's time zone: TimeAPI first, the Apps Script
+    # source as a hedge when TimeAPI is slow and as the fallback when it fails
+    zone_name = get_timezone(market).key
     try:
-        # Try the primary API (TimeAPI)
-        response = requests.get(primary_url, timeout=15)  # Added a timeout to prevent long waits
-        response.raise_for_status()
-        local_time = response.json()
-        print(response.json())
-        
-        # Return the local time only if the expected keys are present
-        if 'hour' in local_time and 'dayOfWeek' in local_time:
-            return local_time, "TimeAPI"
+        return hedged("timeapi.io", [lambda: fetch_timeapi(zone_name), lambda: fetch_apps_script_time(zone_name)],
+                      default_delay=TIME_HEDGE_DELAY)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"Time APIs failed: {e}")
 
-    except requests.exceptions.RequestException as e:
-        print(f"Primary API failed: {e}")
-    
-    # 2) Secondary Google Apps Script
-    try:
-        # Fallback if the primary API fails
-        response = requests.get(fallback_url, timeout=15)
-        response.raise_for_status()
-        local_time = response.json()
-        print(local_time)
-        # Transform the response to match the structure of TimeAPI
-        return {
-          "hour": local_time["hours"],
-          "dayOfWeek": local_time["dayofweekName"]  # Full day name (e.g., Monday)
-        }, "davidayalas"
-
-    except requests.exceptions.RequestException as e:
-        print(f"Fallback API failed: {e}")
-   
-    # 3) Built-in datetime fallback to CET (UTC+1)
-    try:
-        cet = timezone(timedelta(hours=1))
-        now_cet = datetime.now(cet)
-        return {
-            "hour": now_cet.hour,
-            "dayOfWeek": now_cet.strftime("%A")
-        }, "datetime"
-    except Exception as e:
-        print(f"Datetime fallback failed: {e}")
-        
     # If both APIs fail, return an error message
     return {"error": "Unable to fetch local time from any method"}, "None"
 
 
+def cross_check_local_time(market, local_time):
+    # Log any disagreement between the local engine and the public time APIs
+    remote_time, remote_service = fetch_remote_time(market)
+    if "error" in remote_time:
+        print(f"Cross-check skipped: {remote_time['error']}")
+    elif (remote_time.get("hour"), remote_time.get("dayOfWeek")) != (local_time["hour"], local_time["dayOfWeek"]):
+        print(f"Cross-check mismatch for market {market}: zoneinfo {local_time}, {remote_service} {remote_time}")
+    else:
+        print(f"Cross-check OK against {remote_service}")
+
+
+@deadline.with_deadline()
 def main(event):
     try:
         market = event["inputFields"].get("markets", None)
@@ -91,52 +99,40 @@ def main(event):
     print(f"Market: {market}")
 
     # set priority based on lead source/scoring
-    if utm_campaign == "personal_referral" or lead_scoring_system_level_2 == 3 or HV_eligible == True:
-      lead_source_priority = 1
-    elif lead_scoring_system_level_2 == 2:
-      lead_source_priority = 2
-    else:
-      lead_source_priority = 1 
+    source_priority = lead_source_priority(utm_campaign, lead_scoring_system_level_2, HV_eligible)
 
-    # Get the current local time and the API service used
+    # Get the current local time of the market (computed locally, no API call)
     local_time, api_service_used = get_local_time(market)
     print(f"Local Time: {local_time}, API Service Used: {api_service_used}")
 
-    if "error" in local_time:
-        # If no time data is available, set default fallback values
-        hour_of_inquiry = 'unknown'
-        day_of_inquiry = 'unknown'
-        lead_priority = 2  # Default to low priority if no time info is available
-    else:
-        current_hour = local_time.get("hour")
-        day_of_inquiry = local_time.get("dayOfWeek")
-
-        # Determine if the inquiry is during working hours
-        if current_hour < 9 or current_hour >= 18:
-            hour_of_inquiry = 'outside_working_hours'
-        elif 9 <= current_hour < 18:
-            hour_of_inquiry = 'working_hours'
-        else:
-            hour_of_inquiry = 'outside_working_hours'
-
-        # Determine lead priority
-        if day_of_inquiry in ["Saturday", "Sunday"]:
-            lead_priority = 2
-        elif hour_of_inquiry == 'outside_working_hours':
-            lead_priority = 2
-        else:
-            lead_priority = 1
-
-    print(f"Hour of Inquiry: {hour_of_inquiry}, Day of Inquiry: {day_of_inquiry}, Lead Priority: {lead_priority}, API Service Used: {api_service_used}, lead_source_priority: {lead_source_priority}, utm_source: {utm_source}, HV_eligible: {HV_eligible}")
+    if TIME_CROSS_CHECK:
+        cross_check_local_time(market, local_time)
+
+    day_of_inquiry = local_time["dayOfWeek"]
+
+    # Determine if the inquiry is during working hours
+    hour_of_inquiry = classify_hour(local_time["hour"])
+
+    # Determine lead priority
+    priority = lead_priority(day_of_inquiry, hour_of_inquiry)
+
+    # Next working slot (holidays included) and the delay until it, for a single workflow delay step
+    slot, delay_seconds = next_working_slot(market)
+    is_working_time = "yes" if delay_seconds == 0 else "no"
+
+    print(f"Hour of Inquiry: {hour_of_inquiry}, Day of Inquiry: {day_of_inquiry}, Lead Priority: {priority}, API Service Used: {api_service_used}, lead_source_priority: {source_priority}, utm_source: {utm_source}, HV_eligible: {HV_eligible}")
     
     return {
         "outputFields": {
             "hour_of_inquiry": hour_of_inquiry,
             "day_of_inquiry": day_of_inquiry,
-            "lead_priority": lead_priority,
+            "lead_priority": priority,
             "api_service_used": api_service_used,
-          	"lead_source_priority": lead_source_priority,
+          	"lead_source_priority": source_priority,
           	"utm_source": utm_source,
-            "HV_eligible": HV_eligible
+            "HV_eligible": HV_eligible,
+            "is_working_time": is_working_time,
+            "next_working_slot": slot * 1000,
+            "delay_minutes": -(-delay_seconds // 60)
         }
     }
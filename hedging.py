@@ -0,0 +1,174 @@
+# Hedged requests for idempotent reads (time APIs, HubSpot reads). Paid calls such as OpenAI
+# completions are not hedged: the losing request cannot be cancelled once sent, so every hedge
+# would pay for a second completion.
+# The first attempt is sent right away; if it has not answered after the endpoint's usual
+# latency (a high percentile of recent response times), the next attempt -- the same call or
+# an alternate endpoint -- is sent as well and whichever answers first wins. The slower one is
+# cancelled if it has not started yet, and its response is closed when it arrives.
+# Counters of how often a hedge was sent and how often it won are kept per name, in memory
+# and, when HEDGE_METRICS_DB is set, in a SQLite file (`python hedging.py` prints them).
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+
+METRICS_PATH = os.getenv("HEDGE_METRICS_DB")
+
+# The hedge is sent once the first attempt is slower than this percentile of recent calls
+HEDGE_PERCENTILE = 95
+
+# Until this many latencies are known the caller's default delay is used
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# Never hedge faster than this, even for very fast endpoints
+MIN_HEDGE_DELAY = 0.05
+DEFAULT_HEDGE_DELAY = 1.0
+
+# Threads shared by all hedged calls; losers keep theirs until their own timeout
+MAX_THREADS = 16
+
+COUNTERS = ("calls", "hedged", "hedge_wins", "failures")
+
+_executor = ThreadPoolExecutor(max_workers=MAX_THREADS, thread_name_prefix="hedge")
+_lock = threading.Lock()
+_latencies = {}
+_counters = {}
+
+
+def hedge_delay(name, default=DEFAULT_HEDGE_DELAY):
+    """
+    Returns how long to wait for the first attempt before hedging: the HEDGE_PERCENTILE of
+    the last LATENCY_WINDOW successful first attempts, or `default` while too few are known.
+    """
+    with _lock:
+        samples = sorted(_latencies.get(name, ()))
+    if len(samples) < MIN_SAMPLES:
+        return default
+    index = min(len(samples) - 1, len(samples) * HEDGE_PERCENTILE // 100)
+    return max(MIN_HEDGE_DELAY, samples[index])
+
+
+def _record_latency(name, seconds):
+    with _lock:
+        _latencies.setdefault(name, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def _record_call(name, hedged, hedge_won, failed):
+    counts = {"calls": 1, "hedged": int(hedged), "hedge_wins": int(hedge_won), "failures": int(failed)}
+    with _lock:
+        totals = _counters.setdefault(name, dict.fromkeys(COUNTERS, 0))
+        for counter, value in counts.items():
+            totals[counter] += value
+    if METRICS_PATH:
+        try:
+            with closing(_connect(METRICS_PATH)) as connection, connection:
+                connection.execute("INSERT OR IGNORE INTO hedge_metrics (name) VALUES (?)", (name,))
+                connection.execute(
+                    "UPDATE hedge_metrics SET " + ", ".join(f"{counter} = {counter} + ?" for counter in COUNTERS) + " WHERE name = ?",
+                    [counts[counter] for counter in COUNTERS] + [name]
+                )
+        except sqlite3.Error as e:
+            print(f"Failed to record hedging metrics: {e}")
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=5)
+    # Metrics are advisory, so trade durability for speed
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS hedge_metrics (name TEXT PRIMARY KEY, "
+        + ", ".join(f"{counter} INTEGER NOT NULL DEFAULT 0" for counter in COUNTERS) + ")"
+    )
+    return connection
+
+
+def _discard(future):
+    # Close responses of attempts that lost the race so their connections are released
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        close()
+
+
+def hedged(name, attempts, delay=None, default_delay=DEFAULT_HEDGE_DELAY):
+    """
+    Runs idempotent attempts with hedging and returns the first successful result.
+
+    attempts[0] is sent at once; every further attempt is sent when the running ones have not
+    answered within the hedge delay, or straight away when all running ones failed.
+
+    :param name: Name the latencies and metrics are kept under, e.g. "timeapi.io".
+    :param attempts: Callables without arguments, e.g. [get, get] or [get_primary, get_fallback].
+    :param delay: Fixed hedge delay in seconds; by default it follows the recorded latencies.
+    :param default_delay: Hedge delay used until enough latencies are recorded.
+    :return: The result of the attempt that succeeded first.
+    :raises Exception: The last attempt's exception if all attempts failed.
+    """
+    delay = hedge_delay(name, default_delay) if delay is None else delay
+    started = time.monotonic()
+    pending = {}
+    errors = []
+
+    def launch(index):
+        future = _executor.submit(attempts[index])
+        if index == 0:
+            future.add_done_callback(lambda f: f.exception() is None and _record_latency(name, time.monotonic() - started))
+        pending[future] = index
+
+    winner = None
+    launch(0)
+    launched = 1
+    while pending and winner is None:
+        can_hedge = launched < len(attempts)
+        done, _ = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+        if not done:
+            launch(launched)
+            launched += 1
+            continue
+        for future in done:
+            index = pending.pop(future)
+            if future.exception() is not None:
+                errors.append(future.exception())
+            elif winner is None:
+                winner = (index, future.result())
+        if winner is None and not pending and launched < len(attempts):
+            launch(launched)
+            launched += 1
+
+    for future in pending:
+        future.cancel()
+        future.add_done_callback(_discard)
+
+    _record_call(name, hedged=launched > 1, hedge_won=winner is not None and winner[0] > 0, failed=winner is None)
+    if winner is None:
+        raise errors[-1]
+    return winner[1]
+
+
+def metrics():
+    """
+    Returns this process's counters per name, with the hedge win rate and current hedge delay.
+    """
+    with _lock:
+        counters = {name: dict(totals) for name, totals in _counters.items()}
+    for name, totals in counters.items():
+        totals["hedge_win_rate"] = round(totals["hedge_wins"] / totals["hedged"], 3) if totals["hedged"] else None
+        totals["hedge_delay"] = round(hedge_delay(name), 3)
+    return counters
+
+
+if __name__ == "__main__":
+    if not METRICS_PATH or not os.path.exists(METRICS_PATH):
+        print("Set HEDGE_METRICS_DB to the metrics file written by the actions.")
+    else:
+        with closing(_connect(METRICS_PATH)) as connection:
+            rows = connection.execute(f"SELECT name, {', '.join(COUNTERS)} FROM hedge_metrics ORDER BY name").fetchall()
+        for name, calls, hedged_calls, hedge_wins, failures in rows:
+            rate = f"{hedge_wins / hedged_calls:.1%}" if hedged_calls else "-"
+            print(f"{name}: {calls} calls, {hedged_calls} hedged, {hedge_wins} won by the hedge ({rate}), {failures} failed")
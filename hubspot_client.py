@@ -0,0 +1,232 @@
+# Shared HTTP client for the HubSpot custom code actions in this repo.
+# Keep this file next to the action (or on PYTHONPATH) and use get_session()
+# instead of building a module-level `headers` dict and calling requests.get/post/patch.
+# Sessions are pooled per access token, so repeated calls inside one run (and across
+# warm runs of the same action) reuse the keep-alive TLS connection to api.hubapi.com.
+# Every call is paced and retried by the token's hubspot_ratelimit.RequestScheduler, and
+# fails fast with CircuitOpenError while its endpoint's circuit breaker is open. Timeouts are
+# capped to what is left of the event's deadline (see deadline.py). With HUBSPOT_HEDGE_READS=1,
+# reads that are slower than usual are hedged with a second identical request (see hedging.py).
+
+import os
+import re
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import deadline
+from circuit_breaker import get_breaker, is_server_error
+from hedging import hedged
+from hubspot_ratelimit import READ_ONLY_POST_SUFFIXES, RequestScheduler
+
+BASE_URL = "https://api.hubapi.com"
+
+# (connect, read) timeout in seconds applied when a call does not pass its own
+DEFAULT_TIMEOUT = (3.05, 15)
+
+# Max keep-alive connections kept open per token
+POOL_SIZE = 10
+
+# HubSpot rejects search filter groups with more filters than this
+MAX_FILTERS_PER_GROUP = 6
+
+# Hedged reads cost extra calls against the rate limit, so they are opt-in
+HEDGE_READS = os.getenv("HUBSPOT_HEDGE_READS", "") == "1"
+
+# Path segments that identify a record (numeric ids, UUIDs, emails) rather than an endpoint
+RECORD_ID_SEGMENT = re.compile(r"\d+|[0-9a-fA-F-]{16,}|[^@]+@[^@]+")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class HubSpotSession(requests.Session):
+    """
+    requests.Session bound to one HubSpot access token.
+
+    Sets the auth/JSON/gzip headers once, applies DEFAULT_TIMEOUT to every call,
+    accepts paths relative to BASE_URL (e.g. "/crm/v3/objects/tickets") and sends
+    everything through a rate-limit-aware scheduler.
+    """
+
+    def __init__(self, access_token, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE, scheduler=None, hedge_reads=HEDGE_READS):
+        super().__init__()
+        self.timeout = timeout
+        self.hedge_reads = hedge_reads
+        self.scheduler = scheduler or RequestScheduler()
+        self.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate"
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if url.startswith("/"):
+            url = BASE_URL + url
+        timeout = kwargs.pop("timeout", self.timeout)
+        # The timeout is recomputed for every attempt, so retries only get what is left of the deadline
+        send_request = lambda: super(HubSpotSession, self).request(method, url, timeout=deadline.timeout(timeout), **kwargs)
+        name = endpoint_name(url)
+        breaker = get_breaker(name)
+        send = lambda: breaker.call(self.scheduler.send, method, url, send_request, is_failure=is_server_error)
+        if self.hedge_reads and is_read_request(method, url):
+            return hedged(name, [send, send])
+        return send()
+
+
+def endpoint_name(url):
+    """
+    Circuit breaker name for a URL: host plus the first four path segments, cut before the
+    first record id, e.g. "api.hubapi.com/crm/v3/objects/tickets" or "api.hubapi.com/settings/v3/users"
+    (so every record shares its endpoint's breaker).
+    """
+    parts = urlsplit(url)
+    segments = []
+    for segment in [segment for segment in parts.path.split("/") if segment][:4]:
+        if RECORD_ID_SEGMENT.fullmatch(segment):
+            break
+        segments.append(segment)
+    return "/".join([parts.netloc] + segments)
+
+
+def is_read_request(method, url):
+    """
+    Whether a call only reads data (GET, or a POST to a batch read or search endpoint) and may be hedged.
+    """
+    method = method.upper()
+    return method in ("GET", "HEAD") or (method == "POST" and urlsplit(url).path.rstrip("/").endswith(READ_ONLY_POST_SUFFIXES))
+
+
+def get_session(access_token):
+    """
+    Returns the pooled session for a given access token, creating it on first use.
+
+    :param access_token: The HubSpot private app access token.
+    :return: HubSpotSession shared by every caller using the same token.
+    """
+    with _sessions_lock:
+        session = _sessions.get(access_token)
+        if session is None:
+            session = HubSpotSession(access_token)
+            _sessions[access_token] = session
+        return session
+
+
+def close_sessions():
+    """
+    Closes and forgets every pooled session (e.g. at the end of a batch job).
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def chunks(items, size=100):
+    """
+    Splits a list into consecutive chunks of at most `size` items (HubSpot batch endpoints take 100).
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def search_all(session, object_type, filters=None, properties=None, page_size=100, after_id=0):
+    """
+    Streams every record matching a CRM search, page by page.
+
+    The search API stops paging after 10,000 results, so instead of following
+    `paging.next.after` each page asks for records with a higher hs_object_id
+    than the last one seen (sorted ascending), which works for any result size.
+
+    :param session: HubSpotSession used for the calls.
+    :param object_type: CRM object type, e.g. "companies" or "tickets".
+    :param filters: List of search filters combined with AND; at most MAX_FILTERS_PER_GROUP - 1,
+        because the hs_object_id cursor filter is added to the same group.
+    :param properties: Properties to return for each record.
+    :param page_size: Records per search call (HubSpot max is 100 -- 200 for some objects).
+    :param after_id: Only return records with a higher hs_object_id (to resume an interrupted run).
+    :return: Generator of search result records.
+    """
+    filters = list(filters or [])
+    if len(filters) >= MAX_FILTERS_PER_GROUP:
+        raise ValueError(
+            f"search_all takes at most {MAX_FILTERS_PER_GROUP - 1} filters ({len(filters)} given): "
+            f"HubSpot allows {MAX_FILTERS_PER_GROUP} per group and the hs_object_id cursor filter uses one."
+        )
+    search_url = f"/crm/v3/objects/{object_type}/search"
+    last_id = int(after_id)
+
+    while True:
+        payload = {
+            "filterGroups": [{
+                "filters": filters + [
+                    {"propertyName": "hs_object_id", "operator": "GT", "value": str(last_id)}
+                ]
+            }],
+            "sorts": [{"propertyName": "hs_object_id", "direction": "ASCENDING"}],
+            "properties": list(properties or []),
+            "limit": page_size
+        }
+        response = session.post(search_url, json=payload)
+
+        if response.status_code != 200:
+            raise Exception(f"Error searching {object_type}: {response.text}")
+
+        results = response.json().get("results", [])
+        yield from results
+
+        if len(results) < page_size:
+            return
+        last_id = int(results[-1]["id"])
+
+
+def batch_errors(response_data, object_ids):
+    """
+    Finds the records a batch call did not process, from its 207 (multi-status) body.
+
+    Records missing from `results` failed; each gets the message of the error whose context
+    names it, or every error message when none does.
+
+    :param response_data: Parsed JSON body of the batch call.
+    :param object_ids: IDs of the records that were sent.
+    :return: Dictionary of record ID -> error message for the failed records.
+    """
+    succeeded = {str(result.get("id")) for result in response_data.get("results", [])}
+    errors = response_data.get("errors", [])
+    messages = {}
+    for error in errors:
+        for ids in (error.get("context") or {}).values():
+            for object_id in ids if isinstance(ids, list) else [ids]:
+                messages.setdefault(str(object_id), error.get("message", ""))
+    fallback = "; ".join(error.get("message", "") for error in errors) or "not processed"
+    return {str(object_id): messages.get(str(object_id), fallback) for object_id in object_ids if str(object_id) not in succeeded}
+
+
+def batch_read_associations(session, from_object_type, to_object_type, object_ids):
+    """
+    Reads the associations of up to 100 records with one v4 batch association read.
+
+    Only the first page of associations (500) is returned for each record.
+
+    :param session: HubSpotSession used for the call.
+    :param from_object_type: Object type (or type ID) of the records, e.g. "contacts" or "0-136".
+    :param to_object_type: Object type (or type ID) of the associated records.
+    :param object_ids: Up to 100 record IDs.
+    :return: Dictionary of record ID -> list of associated record IDs (as strings).
+    """
+    associations_url = f"/crm/v4/associations/{from_object_type}/{to_object_type}/batch/read"
+    payload = {"inputs": [{"id": str(object_id)} for object_id in object_ids]}
+
+    response = session.post(associations_url, json=payload)
+
+    # 207 is returned when some of the records have no associations
+    if response.status_code not in (200, 207):
+        raise Exception(f"Error fetching associations: {response.text}")
+
+    associations = {str(object_id): [] for object_id in object_ids}
+    for result in response.json().get("results", []):
+        associations[str(result["from"]["id"])] = [str(assoc["toObjectId"]) for assoc in result.get("to", [])]
+    return associations
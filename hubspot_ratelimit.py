@@ -0,0 +1,180 @@
+# Rate-limit-aware scheduling for HubSpot API calls.
+# A token bucket per access token paces calls below the portal's 10-second burst limit,
+# keeps itself in sync with the X-HubSpot-RateLimit-* response headers and retries
+# 429/5xx responses with jittered exponential backoff.
+# Used by hubspot_client.HubSpotSession, so every action going through get_session() shares it.
+
+import random
+import threading
+import time
+
+import requests
+
+import deadline
+
+# Defaults for a private app until the first response tells us the real limits
+DEFAULT_MAX_REQUESTS = 100
+DEFAULT_INTERVAL = 10.0  # seconds
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 10.0  # seconds
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}
+
+# POST endpoints that only read data and are therefore safe to retry after a 5xx
+READ_ONLY_POST_SUFFIXES = ("/batch/read", "/search")
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all threads calling HubSpot with the same token.
+
+    Callers reserve a token up front, so when the bucket is empty they queue up
+    in time order instead of all retrying at once.
+    """
+
+    def __init__(self, max_requests=DEFAULT_MAX_REQUESTS, interval=DEFAULT_INTERVAL):
+        self.max_requests = max_requests
+        self.interval = interval
+        self._tokens = float(max_requests)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.max_requests / self.interval
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.max_requests, self._tokens + elapsed * self.rate)
+        self._updated = max(self._updated, now)
+
+    def acquire(self):
+        """
+        Blocks until the caller may send one request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(-self._tokens / self.rate, self._paused_until - now)
+        if wait > 0:
+            deadline.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for the given number of seconds (e.g. after a 429).
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._updated = self._paused_until
+
+    def update_from_headers(self, headers):
+        """
+        Syncs the bucket with HubSpot's view of the current burst window.
+
+        :param headers: Response headers containing X-HubSpot-RateLimit-* values.
+        """
+        max_requests = _int_header(headers, "X-HubSpot-RateLimit-Max")
+        interval_ms = _int_header(headers, "X-HubSpot-RateLimit-Interval-Milliseconds")
+        remaining = _int_header(headers, "X-HubSpot-RateLimit-Remaining")
+
+        with self._lock:
+            self._refill(time.monotonic())
+            if max_requests:
+                self.max_requests = max_requests
+            if interval_ms:
+                self.interval = interval_ms / 1000.0
+            # Other actions share the portal limit, so trust the server's remaining count
+            if remaining is not None:
+                self._tokens = min(self._tokens, float(remaining))
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Full-jitter exponential backoff delay for the given retry attempt (0-based).
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_retry_safe(method, url):
+    """
+    Whether a request can be re-sent after a 5xx or connection error.
+    429 responses are always retried because HubSpot did not process the call.
+    """
+    method = method.upper()
+    if method in IDEMPOTENT_METHODS:
+        return True
+    return method == "POST" and url.split("?", 1)[0].rstrip("/").endswith(READ_ONLY_POST_SUFFIXES)
+
+
+def _is_daily_limit(response):
+    try:
+        return response.json().get("policyName") == "DAILY"
+    except ValueError:
+        return False
+
+
+class RequestScheduler:
+    """
+    Paces and retries HubSpot calls for one access token.
+    """
+
+    def __init__(self, bucket=None, max_retries=MAX_RETRIES):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+
+    def send(self, method, url, send_request):
+        """
+        Sends a request through the token bucket, retrying 429/5xx with jittered backoff.
+
+        :param method: HTTP method of the request.
+        :param url: Full request URL.
+        :param send_request: Callable performing the actual HTTP call and returning a response.
+        :return: The last response received; callers keep handling non-2xx statuses themselves.
+        """
+        retry_safe = is_retry_safe(method, url)
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                response = send_request()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not retry_safe or attempt >= self.max_retries:
+                    raise
+                deadline.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            self.bucket.update_from_headers(response.headers)
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            if response.status_code == 429:
+                # The daily quota will not recover within this run
+                if _is_daily_limit(response):
+                    return response
+                retry_after = _int_header(response.headers, "Retry-After")
+                delay = retry_after if retry_after is not None else self.bucket.interval / 2
+                self.bucket.pause(delay + backoff_delay(attempt))
+            elif retry_safe:
+                deadline.sleep(backoff_delay(attempt))
+            else:
+                return response
+
+            print(f"HubSpot returned {response.status_code} for {method} {url}, retrying (attempt {attempt + 1}).")
+            attempt += 1
@@ -0,0 +1,160 @@
+# Vectorized batch version of the determine_time_of_day_v4 classification, for re-scoring
+# historical leads after a rule change. The rules themselves are the market_time functions the
+# per-event action calls, evaluated once per distinct input (every weekday/hour pair, every
+# lead source combination) and spread over the rows, so the two paths cannot drift apart.
+#
+# Time zones are handled with a per-zone table of UTC offsets for every hour in the input
+# range (European DST switches happen on the hour), built from a handful of zoneinfo calls,
+# so converting millions of timestamps is a single NumPy lookup.
+
+import argparse
+import csv
+from datetime import datetime, timezone
+
+import numpy as np
+
+from market_time import classify_hour, get_timezone, lead_priority, lead_source_priority
+
+DAY_NAMES = np.array(["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"])
+
+# market_time rules for every local hour and every (weekday, hour) pair
+HOUR_LABELS = np.array([classify_hour(hour) for hour in range(24)])
+PRIORITY_TABLE = np.array([[lead_priority(day, HOUR_LABELS[hour]) for hour in range(24)] for day in DAY_NAMES])
+
+
+def hourly_offset_table(zone, first_hour, last_hour):
+    """
+    Returns the zone's UTC offset (in seconds) for every UTC hour in [first_hour, last_hour].
+
+    Offsets are looked up once per day; only days where the offset changes are resolved
+    hour by hour.
+
+    :param zone: ZoneInfo to compute the offsets for.
+    :param first_hour: First hour, as hours since the Unix epoch.
+    :param last_hour: Last hour, as hours since the Unix epoch.
+    :return: int64 array of length last_hour - first_hour + 1.
+    """
+    first_day = first_hour // 24
+    last_day = last_hour // 24 + 1
+
+    def offset_at(hour):
+        instant = datetime.fromtimestamp(hour * 3600, timezone.utc)
+        return int(instant.astimezone(zone).utcoffset().total_seconds())
+
+    daily = np.array([offset_at(day * 24) for day in range(first_day, last_day + 1)], dtype=np.int64)
+    table = np.repeat(daily[:-1], 24)
+    for i in np.flatnonzero(daily[:-1] != daily[1:]):
+        day_start = (first_day + i) * 24
+        table[i * 24:(i + 1) * 24] = [offset_at(day_start + h) for h in range(24)]
+
+    start = first_hour - first_day * 24
+    return table[start:start + last_hour - first_hour + 1]
+
+
+def local_seconds(timestamps_ms, markets):
+    """
+    Converts UTC timestamps to local wall-clock seconds since the epoch in each row's market.
+
+    :param timestamps_ms: int64 array of UTC timestamps in milliseconds (HubSpot createdate).
+    :param markets: Array of market codes, one per timestamp.
+    :return: int64 array of local seconds.
+    """
+    seconds = np.asarray(timestamps_ms, dtype=np.int64) // 1000
+    hours = seconds // 3600
+    if len(seconds) == 0:
+        return seconds
+
+    first_hour, last_hour = int(hours.min()), int(hours.max())
+    unique_markets, market_index = np.unique(np.asarray(markets, dtype=str), return_inverse=True)
+
+    # One offset table per time zone, stacked so every row is a single 2-D lookup
+    zone_tables = {}
+    market_tables = []
+    for market in unique_markets:
+        zone = get_timezone(market)
+        if zone.key not in zone_tables:
+            zone_tables[zone.key] = hourly_offset_table(zone, first_hour, last_hour)
+        market_tables.append(zone_tables[zone.key])
+    offsets = np.stack(market_tables)
+
+    return seconds + offsets[market_index.ravel(), hours - first_hour]
+
+
+def map_distinct(function, *columns):
+    """
+    Applies `function` row by row, calling it only once per distinct combination of inputs.
+
+    :return: NumPy array of the results, one per row.
+    """
+    results = {}
+    values = []
+    for key in zip(*columns):
+        if key not in results:
+            results[key] = function(*key)
+        values.append(results[key])
+    return np.array(values)
+
+
+def classify_batch(timestamps_ms, markets, utm_campaigns, lead_scoring_system_level_2, hv_eligible):
+    """
+    Computes the determine_time_of_day_v4 output fields for many leads at once.
+
+    :param timestamps_ms: UTC creation timestamps in milliseconds.
+    :param markets: Market codes.
+    :param utm_campaigns: utm_campaign values.
+    :param lead_scoring_system_level_2: Raw scoring levels (e.g. "2", 3 or "" when missing).
+    :param hv_eligible: Raw HV_eligible values (e.g. "true", False or None).
+    :return: Dictionary of output field -> NumPy array (hour_of_inquiry, day_of_inquiry,
+             lead_priority, lead_source_priority).
+    """
+    local = local_seconds(timestamps_ms, markets)
+    hour = (local // 3600) % 24
+    weekday = (local // 86400 + 3) % 7  # 1970-01-01 was a Thursday
+
+    return {
+        "hour_of_inquiry": HOUR_LABELS[hour],
+        "day_of_inquiry": DAY_NAMES[weekday],
+        "lead_priority": PRIORITY_TABLE[weekday, hour],
+        "lead_source_priority": map_distinct(lead_source_priority, utm_campaigns, lead_scoring_system_level_2, hv_eligible)
+    }
+
+
+def _parse_createdate(value):
+    # HubSpot exports createdate either as epoch milliseconds or as an ISO 8601 string
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def classify_csv(input_path, output_path):
+    """
+    Re-scores a CSV export of leads (createdate, markets, utm_campaign,
+    lead_scoring_system_level_2, HV_eligible columns) and writes the input
+    columns plus the computed output fields to `output_path`.
+    """
+    with open(input_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    results = classify_batch(
+        [_parse_createdate(row["createdate"]) for row in rows],
+        [row.get("markets") or "" for row in rows],
+        [row.get("utm_campaign") for row in rows],
+        [row.get("lead_scoring_system_level_2") for row in rows],
+        [row.get("HV_eligible") for row in rows],
+    )
+
+    fieldnames = list(rows[0].keys()) + list(results) if rows else list(results)
+    with open(output_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for i, row in enumerate(rows):
+            writer.writerow({**row, **{field: values[i] for field, values in results.items()}})
+    print(f"Classified {len(rows)} leads into {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score historical leads with the current time-of-day rules.")
+    parser.add_argument("input", help="CSV export of leads")
+    parser.add_argument("output", help="CSV file to write")
+    args = parser.parse_args()
+    classify_csv(args.input, args.output)
@@ -0,0 +1,283 @@
+# Local job queue for the OpenAI-backed actions (won-deal poem, ticket categorizer).
+# In queue mode the action only records the deal/ticket id and returns at once; a worker pool
+# started from the action's script makes the LLM calls concurrently and writes the results back
+# through the CRM batch update endpoint. Failed jobs (and jobs whose worker lost its lease) are
+# retried with backoff and moved to a dead-letter state after MAX_ATTEMPTS. Done jobs are kept
+# for DONE_RETENTION_SECONDS, then deleted.
+# The queue is a SQLite file standing in for a real broker, so actions and workers must share
+# a host (or the file), and LLM_QUEUE_PATH must point both to the same file.
+
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from hubspot_client import batch_errors, chunks
+from hubspot_ratelimit import backoff_delay
+
+QUEUE_PATH = os.getenv("LLM_QUEUE_PATH")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+MAX_WORKERS = 5
+MAX_ATTEMPTS = 5
+
+# Jobs claimed per round; their results are written back with one batch update per object type
+CLAIM_SIZE = 50
+
+# A running job whose worker did not report back within this time is handed out again
+LEASE_SECONDS = 300
+
+# How long an idle worker waits before looking for new jobs
+POLL_SECONDS = 2.0
+
+# Done jobs are deleted after this long; workers purge them every PURGE_SECONDS
+DONE_RETENTION_SECONDS = 7 * 24 * 3600
+PURGE_SECONDS = 3600
+
+# Retry delays are longer than for HubSpot calls: a slow or failing model rarely recovers in seconds
+RETRY_BASE = 5.0
+RETRY_CAP = 600.0
+
+
+def get_queue(path=QUEUE_PATH):
+    """
+    Opens the job queue, creating the table on first use.
+    """
+    if not path:
+        raise Exception("LLM_QUEUE_PATH is not set; the actions and the workers must share the queue file.")
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "kind TEXT NOT NULL, object_id TEXT NOT NULL, payload TEXT NOT NULL, "
+        "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+        "available_at REAL NOT NULL, last_error TEXT, updated_at REAL NOT NULL, "
+        "PRIMARY KEY (kind, object_id))"
+    )
+    return connection
+
+
+def enqueue(kind, object_id, payload, path=QUEUE_PATH):
+    """
+    Queues one job. Re-queuing a record replaces its earlier job, so a record re-enrolled
+    before the worker got to it is only processed once, with the newest inputs.
+
+    :param kind: Job kind, e.g. "won_deal_poem" or "ticket_category".
+    :param object_id: Id of the CRM record the result is written to.
+    :param payload: JSON-serializable inputs for the handler.
+    """
+    now = time.time()
+    with closing(get_queue(path)) as connection, connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO jobs (kind, object_id, payload, status, attempts, available_at, last_error, updated_at) "
+            "VALUES (?, ?, ?, ?, 0, ?, NULL, ?)",
+            (kind, str(object_id), json.dumps(payload), PENDING, now, now)
+        )
+
+
+def claim(kind, limit=CLAIM_SIZE, path=QUEUE_PATH):
+    """
+    Marks up to `limit` due jobs of a kind as running and returns them.
+
+    A running job whose lease expired counts as a failed attempt: it is handed out again,
+    or moved to the dead letters once it has used up MAX_ATTEMPTS.
+
+    :return: List of job dictionaries with object_id, payload and attempts.
+    """
+    now = time.time()
+    jobs, dead = [], []
+    with closing(get_queue(path)) as connection, connection:
+        connection.execute("BEGIN IMMEDIATE")
+        rows = connection.execute(
+            "SELECT object_id, payload, attempts, status FROM jobs WHERE kind = ? AND ("
+            "(status = ? AND available_at <= ?) OR (status = ? AND updated_at <= ?)"
+            ") ORDER BY available_at LIMIT ?",
+            (kind, PENDING, now, RUNNING, now - LEASE_SECONDS, limit)
+        ).fetchall()
+        for object_id, payload, attempts, status in rows:
+            if status == RUNNING:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    dead.append(object_id)
+                    connection.execute(
+                        "UPDATE jobs SET status = ?, attempts = ?, last_error = ?, updated_at = ? WHERE kind = ? AND object_id = ?",
+                        (DEAD, attempts, "lease expired", now, kind, object_id)
+                    )
+                    continue
+            jobs.append({"object_id": object_id, "payload": json.loads(payload), "attempts": attempts})
+        connection.executemany(
+            "UPDATE jobs SET status = ?, attempts = ?, updated_at = ? WHERE kind = ? AND object_id = ?",
+            [(RUNNING, job["attempts"], now, kind, job["object_id"]) for job in jobs]
+        )
+    for object_id in dead:
+        print(f"Job {kind}/{object_id} lost its worker on attempt {MAX_ATTEMPTS}, moved to dead letters.")
+    return jobs
+
+
+def complete(kind, object_ids, path=QUEUE_PATH):
+    with closing(get_queue(path)) as connection, connection:
+        connection.executemany(
+            "UPDATE jobs SET status = ?, last_error = NULL, updated_at = ? WHERE kind = ? AND object_id = ? AND status = ?",
+            [(DONE, time.time(), kind, object_id, RUNNING) for object_id in object_ids]
+        )
+
+
+def fail(kind, job, error, path=QUEUE_PATH):
+    """
+    Schedules a failed job for a retry, or moves it to the dead letters after MAX_ATTEMPTS.
+    """
+    attempts = job["attempts"] + 1
+    now = time.time()
+    status = DEAD if attempts >= MAX_ATTEMPTS else PENDING
+    with closing(get_queue(path)) as connection, connection:
+        connection.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, available_at = ?, last_error = ?, updated_at = ? "
+            "WHERE kind = ? AND object_id = ? AND status = ?",
+            (status, attempts, now + backoff_delay(attempts, RETRY_BASE, RETRY_CAP), str(error)[:1000], now,
+             kind, job["object_id"], RUNNING)
+        )
+    if status == DEAD:
+        print(f"Job {kind}/{job['object_id']} failed {attempts} times, moved to dead letters: {error}")
+
+
+def purge_done(kind, older_than=DONE_RETENTION_SECONDS, path=QUEUE_PATH):
+    """
+    Deletes the done jobs of a kind that finished more than `older_than` seconds ago.
+
+    :return: Number of deleted jobs.
+    """
+    with closing(get_queue(path)) as connection, connection:
+        return connection.execute(
+            "DELETE FROM jobs WHERE kind = ? AND status = ? AND updated_at < ?",
+            (kind, DONE, time.time() - older_than)
+        ).rowcount
+
+
+def dead_letters(kind, path=QUEUE_PATH):
+    """
+    Returns the dead jobs of a kind as (object_id, attempts, last_error) tuples.
+    """
+    with closing(get_queue(path)) as connection:
+        return connection.execute(
+            "SELECT object_id, attempts, last_error FROM jobs WHERE kind = ? AND status = ? ORDER BY updated_at",
+            (kind, DEAD)
+        ).fetchall()
+
+
+def requeue_dead(kind, path=QUEUE_PATH):
+    """
+    Gives every dead job of a kind a fresh set of attempts.
+
+    :return: Number of requeued jobs.
+    """
+    now = time.time()
+    with closing(get_queue(path)) as connection, connection:
+        return connection.execute(
+            "UPDATE jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? WHERE kind = ? AND status = ?",
+            (PENDING, now, now, kind, DEAD)
+        ).rowcount
+
+
+def write_back(session, object_type, results):
+    """
+    Writes handler results to CRM records with batch updates.
+
+    :param results: Dictionary of record id -> properties to set.
+    :return: Dictionary of record id -> error for the records that were not updated
+        (rejected in a 207 response, or in a batch that failed as a whole).
+    """
+    update_url = f"/crm/v3/objects/{object_type}/batch/update"
+    failed = {}
+    for batch in chunks(list(results.items())):
+        object_ids = [object_id for object_id, _ in batch]
+        payload = {"inputs": [{"id": object_id, "properties": properties} for object_id, properties in batch]}
+        response = session.post(update_url, json=payload)
+        if response.status_code == 207:
+            failed.update(batch_errors(response.json(), object_ids))
+        elif response.status_code != 200:
+            failed.update({object_id: f"Error updating {object_type}: {response.text}" for object_id in object_ids})
+    return failed
+
+
+def process_jobs(kind, handler, session, object_type, executor, path=QUEUE_PATH):
+    """
+    Runs one round: claims due jobs, runs the handler for each on the pool and writes the results back.
+
+    :param handler: Callable taking a job payload and returning the properties to write;
+        raising marks the job as failed.
+    :return: Number of claimed jobs (0 when the queue had nothing due).
+    """
+    jobs = claim(kind, path=path)
+    if not jobs:
+        return 0
+
+    futures = [(job, executor.submit(handler, job["payload"])) for job in jobs]
+    results = {}
+    for job, future in futures:
+        try:
+            results[job["object_id"]] = future.result()
+        except Exception as e:
+            fail(kind, job, e, path=path)
+
+    try:
+        failed = write_back(session, object_type, results)
+    except Exception as e:
+        failed = {object_id: e for object_id in results}
+
+    # Only records HubSpot actually updated are done; the others are retried like handler errors
+    for job in jobs:
+        if job["object_id"] in failed:
+            fail(kind, job, failed[job["object_id"]], path=path)
+    written = [object_id for object_id in results if object_id not in failed]
+    complete(kind, written, path=path)
+    print(f"Processed {len(written)} of {len(jobs)} {kind} jobs.")
+    return len(jobs)
+
+
+def run_worker(kind, handler, session, object_type, workers=MAX_WORKERS, once=False, path=QUEUE_PATH):
+    """
+    Processes jobs of one kind until stopped (or, with `once`, until nothing is due).
+
+    :param kind: Job kind to process.
+    :param handler: Callable taking a job payload and returning the properties to write.
+    :param session: HubSpotSession used for the write-back.
+    :param object_type: CRM object type the results are written to, e.g. "deals".
+    """
+    purged_at = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if time.time() - purged_at >= PURGE_SECONDS:
+                purged = purge_done(kind, path=path)
+                if purged:
+                    print(f"Deleted {purged} done {kind} jobs older than {DONE_RETENTION_SECONDS}s.")
+                purged_at = time.time()
+            if process_jobs(kind, handler, session, object_type, executor, path=path):
+                continue
+            if once:
+                return
+            time.sleep(POLL_SECONDS)
+
+
+def add_worker_arguments(parser):
+    parser.add_argument("--once", action="store_true", help="stop when no job is due instead of polling")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="concurrent LLM calls")
+    parser.add_argument("--dead-letters", action="store_true", help="list dead jobs instead of working")
+    parser.add_argument("--requeue-dead", action="store_true", help="retry dead jobs from scratch")
+
+
+def run_worker_command(args, kind, handler, session, object_type):
+    """
+    Runs the worker CLI built with add_worker_arguments() for one job kind.
+    """
+    if args.dead_letters:
+        for object_id, attempts, last_error in dead_letters(kind):
+            print(f"{object_id}\t{attempts} attempts\t{last_error}")
+    elif args.requeue_dead:
+        print(f"Requeued {requeue_dead(kind)} dead {kind} jobs.")
+    else:
+        run_worker(kind, handler, session, object_type, workers=args.workers, once=args.once)
@@ -0,0 +1,148 @@
+# Local, network-free time engine for the determine_time_of_day actions.
+# Maps a market code to its IANA time zone and computes the local hour, weekday and
+# working-hours classification with zoneinfo, so DST is handled without calling any API.
+
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# Market code (as used in the `markets` property) -> IANA time zone
+MARKET_TIMEZONES = {
+    # British Isles & Iberia
+    "gb": "Europe/London",
+    "uk": "Europe/London",
+    "ie": "Europe/Dublin",
+    "pt": "Europe/Lisbon",
+    "es": "Europe/Madrid",
+    # Western Europe
+    "fr": "Europe/Paris",
+    "be": "Europe/Brussels",
+    "nl": "Europe/Amsterdam",
+    "lu": "Europe/Luxembourg",
+    "it": "Europe/Rome",
+    "mt": "Europe/Malta",
+    # DACH
+    "dach": "Europe/Berlin",
+    "de": "Europe/Berlin",
+    "at": "Europe/Vienna",
+    "ch": "Europe/Zurich",
+    # Scandinavia & Nordics
+    "sca": "Europe/Stockholm",
+    "se": "Europe/Stockholm",
+    "dk": "Europe/Copenhagen",
+    "no": "Europe/Oslo",
+    "fi": "Europe/Helsinki",
+    "is": "Atlantic/Reykjavik",
+    # Central & Eastern Europe
+    "pl": "Europe/Warsaw",
+    "cz": "Europe/Prague",
+    "sk": "Europe/Bratislava",
+    "hu": "Europe/Budapest",
+    "si": "Europe/Ljubljana",
+    "hr": "Europe/Zagreb",
+    "ro": "Europe/Bucharest",
+    "bg": "Europe/Sofia",
+    "gr": "Europe/Athens",
+    "cy": "Asia/Nicosia",
+    "ee": "Europe/Tallinn",
+    "lv": "Europe/Riga",
+    "lt": "Europe/Vilnius",
+}
+
+# Unknown or missing markets keep the previous behaviour (Berlin time)
+DEFAULT_TIMEZONE = "Europe/Berlin"
+
+# Working hours are [WORK_START_HOUR, WORK_END_HOUR) local time, Monday to Friday
+WORK_START_HOUR = 9
+WORK_END_HOUR = 18
+WEEKEND_DAYS = ("Saturday", "Sunday")
+
+# Lead source rules: personal referrals, top-scored and HV-eligible leads are priority 1,
+# leads scored at the middle level are priority 2, everything else priority 1
+PERSONAL_REFERRAL_CAMPAIGN = "personal_referral"
+HIGH_SCORE_LEVEL = 3
+LOW_SCORE_LEVEL = 2
+
+_zones = {}
+
+
+def get_timezone(market):
+    """
+    Returns the ZoneInfo of a market, falling back to DEFAULT_TIMEZONE.
+    """
+    name = MARKET_TIMEZONES.get((market or "").strip().lower(), DEFAULT_TIMEZONE)
+    zone = _zones.get(name)
+    if zone is None:
+        zone = _zones[name] = ZoneInfo(name)
+    return zone
+
+
+def local_now(market, now=None):
+    """
+    Returns the current (or given) instant as an aware datetime in the market's time zone.
+
+    :param market: Market code, e.g. "gb" or "pl".
+    :param now: Aware datetime to convert instead of the current time.
+    """
+    return (now or datetime.now(timezone.utc)).astimezone(get_timezone(market))
+
+
+def get_local_time(market, now=None):
+    """
+    Computes the local hour and weekday of a market, in the same shape as the TimeAPI response.
+
+    :return: Tuple of ({"hour", "dayOfWeek"}, "zoneinfo").
+    """
+    local = local_now(market, now)
+    return {
+        "hour": local.hour,
+        "dayOfWeek": local.strftime("%A")
+    }, "zoneinfo"
+
+
+def classify_hour(hour):
+    """
+    Returns 'working_hours' or 'outside_working_hours' for a local hour.
+    """
+    if WORK_START_HOUR <= hour < WORK_END_HOUR:
+        return "working_hours"
+    return "outside_working_hours"
+
+
+def lead_priority(day_of_inquiry, hour_of_inquiry):
+    """
+    Returns 1 for inquiries during working hours on a weekday, 2 otherwise.
+    """
+    if day_of_inquiry in WEEKEND_DAYS or hour_of_inquiry != "working_hours":
+        return 2
+    return 1
+
+
+def normalize_lead_source(utm_campaign, lead_scoring_system_level_2, hv_eligible):
+    """
+    Normalizes the lead source fields, which arrive as strings, numbers, booleans or None
+    depending on the workflow input or export they come from.
+
+    :return: Tuple of (utm_campaign as a string, scoring level as a float or None, HV_eligible as a bool).
+    """
+    campaign = str(utm_campaign or "").strip()
+    try:
+        level = float(lead_scoring_system_level_2)
+    except (TypeError, ValueError):
+        level = None
+    if isinstance(hv_eligible, str):
+        hv_eligible = hv_eligible.strip().lower() == "true"
+    return campaign, level, bool(hv_eligible)
+
+
+def lead_source_priority(utm_campaign, lead_scoring_system_level_2, hv_eligible):
+    """
+    Returns the lead priority implied by the lead source and scoring fields.
+
+    Both the per-event action and lead_priority_batch call this, with the raw field values.
+    """
+    campaign, level, hv_eligible = normalize_lead_source(utm_campaign, lead_scoring_system_level_2, hv_eligible)
+    if campaign == PERSONAL_REFERRAL_CAMPAIGN or level == HIGH_SCORE_LEVEL or hv_eligible:
+        return 1
+    if level == LOW_SCORE_LEVEL:
+        return 2
+    return 1
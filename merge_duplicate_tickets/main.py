@@ -1,8 +1,14 @@
 # Use inputs to get data from any action in your workflow and use it in your code instead of having to use the HubSpot API.
 import requests
+import argparse
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hubspot import HubSpot
+from deadline import check, with_deadline
+from hubspot_client import batch_read_associations, chunks, get_session, search_all
+from similarity_index import DEFAULT_THRESHOLD, SimilarityIndex
 
 new_stage_id = {
   '0': '1', # IT
@@ -21,76 +27,111 @@ new_stage_id = {
 # HubSpot API key
 api_key = os.getenv('secret_name')
 
-headers = {
-  'Authorization': f'Bearer {api_key}',
-  'Content-Type': 'application/json'
-}
-
-def get_associated_open_tickets(contact_id, ticket_id, ticket_category, ticket_pipeline):
-    """
-    Retrieves all open tickets associated with a given contact ID based on the 'is_ticket_open_' property.
+# Pooled keep-alive session (auth headers, timeouts and gzip set once)
+session = get_session(api_key)
 
-    :param contact_id: The HubSpot contact ID.
-    :return: List of open tickets with their details.
-    """
-    # HubSpot Associations API Endpoint
-    associations_url = f"https://api.hubapi.com/crm/v4/objects/contacts/{contact_id}/associations/tickets"
+# Define what constitutes an "open" ticket based on the 'is_ticket_open_' property
+TICKET_OPEN_PROPERTY = 'is_ticket_open_'  # Custom property name
+OPEN_VALUE = '1'  # Value indicating the ticket is open
 
-    # Fetch associated tickets
-    response = requests.get(associations_url, headers=headers, params={'limit': 100})
+# Optional on-disk (SQLite) MinHash/LSH index of open ticket descriptions used to find near-duplicates
+# from other contacts or categories. Near-duplicate detection is off when not set.
+SIMILARITY_INDEX_PATH = os.getenv('similarity_index_path')
 
-    if response.status_code != 200:
-        raise Exception(f"Error fetching associations: {response.text}")
+# Seconds the description update and the merge need together; the pair is not started with
+# less of the event's budget left, so a deadline cannot split it
+WRITE_BUDGET = 8.0
 
-    associations_data = response.json()
-    print(associations_data)
+# Properties needed to pick a master ticket; the description is fetched separately
+DUPLICATE_PROPERTIES = [TICKET_OPEN_PROPERTY, 'hs_ticket_category', 'hs_pipeline', 'createdate']
 
-    ticket_ids = [assoc['toObjectId'] for assoc in associations_data.get('results', [])]
-    print(ticket_ids)
+def property_filter(property_name, value):
+    """
+    Builds a search filter matching a property value, or a missing property when the value is empty.
+    """
+    if not value:
+        return {"propertyName": property_name, "operator": "NOT_HAS_PROPERTY"}
+    return {"propertyName": property_name, "operator": "EQ", "value": value}
 
-    if not ticket_ids:
-        return []
+def build_duplicate_filters(contact_id, ticket_id, ticket_category, ticket_pipeline):
+    """
+    Builds the tickets search filters selecting open tickets of the same contact, category and pipeline.
 
-    # Batch fetch ticket details
-    tickets_url = "https://api.hubapi.com/crm/v3/objects/tickets/batch/read"
-    tickets_payload = {
-        "inputs": [{"id": tid} for tid in ticket_ids],
-        "properties": ["is_ticket_open_",
-                       "hs_ticket_category",
-                       "content",
-                       "hs_pipeline"
-                      ]
-    }
+    :param contact_id: The HubSpot contact ID.
+    :param ticket_id: The ID of the ticket that triggered the workflow (excluded).
+    :param ticket_category: The category of the triggering ticket.
+    :param ticket_pipeline: The pipeline of the triggering ticket.
+    :return: List of search filters combined with AND. These are the 5 filters search_all allows
+        (it adds the hs_object_id cursor as the 6th and raises if there are more).
+    """
+    return [
+        {"propertyName": "associations.contact", "operator": "EQ", "value": str(contact_id)},
+        {"propertyName": TICKET_OPEN_PROPERTY, "operator": "EQ", "value": OPEN_VALUE},
+        property_filter('hs_ticket_category', ticket_category),
+        property_filter('hs_pipeline', ticket_pipeline),
+        {"propertyName": "hs_object_id", "operator": "NEQ", "value": str(ticket_id)}
+    ]
 
-    tickets_response = requests.post(tickets_url, headers=headers, json=tickets_payload)
+def get_associated_open_tickets(contact_id, ticket_id, ticket_category, ticket_pipeline):
+    """
+    Retrieves all open tickets associated with a given contact ID based on the 'is_ticket_open_' property,
+    in the same category and pipeline as the triggering ticket.
 
-    if tickets_response.status_code != 200:
-        raise Exception(f"Error fetching tickets: {tickets_response.text}")
+    Filtering happens in the tickets search API, so only matching tickets (without their
+    description) are downloaded. Results are ordered by ticket ID, i.e. oldest first.
 
-    tickets_data = tickets_response.json()
+    :param contact_id: The HubSpot contact ID.
+    :return: List of open tickets with their details.
+    """
+    filters = build_duplicate_filters(contact_id, ticket_id, ticket_category, ticket_pipeline)
 
     open_tickets = []
-
-    # Define what constitutes an "open" ticket based on the 'is_ticket_open_' property
-    ticket_open_property = 'is_ticket_open_'  # Custom property name
-    open_value = '1'  # Value indicating the ticket is open
-
-    for ticket in tickets_data.get('results', []):
+    for ticket in search_all(session, 'tickets', filters=filters, properties=DUPLICATE_PROPERTIES):
         properties = ticket.get('properties', {})
         print(properties)
-        is_open = properties.get(ticket_open_property, '')
-        original_ticket_id = properties.get('hs_object_id', '')
-        original_ticket_category = properties.get('hs_ticket_category', '')
-        original_ticket_pipeline = properties.get('hs_pipeline', '')
-        if original_ticket_id != ticket_id and is_open == open_value and original_ticket_category == ticket_category and original_ticket_pipeline == ticket_pipeline:
-            open_tickets.append({
-                'original_ticket_id': ticket.get('id'),
-                'original_ticket_description': properties.get('content', ''),
-                'is_open': is_open,
-                'created_at': properties.get('createdate', 'N/A')
-            })
+        open_tickets.append({
+            'original_ticket_id': ticket.get('id'),
+            'is_open': properties.get(TICKET_OPEN_PROPERTY, ''),
+            'created_at': properties.get('createdate', 'N/A')
+        })
     return open_tickets
 
+def get_ticket_description(ticket_id):
+    """
+    Retrieves the description ('content' property) of a single ticket.
+
+    :param ticket_id: The HubSpot ticket ID.
+    :return: The ticket description, or an empty string if it has none.
+    """
+    ticket_url = f"https://api.hubapi.com/crm/v3/objects/tickets/{ticket_id}"
+    response = session.get(ticket_url, params={'properties': 'content'})
+
+    if response.status_code != 200:
+        raise Exception(f"Error fetching ticket {ticket_id}: {response.text}")
+
+    return response.json().get('properties', {}).get('content') or ''
+
+def merged_description_prefix(ticket_description):
+    """
+    Returns the text put in front of a master ticket's description when a duplicate is merged into it.
+    """
+    return (
+        "(Duplicate ticket merged)\n\n"
+        "NEW TICKET\n"
+        f"{ticket_description}\n\n"
+        "ORIGINAL TICKET DESCRIPTION\n"
+    )
+
+def build_merged_description(original_ticket_description, ticket_description):
+    """
+    Builds the description of a master ticket after a duplicate has been merged into it.
+    A description that already starts with this duplicate's prefix (e.g. from a retried run) is kept as is.
+    """
+    prefix = merged_description_prefix(ticket_description)
+    if original_ticket_description.startswith(prefix):
+        return original_ticket_description
+    return prefix + original_ticket_description
+
 def update_source_ticket_stage_and_description(original_ticket_id, ticket_id, original_ticket_description, ticket_description, ticket_pipeline):
     """
     Updates ticket status to New and appends the description of a duplicate ticket to the original ticket in a specified format.
@@ -118,28 +159,26 @@ def update_source_ticket_stage_and_description(original_ticket_id, ticket_id, or
         }
 
     # Construct the new description in the specified format
-    new_description = (
-        "(Duplicate ticket merged)\n\n"
-        "NEW TICKET\n"
-        f"{ticket_description}\n\n"
-        "ORIGINAL TICKET DESCRIPTION\n"
-        f"{original_ticket_description}"
-    )
+    new_description = build_merged_description(original_ticket_description, ticket_description)
 
-    # Prepare the payload for the PATCH request
+    # Prepare the payload for the PATCH request; a description that already has this duplicate's
+    # prefix (the update went through on an earlier, retried run) is left alone
     payload = {
         "properties": {
-            "content": new_description,
             "hs_pipeline_stage": new_stage_id[ticket_pipeline]
         }
     }
+    if new_description != original_ticket_description:
+        payload["properties"]["content"] = new_description
+    else:
+        print(f"Ticket {original_ticket_id} already has the description of ticket {ticket_id}, only updating the stage.")
 
     # Define the API endpoint for updating the ticket
     update_url = f"https://api.hubapi.com/crm/v3/objects/tickets/{original_ticket_id}"
 
     try:
         # Make the PATCH request to update the original ticket's description
-        response = requests.patch(update_url, headers=headers, json=payload)
+        response = session.patch(update_url, json=payload)
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -188,7 +227,7 @@ def merge_tickets(ticket_id, original_ticket_id):
 
     try:
       # Make the POST request to merge the tickets
-      response = requests.post(merge_url, headers=headers, json=payload)
+      response = session.post(merge_url, json=payload)
       print(response)
       
       # Check if the request was successful
@@ -215,6 +254,236 @@ def merge_tickets(ticket_id, original_ticket_id):
       }
   
   
+# Number of duplicate groups merged at the same time by the sweep
+SWEEP_WORKERS = 4
+
+def get_tickets_contact_ids(ticket_ids):
+    """
+    Retrieves the first associated contact of up to 100 tickets with one v4 batch association read.
+
+    :param ticket_ids: Up to 100 HubSpot ticket IDs.
+    :return: Dictionary of ticket ID -> contact ID for tickets that have a contact.
+    """
+    associations_url = "https://api.hubapi.com/crm/v4/associations/tickets/contacts/batch/read"
+    payload = {"inputs": [{"id": str(tid)} for tid in ticket_ids]}
+
+    response = session.post(associations_url, json=payload)
+
+    # 207 is returned when some of the tickets have no associated contact
+    if response.status_code not in [200, 207]:
+        raise Exception(f"Error fetching associations: {response.text}")
+
+    contact_by_ticket = {}
+    for result in response.json().get('results', []):
+        to = result.get('to', [])
+        if to:
+            contact_by_ticket[str(result['from']['id'])] = str(to[0]['toObjectId'])
+    return contact_by_ticket
+
+def get_ticket_descriptions(ticket_ids):
+    """
+    Retrieves the descriptions of any number of tickets with concurrent 100-id batch reads.
+
+    :param ticket_ids: List of HubSpot ticket IDs.
+    :return: Dictionary of ticket ID -> description.
+    """
+    def read_batch(batch):
+        tickets_url = "https://api.hubapi.com/crm/v3/objects/tickets/batch/read"
+        payload = {"inputs": [{"id": tid} for tid in batch], "properties": ["content"]}
+        response = session.post(tickets_url, json=payload)
+
+        # 207 means some of the IDs could not be read (e.g. already merged tickets)
+        if response.status_code not in [200, 207]:
+            raise Exception(f"Error fetching tickets: {response.text}")
+        return response.json().get('results', [])
+
+    with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as executor:
+        batches = list(executor.map(read_batch, chunks(ticket_ids)))
+    return {
+        ticket['id']: ticket.get('properties', {}).get('content') or ''
+        for batch in batches for ticket in batch
+    }
+
+def build_open_ticket_index(created_within_days=None):
+    """
+    Streams every open ticket once and indexes it by (contact, category, pipeline).
+
+    Only pipelines with a known reopen stage in new_stage_id are included.
+
+    :param created_within_days: Only index tickets created in the last N days (all open tickets if None).
+    :return: Dictionary of (contact_id, category, pipeline) -> list of (createdate, ticket_id), oldest first.
+    """
+    filters = [
+        {"propertyName": TICKET_OPEN_PROPERTY, "operator": "EQ", "value": OPEN_VALUE},
+        {"propertyName": "hs_pipeline", "operator": "IN", "values": list(new_stage_id)}
+    ]
+    if created_within_days:
+        since_ms = int((time.time() - created_within_days * 86400) * 1000)
+        filters.append({"propertyName": "createdate", "operator": "GTE", "value": str(since_ms)})
+
+    index = {}
+    page = []
+
+    def index_page(tickets):
+        contact_by_ticket = get_tickets_contact_ids([ticket['id'] for ticket in tickets])
+        for ticket in tickets:
+            contact_id = contact_by_ticket.get(ticket['id'])
+            if contact_id is None:
+                continue
+            properties = ticket.get('properties', {})
+            key = (contact_id, properties.get('hs_ticket_category') or '', properties.get('hs_pipeline'))
+            index.setdefault(key, []).append((properties.get('createdate') or '', ticket['id']))
+
+    for ticket in search_all(session, 'tickets', filters=filters, properties=DUPLICATE_PROPERTIES):
+        page.append(ticket)
+        if len(page) == 100:
+            index_page(page)
+            page = []
+    if page:
+        index_page(page)
+
+    for tickets in index.values():
+        tickets.sort()
+    return index
+
+def merge_duplicate_group(key, ticket_ids, descriptions):
+    """
+    Merges every duplicate of a group into its oldest ticket, one after another.
+
+    :param key: The (contact_id, category, pipeline) index key of the group.
+    :param ticket_ids: Ticket IDs of the group, oldest (master) first.
+    :param descriptions: Dictionary of ticket ID -> description.
+    :return: Dictionary with the master ID and the merge status of each duplicate.
+    """
+    ticket_pipeline = key[2]
+    original_ticket_id = ticket_ids[0]
+    original_ticket_description = descriptions.get(original_ticket_id, '')
+    merged = {}
+
+    for ticket_id in ticket_ids[1:]:
+        ticket_description = descriptions.get(ticket_id, '')
+        update_source_ticket = update_source_ticket_stage_and_description(original_ticket_id, ticket_id, original_ticket_description, ticket_description, ticket_pipeline)
+        if update_source_ticket['status'] != 'success':
+            merged[ticket_id] = update_source_ticket['status']
+            continue
+
+        original_ticket_description = build_merged_description(original_ticket_description, ticket_description)
+        merged[ticket_id] = merge_tickets(ticket_id, original_ticket_id)['status']
+
+    return {
+        'original_ticket_id': original_ticket_id,
+        'merged': merged
+    }
+
+def sweep_duplicate_tickets(created_within_days=None, dry_run=False):
+    """
+    Deduplicates all open tickets at once instead of one workflow run per ticket.
+
+    Tickets of the same contact, category and pipeline are grouped, the oldest one becomes
+    the master and the others are merged into it with the same stage/description update
+    as the workflow action. Groups are processed with bounded concurrency.
+
+    :param created_within_days: Only consider tickets created in the last N days.
+    :param dry_run: Only report the duplicate groups without merging them.
+    :return: List with one result dictionary per duplicate group.
+    """
+    index = build_open_ticket_index(created_within_days)
+    groups = {key: [tid for _, tid in tickets] for key, tickets in index.items() if len(tickets) > 1}
+    print(f"Open ticket groups: {len(index)}, groups with duplicates: {len(groups)}")
+
+    if dry_run:
+        return [{'original_ticket_id': ids[0], 'duplicates': ids[1:]} for ids in groups.values()]
+
+    descriptions = get_ticket_descriptions([tid for ids in groups.values() for tid in ids])
+
+    with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as executor:
+        results = list(executor.map(lambda item: merge_duplicate_group(item[0], item[1], descriptions), groups.items()))
+
+    merged_count = sum(1 for result in results for status in result['merged'].values() if status == 'success')
+    print(f"Merged {merged_count} duplicate tickets into {len(results)} master tickets.")
+    return results
+
+def get_similar_open_tickets(index, ticket_id, ticket_description, ticket_pipeline, ticket_category=None, contact_id=None, threshold=DEFAULT_THRESHOLD):
+    """
+    Retrieves open tickets in the same pipeline whose description is near-identical to the given one.
+
+    Candidates come from the similarity index and are re-checked against HubSpot; tickets that
+    were closed or merged in the meantime are dropped from the index. Similar text alone does not
+    prove two tickets are the same request, so each ticket carries a `merge_signal`: 'same_contact'
+    or 'same_category' when a second signal confirms it, otherwise None.
+
+    :param index: SimilarityIndex of open ticket descriptions.
+    :param ticket_id: The ID of the ticket that triggered the workflow (excluded).
+    :param ticket_description: The description of the triggering ticket.
+    :param ticket_pipeline: The id of the ticket pipeline.
+    :param ticket_category: The category of the triggering ticket.
+    :param contact_id: The contact of the triggering ticket.
+    :param threshold: Minimum estimated similarity of the descriptions.
+    :return: List of open tickets with their details, most similar first.
+    """
+    matches = index.query(ticket_description, threshold=threshold, pipeline=ticket_pipeline, exclude=ticket_id)
+    if not matches:
+        return []
+
+    tickets_url = "https://api.hubapi.com/crm/v3/objects/tickets/batch/read"
+    payload = {
+        "inputs": [{"id": tid} for tid, _ in matches[:100]],
+        "properties": DUPLICATE_PROPERTIES
+    }
+    response = session.post(tickets_url, json=payload)
+
+    # 207 means some of the IDs could not be read (e.g. already merged tickets)
+    if response.status_code not in [200, 207]:
+        raise Exception(f"Error fetching tickets: {response.text}")
+
+    current = {ticket['id']: ticket.get('properties', {}) for ticket in response.json().get('results', [])}
+    contacts = batch_read_associations(session, 'tickets', 'contacts', list(current)) if contact_id and current else {}
+
+    similar_tickets = []
+    for tid, similarity in matches[:100]:
+        properties = current.get(tid)
+        if properties is None or properties.get(TICKET_OPEN_PROPERTY) != OPEN_VALUE:
+            index.remove(tid)
+            continue
+        similar_tickets.append({
+            'original_ticket_id': tid,
+            'is_open': properties.get(TICKET_OPEN_PROPERTY),
+            'created_at': properties.get('createdate', 'N/A'),
+            'similarity': round(similarity, 2),
+            'merge_signal': (
+                'same_contact' if contact_id and str(contact_id) in contacts.get(tid, []) else
+                'same_category' if ticket_category and properties.get('hs_ticket_category') == ticket_category else
+                None
+            )
+        })
+    return similar_tickets
+
+def build_similarity_index(path=SIMILARITY_INDEX_PATH):
+    """
+    Indexes every open ticket in the similarity index at `path` and drops tickets that are no
+    longer open. The index stays usable by running workflows while it is rebuilt.
+
+    :return: The SimilarityIndex.
+    """
+    index = SimilarityIndex(path)
+    filters = [{"propertyName": TICKET_OPEN_PROPERTY, "operator": "EQ", "value": OPEN_VALUE}]
+    tickets = (
+        (ticket['id'], ticket.get('properties', {}).get('content'), ticket.get('properties', {}).get('hs_pipeline'))
+        for ticket in search_all(session, 'tickets', filters=filters, properties=['content', 'hs_pipeline'])
+    )
+
+    open_ids, indexed = [], 0
+    for ticket_id, added in index.add_many(tickets):
+        open_ids.append(ticket_id)
+        indexed += added
+        if len(open_ids) % 10000 == 0:
+            print(f"Processed tickets: {len(open_ids)}, indexed: {indexed}")
+
+    removed = index.retain(open_ids)
+    print(f"Similarity index {path}: {indexed} of {len(open_ids)} open tickets indexed, {removed} closed tickets removed")
+    return index
+
+@with_deadline(open_tickets=[], duplicate_candidates=[], is_duplicate="unknown", merge_status="unknown")
 def main(event):
   
   contact_id = event["inputFields"]["contact_id"]
@@ -227,15 +496,27 @@ def main(event):
   merge_status = "not applicable"
   
   open_tickets = get_associated_open_tickets(contact_id, ticket_id, ticket_category, ticket_pipeline)
+
+  # Fall back to textually near-identical open tickets (other contact address or AI category).
+  # A merge cannot be undone, so only matches confirmed by the same contact or category are
+  # merged; the others are returned as candidates for a person to review.
+  index = SimilarityIndex(SIMILARITY_INDEX_PATH) if SIMILARITY_INDEX_PATH else None
+  duplicate_candidates = []
+  if not open_tickets and index is not None:
+    similar_tickets = get_similar_open_tickets(index, ticket_id, ticket_description, ticket_pipeline, ticket_category, contact_id)
+    open_tickets = [ticket for ticket in similar_tickets if ticket['merge_signal']]
+    duplicate_candidates = [ticket for ticket in similar_tickets if not ticket['merge_signal']]
   print(open_tickets)
   
   if len(open_tickets) == 0:
-    is_duplicate = 'no'
+    is_duplicate = 'candidate' if duplicate_candidates else 'no'
   else:
     is_duplicate = 'yes'
     original_ticket_id = open_tickets[0]['original_ticket_id']
-    original_ticket_description = open_tickets[0]['original_ticket_description']
-    
+    original_ticket_description = get_ticket_description(original_ticket_id)
+
+    # Retry the whole event rather than run out of time between the update and the merge
+    check(min_remaining=WRITE_BUDGET)
     update_source_ticket = update_source_ticket_stage_and_description(original_ticket_id, ticket_id, original_ticket_description, ticket_description,ticket_pipeline)
     print(update_source_ticket)
 
@@ -243,6 +524,14 @@ def main(event):
         merged_tickets = merge_tickets(ticket_id, open_tickets[0]['original_ticket_id'])
         merge_status = merged_tickets['status']
         print(merged_tickets)
+
+  # Keep the index in sync: a merged ticket is gone, any other new ticket becomes a candidate
+  if index is not None:
+    if merge_status == 'success':
+      index.remove(ticket_id)
+    else:
+      index.add(ticket_id, ticket_description, pipeline=ticket_pipeline)
+    index.close()
 		
   
   # Return the output data that can be used in later actions in your workflow.
@@ -250,7 +539,20 @@ def main(event):
     "outputFields": {
       "contact_id": contact_id,
       "open_tickets": open_tickets,
+      "duplicate_candidates": duplicate_candidates,
       "is_duplicate": is_duplicate,
       "merge_status": merge_status 
     }
   }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Merge all duplicate open tickets in one sweep.")
+  parser.add_argument("--days", type=int, default=None, help="only consider tickets created in the last N days")
+  parser.add_argument("--dry-run", action="store_true", help="list the duplicate groups without merging them")
+  parser.add_argument("--build-similarity-index", action="store_true", help="rebuild the near-duplicate index from all open tickets instead of sweeping")
+  args = parser.parse_args()
+  if args.build_similarity_index:
+    build_similarity_index()
+  else:
+    print(json.dumps(sweep_duplicate_tickets(created_within_days=args.days, dry_run=args.dry_run), indent=2))
@@ -0,0 +1,257 @@
+# Near-duplicate ticket detection with MinHash signatures and an LSH (locality-sensitive hashing) index.
+# Each ticket description is normalized, split into word shingles and reduced to a fixed-size
+# MinHash signature. Signatures are split into bands; tickets sharing any band land in the same
+# bucket, so a lookup only compares against a handful of candidates instead of every open ticket.
+# The index lives in SQLite with one row per ticket and per (band, bucket), so a workflow event
+# reads and writes only the rows of its own ticket and buckets, whatever the size of the index.
+
+import hashlib
+import random
+import re
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+from itertools import islice
+
+# 16 bands x 4 rows: tickets with ~80% shingle overlap collide in at least one band >99.9% of the time
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+NUM_PERM = NUM_BANDS * ROWS_PER_BAND
+
+# Words per shingle
+SHINGLE_SIZE = 3
+
+# Estimated Jaccard similarity above which two tickets count as duplicates
+DEFAULT_THRESHOLD = 0.8
+
+# Short texts ("where is my order") are near-identical across unrelated customers, so tickets
+# with fewer shingles than this are neither indexed nor looked up
+MIN_SHINGLES = 8
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Fixed seed so signatures stay comparable across runs and with saved indexes
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_text(text):
+    """
+    Lowercases a ticket description and strips HTML tags, punctuation and extra whitespace.
+    """
+    text = _TAG_RE.sub(" ", text or "")
+    return _NON_WORD_RE.sub(" ", text.lower()).strip()
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """
+    Returns the set of `size`-word shingles of a normalized text (single words for short texts).
+    """
+    words = text.split()
+    if len(words) < size:
+        return set(words)
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _hash_shingle(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+def minhash_signature(text):
+    """
+    Computes the MinHash signature of a ticket description.
+
+    :param text: Raw ticket description.
+    :return: array of NUM_PERM hash values, or None if the text has fewer than MIN_SHINGLES shingles.
+    """
+    hashes = [_hash_shingle(s) for s in shingles(normalize_text(text))]
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    return array("Q", (
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    ))
+
+
+def estimate_similarity(signature, other):
+    """
+    Estimates the Jaccard similarity of two tickets from their signatures.
+    """
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_PERM
+
+
+def _band_keys(signature):
+    # Stable 64-bit key per band (Python's hash() may differ between versions and platforms)
+    return [
+        int.from_bytes(hashlib.blake2b(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes(), digest_size=8).digest(), "little", signed=True)
+        for band in range(NUM_BANDS)
+    ]
+
+
+class SimilarityIndex:
+    """
+    Incrementally updated LSH index of open ticket descriptions, stored in SQLite.
+
+    Every ticket has one row with its signature and pipeline and one (band, bucket) row per
+    band, so adding, removing and looking up a ticket only touch that ticket's rows and the
+    matching buckets, each in its own transaction. Several processes can share the file.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS tickets (ticket_id TEXT PRIMARY KEY, pipeline TEXT, signature BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, bucket INTEGER NOT NULL, ticket_id TEXT NOT NULL, "
+            "PRIMARY KEY (band, bucket, ticket_id)) WITHOUT ROWID;"
+        )
+        with self._transaction() as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'num_perm'").fetchone()
+            if row is None:
+                connection.execute("INSERT INTO meta VALUES ('num_perm', ?)", (str(NUM_PERM),))
+            elif int(row[0]) != NUM_PERM:
+                raise ValueError(f"Similarity index {path} was built with {row[0]} permutations, expected {NUM_PERM}; rebuild it.")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent runs never lose each other's changes
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+
+    def __contains__(self, ticket_id):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM tickets WHERE ticket_id = ?", (str(ticket_id),)).fetchone() is not None
+
+    def _remove(self, connection, ticket_id):
+        row = connection.execute("SELECT signature FROM tickets WHERE ticket_id = ?", (ticket_id,)).fetchone()
+        if row is None:
+            return
+        connection.execute("DELETE FROM tickets WHERE ticket_id = ?", (ticket_id,))
+        connection.executemany(
+            "DELETE FROM buckets WHERE band = ? AND bucket = ? AND ticket_id = ?",
+            [(band, key, ticket_id) for band, key in enumerate(_band_keys(array("Q", row[0])))]
+        )
+
+    def _add(self, connection, ticket_id, text, pipeline, signature):
+        self._remove(connection, ticket_id)
+        signature = signature if signature is not None else minhash_signature(text)
+        if signature is None:
+            return False
+        connection.execute("INSERT INTO tickets VALUES (?, ?, ?)", (ticket_id, pipeline, signature.tobytes()))
+        connection.executemany(
+            "INSERT INTO buckets VALUES (?, ?, ?)",
+            [(band, key, ticket_id) for band, key in enumerate(_band_keys(signature))]
+        )
+        return True
+
+    def add(self, ticket_id, text, pipeline=None, signature=None):
+        """
+        Adds (or replaces) a ticket in the index.
+
+        :param ticket_id: The HubSpot ticket ID.
+        :param text: The ticket description.
+        :param pipeline: The id of the ticket pipeline.
+        :param signature: Precomputed signature, if the caller already has one.
+        :return: True if the ticket was indexed, False if its description is too short.
+        """
+        with self._transaction() as connection:
+            return self._add(connection, str(ticket_id), text, pipeline, signature)
+
+    def add_many(self, tickets, batch_size=1000):
+        """
+        Adds tickets in transactions of `batch_size` (for building the index).
+
+        :param tickets: Iterable of (ticket_id, text, pipeline).
+        :return: Generator yielding (ticket_id, indexed) for every ticket once it is committed.
+        """
+        iterator = iter(tickets)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            with self._transaction() as connection:
+                results = [(str(ticket_id), self._add(connection, str(ticket_id), text, pipeline, None))
+                           for ticket_id, text, pipeline in batch]
+            yield from results
+
+    def remove(self, ticket_id):
+        """
+        Removes a ticket from the index (e.g. once it is closed or merged).
+        """
+        with self._transaction() as connection:
+            self._remove(connection, str(ticket_id))
+
+    def retain(self, ticket_ids):
+        """
+        Removes every ticket not in `ticket_ids` (e.g. tickets closed since the index was built).
+
+        :return: Number of removed tickets.
+        """
+        keep = {str(ticket_id) for ticket_id in ticket_ids}
+        with self._lock:
+            indexed = [row[0] for row in self._connection.execute("SELECT ticket_id FROM tickets")]
+        stale = [ticket_id for ticket_id in indexed if ticket_id not in keep]
+        for i in range(0, len(stale), 1000):
+            with self._transaction() as connection:
+                for ticket_id in stale[i:i + 1000]:
+                    self._remove(connection, ticket_id)
+        return len(stale)
+
+    def query(self, text, threshold=DEFAULT_THRESHOLD, pipeline=None, exclude=None, signature=None):
+        """
+        Finds indexed tickets whose description is near-identical to the given text.
+
+        :param text: The ticket description to look up.
+        :param threshold: Minimum estimated Jaccard similarity.
+        :param pipeline: Only return tickets from this pipeline, if given.
+        :param exclude: Ticket ID to leave out of the results (usually the ticket itself).
+        :param signature: Precomputed signature, if the caller already has one.
+        :return: List of (ticket_id, similarity), most similar first.
+        """
+        signature = signature if signature is not None else minhash_signature(text)
+        if signature is None:
+            return []
+
+        keys = _band_keys(signature)
+        conditions = " OR ".join(["(b.band = ? AND b.bucket = ?)"] * len(keys))
+        parameters = [value for band, key in enumerate(keys) for value in (band, key)]
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT t.ticket_id, t.pipeline, t.signature FROM buckets b "
+                f"JOIN tickets t ON t.ticket_id = b.ticket_id WHERE {conditions}",
+                parameters
+            ).fetchall()
+
+        matches = []
+        for ticket_id, ticket_pipeline, candidate in rows:
+            if ticket_id == str(exclude) or (pipeline is not None and ticket_pipeline != pipeline):
+                continue
+            similarity = estimate_similarity(signature, array("Q", candidate))
+            if similarity >= threshold:
+                matches.append((ticket_id, similarity))
+        return sorted(matches, key=lambda match: (-match[1], int(match[0])))
@@ -0,0 +1,107 @@
+# In-memory directory of HubSpot owners (active and archived), loaded in bulk through the
+# paginated crm/v3/owners endpoint -- the same way AppsScript/fetchUsers.gs does -- so owner
+# ids can be resolved to email/name without one API call per lookup.
+
+import time
+
+from ttl_cache import TTLCache
+
+OWNERS_URL = "/crm/v3/owners"
+
+# How long a loaded directory is trusted before it is reloaded
+OWNERS_TTL = 6 * 3600
+
+# An unknown owner id triggers a reload (new user), but at most this often
+MIN_RELOAD_INTERVAL = 60
+
+
+def fetch_owners(session, archived):
+    """
+    Retrieves every owner from HubSpot, following the pagination cursor.
+
+    :param session: HubSpotSession used for the calls.
+    :param archived: True for deactivated owners, False for active ones.
+    :return: List of owner records.
+    """
+    params = {"limit": 100, "archived": str(archived).lower()}
+    owners = []
+
+    while True:
+        response = session.get(OWNERS_URL, params=params)
+
+        if response.status_code != 200:
+            raise Exception(f"Error fetching owners: {response.text}")
+
+        data = response.json()
+        owners.extend(data.get("results", []))
+
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            return owners
+        params["after"] = after
+
+
+class OwnerDirectory:
+    """
+    id -> owner index with TTL refresh, optionally shared between runs through a cache file.
+    """
+
+    def __init__(self, session, ttl=OWNERS_TTL, path=None):
+        self.session = session
+        self.cache = TTLCache(ttl, path=path)
+        self._last_reload = 0.0
+
+    def reload(self):
+        """
+        Loads all active and archived owners and replaces the cached index.
+        """
+        owners = {}
+        for archived in (True, False):
+            for owner in fetch_owners(self.session, archived):
+                owners[str(owner["id"])] = {
+                    "email": owner.get("email") or "",
+                    "first_name": owner.get("firstName") or "",
+                    "last_name": owner.get("lastName") or "",
+                    "user_id": owner.get("userId"),
+                    "archived": archived
+                }
+        self.cache.set("owners", owners)
+        self._last_reload = time.time()
+        print(f"Loaded {len(owners)} owners.")
+        return owners
+
+    def owners(self):
+        """
+        Returns the whole index, reloading it if it is missing or expired.
+        """
+        owners = self.cache.get("owners")
+        if owners is None:
+            owners = self.reload()
+        return owners
+
+    def get(self, owner_id):
+        """
+        Resolves an owner id to its record (email, first_name, last_name, user_id, archived).
+
+        :param owner_id: The HubSpot owner ID.
+        :return: Owner dictionary, or None if the owner does not exist.
+        """
+        owner_id = str(owner_id)
+        owner = self.owners().get(owner_id)
+        if owner is None and time.time() - self._last_reload > MIN_RELOAD_INTERVAL:
+            owner = self.reload().get(owner_id)
+        return owner
+
+    def email(self, owner_id):
+        """
+        Returns the owner's email address, or an empty string if the owner does not exist.
+        """
+        owner = self.get(owner_id)
+        return owner["email"] if owner else ""
+
+    def full_name(self, owner_id):
+        """
+        Returns the owner's full name, or an empty string if the owner does not exist.
+        """
+        owner = self.get(owner_id)
+        return f"{owner['first_name']} {owner['last_name']}".strip() if owner else ""
@@ -0,0 +1,30 @@
+# The shared modules live at the repository root and every action in its own folder (often with
+# spaces in the name), so tests put the root on sys.path and load action scripts by file path.
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def load_action():
+    """
+    Returns a loader for action scripts, e.g. load_action("Lead to Deal association/main.py").
+    The script's folder is put on sys.path so its sibling modules import as in production.
+    """
+    def load(relative_path, name=None):
+        path = os.path.join(ROOT, relative_path)
+        folder = os.path.dirname(path)
+        if folder not in sys.path:
+            sys.path.insert(0, folder)
+        name = name or os.path.splitext(os.path.basename(path))[0] + "_" + str(abs(hash(path)))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
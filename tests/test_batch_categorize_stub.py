@@ -0,0 +1,103 @@
+# End-to-end run of batch_categorize.py against openai_stub.py: tickets come from a fake
+# search, every pack goes through the stub over HTTP and the written categories are captured.
+
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+TICKETS = [
+    ("Second installment", "I was charged twice for my invoice, please refund one payment."),
+    ("Passport upload", "Which document do you need for the KYC verification?"),
+    ("Checkout broken", "I get an error at checkout and cannot finish the purchase."),
+    ("Where is it?", "The tracking number of my order does not work."),
+    ("Question", "Do you offer a discount for a yearly plan?"),
+]
+EXPECTED = ["payment", "documentation", "technical", "order_status", "sales"]
+
+
+@pytest.fixture
+def stub_server(load_action):
+    stub = load_action("Ticket categories with AI/openai_stub.py", "openai_stub")
+    stats = {"active": 0, "max_active": 0, "requests": 0}
+    lock = threading.Lock()
+
+    class CountingHandler(stub.StubHandler):
+        def do_POST(self):
+            with lock:
+                stats["active"] += 1
+                stats["requests"] += 1
+                stats["max_active"] = max(stats["max_active"], stats["active"])
+            try:
+                # Slow enough that the packs of one window overlap
+                time.sleep(0.05)
+                super().do_POST()
+            finally:
+                with lock:
+                    stats["active"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", stats
+    server.shutdown()
+    server.server_close()
+
+
+def test_batch_categorize_against_stub(stub_server, load_action, monkeypatch, tmp_path):
+    base_url, stats = stub_server
+    monkeypatch.setenv("OpenAI", "test-key")
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path / "no_model.npz"))
+    batch = load_action("Ticket categories with AI/batch_categorize.py", "batch_categorize")
+
+    tickets = [
+        {"id": str(i + 1), "properties": {"subject": TICKETS[i % 5][0], "content": TICKETS[i % 5][1]}}
+        for i in range(250)
+    ]
+    monkeypatch.setattr(batch, "search_all", lambda *args, after_id=0, **kwargs: iter(t for t in tickets if int(t["id"]) > after_id))
+    written = {}
+    monkeypatch.setattr(batch, "update_ticket_categories", lambda session, categories: written.update(categories) or [])
+
+    summary = batch.categorize_all_tickets(checkpoint_path=str(tmp_path / "checkpoint.json"))
+
+    assert written == {ticket["id"]: EXPECTED[i % 5] for i, ticket in enumerate(tickets)}
+    assert summary["categorized"] == 250 and summary["failed"] == []
+    assert summary["counts"] == {category: 50 for category in EXPECTED}
+    # One request per pack of TICKETS_PER_REQUEST, at most MAX_WORKERS in flight
+    assert stats["requests"] == 250 // batch.TICKETS_PER_REQUEST
+    assert 1 < stats["max_active"] <= batch.MAX_WORKERS
+
+
+def test_tickets_rejected_by_the_update_are_checkpointed_as_failed(load_action, monkeypatch, tmp_path):
+    monkeypatch.setenv("OpenAI", "test-key")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path / "no_model.npz"))
+    batch = load_action("Ticket categories with AI/batch_categorize.py", "batch_categorize")
+
+    tickets = [{"id": str(i), "properties": {"subject": "Question", "content": TICKETS[4][1]}} for i in range(1, 5)]
+    monkeypatch.setattr(batch, "search_all", lambda *args, after_id=0, **kwargs: iter(t for t in tickets if int(t["id"]) > after_id))
+    monkeypatch.setattr(batch, "categorize_pack", lambda pack: {ticket["id"]: "sales" for ticket in pack})
+
+    class Response:
+        status_code = 207
+
+        def json(self):
+            return {"results": [{"id": "1"}, {"id": "2"}, {"id": "4"}],
+                    "errors": [{"message": "Object not found. objectId=3", "context": {"ids": ["3"]}}]}
+
+    class Session:
+        def post(self, url, json):
+            return Response()
+
+    monkeypatch.setattr(batch, "get_session", lambda token: Session())
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    summary = batch.categorize_all_tickets(checkpoint_path=checkpoint_path)
+
+    assert summary == {"categorized": 3, "failed": ["3"], "counts": {"sales": 3}}
+    assert batch.load_checkpoint(checkpoint_path) == {"last_id": 4, "categorized": 3, "failed": ["3"]}
@@ -0,0 +1,43 @@
+# The breaker's window counts are shared through SQLite, so failures of separate invocations
+# (each its own process) add up, while successes on a healthy circuit write nothing.
+
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT
+
+RECORD_ONE_FAILURE = """
+import requests
+from circuit_breaker import CircuitBreaker
+
+def unreachable():
+    raise requests.exceptions.ConnectionError("down")
+
+try:
+    CircuitBreaker("example.com", path={path!r}).call(unreachable)
+except requests.exceptions.ConnectionError:
+    pass
+"""
+
+
+def test_failures_of_separate_processes_trip_the_circuit(tmp_path):
+    from circuit_breaker import MIN_CALLS, CircuitBreaker
+
+    path = str(tmp_path / "breakers.db")
+    for _ in range(MIN_CALLS):
+        subprocess.run([sys.executable, "-c", RECORD_ONE_FAILURE.format(path=path)], cwd=ROOT, check=True)
+
+    assert CircuitBreaker("example.com", path=path).state() == "open"
+
+
+def test_successes_on_a_closed_circuit_do_not_write(tmp_path):
+    from circuit_breaker import CircuitBreaker
+
+    path = str(tmp_path / "breakers.db")
+    breaker = CircuitBreaker("example.com", path=path)
+    for _ in range(100):
+        breaker.call(lambda: "ok")
+
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM circuit_breaker_states").fetchone()[0] == 0
@@ -0,0 +1,48 @@
+# The batch re-scoring (lead_priority_batch) must give every lead the same output fields as
+# the per-event path of determine_time_of_day_v4 (market_time functions called per lead).
+
+import random
+from datetime import datetime, timezone
+
+from lead_priority_batch import classify_batch
+from market_time import MARKET_TIMEZONES, classify_hour, get_local_time, lead_priority, lead_source_priority
+
+MARKETS = list(MARKET_TIMEZONES) + ["", "unknown", " GB "]
+CAMPAIGNS = ["personal_referral", " personal_referral", "newsletter", "", None]
+LEVELS = ["", "1", "2", "3", "2.0", 2, 3, 3.0, None, "n/a"]
+HV_ELIGIBLE = [True, False, "true", "false", "TRUE", "", None]
+
+
+def per_event(timestamp_ms, market, campaign, level, hv_eligible):
+    now = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc)
+    local_time, _ = get_local_time(market, now=now)
+    hour_of_inquiry = classify_hour(local_time["hour"])
+    return {
+        "hour_of_inquiry": hour_of_inquiry,
+        "day_of_inquiry": local_time["dayOfWeek"],
+        "lead_priority": lead_priority(local_time["dayOfWeek"], hour_of_inquiry),
+        "lead_source_priority": lead_source_priority(campaign, level, hv_eligible),
+    }
+
+
+def test_batch_matches_per_event_on_random_leads():
+    rng = random.Random(20261018)
+    start = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    end = int(datetime(2026, 12, 31, tzinfo=timezone.utc).timestamp() * 1000)
+    rows = [
+        (rng.randrange(start, end), rng.choice(MARKETS), rng.choice(CAMPAIGNS), rng.choice(LEVELS), rng.choice(HV_ELIGIBLE))
+        for _ in range(5000)
+    ]
+
+    results = classify_batch(*zip(*rows))
+
+    for i, row in enumerate(rows):
+        assert {field: values[i].item() for field, values in results.items()} == per_event(*row), row
+
+
+def test_lead_source_inputs_are_normalized():
+    assert lead_source_priority("", "2", "false") == 2
+    assert lead_source_priority(None, 2, False) == 2
+    assert lead_source_priority("", "2", "true") == 1
+    assert lead_source_priority("", "3.0", None) == 1
+    assert lead_source_priority("", "", "") == 1
@@ -0,0 +1,59 @@
+# Response recorded from POST /crm/v4/associations/0-136/0-3/batch/associate/default (207: one pair failed)
+SAMPLE_RESPONSE = {
+    "status": "COMPLETE",
+    "results": [
+        {
+            "from": {"id": "62431006571"},
+            "to": {"id": "21395374811"},
+            "associationSpec": {"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": 583}
+        }
+    ],
+    "numErrors": 1,
+    "errors": [
+        {
+            "status": "error",
+            "category": "VALIDATION_ERROR",
+            "message": "No deal with id 999 exists",
+            "context": {"fromObjectId": ["62431006572"], "toObjectId": ["999"]}
+        }
+    ],
+    "startedAt": "2026-10-01T09:12:44.102Z",
+    "completedAt": "2026-10-01T09:12:44.311Z"
+}
+
+
+def test_parse_batch_associate_response_matches_recorded_sample(load_action):
+    module = load_action("Lead to Deal association/main.py")
+    pairs = [("62431006571", "21395374811"), ("62431006572", "999")]
+
+    statuses = module.parse_batch_associate_response(SAMPLE_RESPONSE, pairs)
+
+    assert statuses == {
+        ("62431006571", "21395374811"): "success",
+        ("62431006572", "999"): "No deal with id 999 exists",
+    }
+
+
+def test_parse_batch_associate_response_gives_each_pair_its_own_error(load_action):
+    module = load_action("Lead to Deal association/main.py")
+    response = {
+        "status": "COMPLETE",
+        "results": [{"from": {"id": "1"}, "to": {"id": "10"}}],
+        "numErrors": 2,
+        "errors": [
+            {"status": "error", "category": "VALIDATION_ERROR", "message": "No deal with id 999 exists",
+             "context": {"fromObjectId": ["2"], "toObjectId": ["999"]}},
+            {"status": "error", "category": "VALIDATION_ERROR", "message": "No lead with id 3 exists",
+             "context": {"fromObjectId": ["3"], "toObjectId": ["30"]}},
+        ],
+    }
+    pairs = [("1", "10"), ("2", "999"), ("3", "30"), ("4", "40")]
+
+    statuses = module.parse_batch_associate_response(response, pairs)
+
+    assert statuses == {
+        ("1", "10"): "success",
+        ("2", "999"): "No deal with id 999 exists",
+        ("3", "30"): "No lead with id 3 exists",
+        ("4", "40"): "not created",
+    }
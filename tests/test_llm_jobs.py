@@ -0,0 +1,50 @@
+# A 207 from the batch update only completes the records HubSpot updated; rejected records
+# are failed and retried instead of being marked done.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_jobs
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    def __init__(self, response):
+        self.response = response
+        self.payloads = []
+
+    def post(self, url, json):
+        self.payloads.append(json)
+        return self.response
+
+
+def test_rejected_records_of_a_207_are_failed_not_completed(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    for object_id in ("1", "2", "3"):
+        llm_jobs.enqueue("poem", object_id, {"name": object_id}, path=path)
+    session = Session(Response(207, {
+        "status": "COMPLETE",
+        "results": [{"id": "1", "properties": {}}, {"id": "3", "properties": {}}],
+        "numErrors": 1,
+        "errors": [{"status": "error", "category": "OBJECT_NOT_FOUND", "message": "Object not found. objectId=2",
+                    "context": {"ids": ["2"]}}],
+    }))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        llm_jobs.process_jobs("poem", lambda payload: {"prompt_output": payload["name"]}, session, "deals", executor, path=path)
+
+    with llm_jobs.get_queue(path) as connection:
+        statuses = dict(connection.execute("SELECT object_id, status || ':' || COALESCE(last_error, '') FROM jobs"))
+    assert statuses == {
+        "1": "done:",
+        "2": "pending:Object not found. objectId=2",
+        "3": "done:",
+    }
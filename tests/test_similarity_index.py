@@ -0,0 +1,20 @@
+LONG_TICKET = ("I ordered a blue jacket last week and the tracking page still shows "
+               "the parcel waiting at the warehouse in Poznan")
+
+
+def test_short_descriptions_are_neither_indexed_nor_matched(load_action):
+    similarity_index = load_action("merge_duplicate_tickets/similarity_index.py")
+    index = similarity_index.SimilarityIndex()
+
+    assert index.add("1", "Where is my order?") is False
+    assert index.query("where is my order") == []
+    assert len(index) == 0
+
+
+def test_near_identical_long_descriptions_match(load_action):
+    similarity_index = load_action("merge_duplicate_tickets/similarity_index.py")
+    index = similarity_index.SimilarityIndex()
+    index.add("1", LONG_TICKET, pipeline="0")
+
+    assert index.query(LONG_TICKET + "!", pipeline="0", exclude="2") == [("1", 1.0)]
+    assert index.query(LONG_TICKET, pipeline="5370445") == []
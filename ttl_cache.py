@@ -0,0 +1,186 @@
+# Small TTL cache shared by the custom code actions.
+# Values live in memory and, when a file path is given, in a SQLite file as well, so warm
+# and later runs on the same host (and concurrent processes) can reuse what another run
+# already fetched. The file is read and written one key at a time: a set is a single upsert.
+# Optionally bounded (least recently used entries are evicted first), and get_or_set()
+# coalesces concurrent misses for the same key into a single computation.
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Expired rows (and rows beyond max_entries) are deleted from the file every this many sets
+PRUNE_EVERY = 100
+
+_MISSING = object()
+
+
+class _InFlight:
+    """
+    A computation other threads asking for the same key wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    Key/value cache where every entry expires `ttl` seconds after it was set.
+
+    Values must be JSON-serializable when the cache is backed by a file.
+    With `max_entries`, the least recently used entries are evicted beyond that size.
+    """
+
+    def __init__(self, ttl, path=None, max_entries=None):
+        self.ttl = ttl
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._connection = None
+        self._sets = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _store(self):
+        # Lazily open the file tier on first use (callers hold the lock)
+        if self._connection is None and self.path:
+            try:
+                connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+                )
+                self._connection = connection
+            except sqlite3.Error as e:
+                print(f"Ignoring unusable cache file {self.path}: {e}")
+                self.path = None
+        return self._connection
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune(self, store, now):
+        # Drop expired rows, and beyond max_entries the ones closest to expiry
+        store.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        if self.max_entries is not None:
+            store.execute(
+                "DELETE FROM entries WHERE key NOT IN (SELECT key FROM entries ORDER BY expires_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for `key`, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is None:
+                store = self._store()
+                if store is not None:
+                    try:
+                        row = store.execute("SELECT expires_at, value FROM entries WHERE key = ?", (str(key),)).fetchone()
+                    except sqlite3.Error as e:
+                        print(f"Failed to read cache file {self.path}: {e}")
+                        row = None
+                    if row is not None:
+                        entry = self._entries[key] = (row[0], json.loads(row[1]))
+                        self._evict()
+            if entry is None or entry[0] < now:
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value for `ttl` seconds (the cache default if not given).
+        """
+        with self._lock:
+            now = time.time()
+            expires_at = now + (self.ttl if ttl is None else ttl)
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            self._evict()
+            store = self._store()
+            if store is None:
+                return
+            try:
+                store.execute(
+                    "INSERT INTO entries (key, expires_at, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at, value = excluded.value",
+                    (str(key), expires_at, json.dumps(value))
+                )
+                self._sets += 1
+                if self._sets % PRUNE_EVERY == 0:
+                    self._prune(store, now)
+            except sqlite3.Error as e:
+                print(f"Failed to write cache file {self.path}: {e}")
+
+    def get_or_set(self, key, compute, ttl=None, should_cache=None):
+        """
+        Returns the cached value for `key`, computing and storing it on a miss.
+
+        Concurrent misses for the same key share one call to `compute`; the other callers
+        wait for its result (or exception) instead of computing it again.
+
+        :param compute: Callable without arguments producing the value.
+        :param should_cache: Optional predicate on the value; values failing it (e.g. error
+            results) are returned but not stored.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+            if should_cache is None or should_cache(call.value):
+                self.set(key, call.value, ttl)
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def invalidate(self, key=None):
+        """
+        Drops one key, or every key when called without arguments.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            store = self._store()
+            if store is None:
+                return
+            try:
+                if key is None:
+                    store.execute("DELETE FROM entries")
+                else:
+                    store.execute("DELETE FROM entries WHERE key = ?", (str(key),))
+            except sqlite3.Error as e:
+                print(f"Failed to write cache file {self.path}: {e}")